@@ -0,0 +1,355 @@
+import xarray
+import rasterio
+import geopandas as gpd
+import numpy as np
+import shapely
+import hydra
+import logging
+import json
+import os
+import pathlib
+import platform
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from hydra.utils import get_original_cwd
+
+# the benchmarks are run as a script from the repository root, without PYTHONPATH
+REPO_DIR = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_DIR))
+
+from utils.component_files import available_shapefile_year
+from utils.faster_zonal_stats import (
+    bounds_windows,
+    color_windows,
+    polygon_to_raster_cells,
+    polygon_to_raster_cells_layer,
+    zonal_means,
+)
+from utils.mapping_cache import cells_to_csr
+
+
+# configure logger to print at info level
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+month_abbrs = ["JAN", "FEB", "MAR", "APR", "MAY", "JUN", "JUL", "AUG", "SEP", "OCT", "NOV", "DEC"]
+
+
+# == synthetic inputs
+
+def make_grid(cfg):
+    """
+    Cell center coordinates of the synthetic grid (ascending and float64 by default, as in the component files)
+    """
+    res = cfg.grid.resolution
+    lon = np.arange(cfg.grid.lon_min + res / 2, cfg.grid.lon_max, res).astype(cfg.grid.coordinate_dtype)
+    lat = np.arange(cfg.grid.lat_min + res / 2, cfg.grid.lat_max, res).astype(cfg.grid.coordinate_dtype)
+    return lat, lon
+
+
+def write_component_files(cfg, rng, lat, lon):
+    """
+    Write one yearly and twelve monthly files per component file prefix, with all the layers of that prefix
+    """
+    # layers stored in the same file (e.g. GWROM and GWROM_H2O)
+    prefixes = {}
+    for component, component_cfg in cfg.satellite_component.component.items():
+        prefixes.setdefault(component_cfg.file_prefix, []).append((component, component_cfg.layer))
+
+    # smooth field plus noise, with a block of nodata cells shared by all the files
+    yy, xx = np.meshgrid(np.linspace(0, 3, lat.size), np.linspace(0, 3, lon.size), indexing="ij")
+    field = (np.sin(xx) + np.cos(yy) + 2).astype("float32")
+    nodata_rows = int(lat.size * cfg.grid.nodata_fraction)
+
+    year = cfg.year
+    for prefix, members in prefixes.items():
+        layers = sorted({layer for _, layer in members})
+        for temporal_freq in ("yearly", "monthly"):
+            if temporal_freq == "yearly":
+                names = [f"{prefix}.{year}001-{year}366.nc"]
+            else:
+                names = [f"{prefix}.{year}-{year}-{m}.nc" for m in month_abbrs]
+
+            first_dir = None
+            for component, _ in members:
+                component_dir = pathlib.Path(f"data/input/pm25_components__randall/{temporal_freq}/{component}")
+                os.makedirs(component_dir, exist_ok=True)
+                if first_dir is not None:
+                    # components sharing a file prefix get a copy of the same files, as downloaded
+                    for name in names:
+                        shutil.copy(first_dir / name, component_dir / name)
+                    continue
+                first_dir = component_dir
+                for name in names:
+                    data = {}
+                    for layer in layers:
+                        values = field * rng.uniform(0.5, 2.0) + rng.random(field.shape, dtype="float32")
+                        values[:nodata_rows] = np.nan
+                        data[layer] = ((cfg.satellite_component.latitude_layer, cfg.satellite_component.longitude_layer), values)
+                    coords = {cfg.satellite_component.latitude_layer: lat, cfg.satellite_component.longitude_layer: lon}
+                    xarray.Dataset(data, coords=coords).to_netcdf(component_dir / name)
+
+
+def voronoi_polygons(rng, n_polygons, extent):
+    """
+    Voronoi tessellation of an extent (with lon/lat_min/max) from uniform random points (a partition, as
+    census geographies)
+    """
+    lon_min, lon_max, lat_min, lat_max = extent.lon_min, extent.lon_max, extent.lat_min, extent.lat_max
+    extent = shapely.box(lon_min, lat_min, lon_max, lat_max)
+    points = shapely.points(rng.uniform(lon_min, lon_max, n_polygons), rng.uniform(lat_min, lat_max, n_polygons))
+    cells = shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(points), extend_to=extent))
+    return shapely.intersection(cells, extent)
+
+
+def write_polygon_layers(cfg, rng):
+    """
+    Write a voronoi tessellation of the grid extent for each geography, named and with the idvar of
+    the shapefile vintage used for cfg.year
+    """
+    layers = {}
+    for polygon_name, n_polygons in cfg.geographies.items():
+        shapefile_year = available_shapefile_year(cfg.year, list(cfg.shapefiles[polygon_name].keys()))
+        idvar = cfg.shapefiles[polygon_name][shapefile_year].idvar
+        cells = voronoi_polygons(rng, n_polygons, cfg.grid)
+
+        polygon = gpd.GeoDataFrame(
+            {idvar: [f"{i:07d}" for i in range(len(cells))]}, geometry=cells, crs="EPSG:4269"
+        )
+        shape_dir = f"data/input/shapefiles/shapefile_{polygon_name}_{shapefile_year}"
+        os.makedirs(shape_dir, exist_ok=True)
+        polygon.to_file(f"{shape_dir}/shapefile.shp")
+        layers[polygon_name] = polygon
+
+    return layers
+
+
+# == timing helpers
+
+def time_in_process(fn, repeats=1):
+    """
+    Median wall time and cpu time of an in-process call, and its peak traced memory measured in a separate
+    call (tracing the allocations slows down the call)
+    """
+    walls, cpus = [], []
+    result = None
+    for _ in range(repeats):
+        t0, c0 = time.perf_counter(), time.process_time()
+        result = fn()
+        walls.append(time.perf_counter() - t0)
+        cpus.append(time.process_time() - c0)
+
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    stats = {
+        "wall_time_s": float(np.median(walls)),
+        "cpu_time_s": float(np.median(cpus)),
+        "peak_memory_mb": peak / 2**20,
+    }
+    return result, stats
+
+
+def peak_rss_mb(pid):
+    """
+    High water mark of the resident memory of a running process, None if not available (non linux)
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2**10
+    except (FileNotFoundError, ProcessLookupError):
+        pass
+    return None
+
+
+def time_job(script, overrides, log_path):
+    """
+    Wall time, cpu time and peak RSS of a pipeline script run as a separate process (as in the Snakefile).
+    The peak RSS is sampled from /proc while the job runs since the rusage of a child also counts the
+    memory of the parent at fork time.
+    """
+    env = dict(os.environ, PYTHONPATH=str(REPO_DIR))
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    peak = None
+    with open(log_path, "w") as log:
+        t0 = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, str(REPO_DIR / script), *overrides], env=env, stdout=log, stderr=log)
+        while True:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                break
+            peak = peak_rss_mb(proc.pid) or peak
+            time.sleep(0.02)
+        wall = time.perf_counter() - t0
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+    if proc.returncode != 0:
+        raise RuntimeError(f"{script} {overrides} failed, see {log_path}")
+
+    return {"wall_time_s": wall, "cpu_time_s": rusage.ru_utime + rusage.ru_stime, "peak_memory_mb": peak}
+
+
+# == baseline comparison
+
+def compare_to_baseline(results, baseline, threshold):
+    """
+    Returns the list of (name, metric, baseline, current) of the stages slower or larger than threshold x baseline
+    """
+    previous = {r["name"]: r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        if r["name"] not in previous:
+            continue
+        for metric in ("wall_time_s", "peak_memory_mb"):
+            before, now = previous[r["name"]][metric], r[metric]
+            if before is None or now is None:
+                continue
+            ratio = now / before if before > 0 else 1.0
+            LOGGER.info(f"{r['name']:<40} {metric:<15} {before:10.3f} -> {now:10.3f} ({ratio:5.2f}x)")
+            if ratio > threshold:
+                regressions.append((r["name"], metric, before, now))
+    return regressions
+
+
+@hydra.main(config_path="../conf", config_name="benchmark", version_base=None)
+def main(cfg):
+    """
+    Benchmark mapping construction, per-file reduction, full aggregation jobs and merging on synthetic data.
+    """
+    rng = np.random.default_rng(cfg.seed)
+    original_cwd = get_original_cwd()
+    output_path = os.path.join(original_cwd, cfg.output)
+    baseline_path = os.path.join(original_cwd, cfg.baseline)
+
+    # == generate synthetic inputs in a clean workdir
+    workdir = pathlib.Path(original_cwd) / cfg.workdir
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+    os.chdir(workdir)
+
+    LOGGER.info(f"Generating synthetic inputs in {workdir}")
+    lat, lon = make_grid(cfg)
+    write_component_files(cfg, rng, lat, lon)
+    layers = write_polygon_layers(cfg, rng)
+
+    results = []
+
+    def record(name, stats, **extra):
+        stats = dict(name=name, **stats, **extra)
+        LOGGER.info(f"{name}: {stats}")
+        results.append(stats)
+
+    # a raster in the orientation used by the pipeline
+    component_cfg = cfg.satellite_component.component[cfg.component]
+    sample = next(pathlib.Path(f"data/input/pm25_components__randall/yearly/{cfg.component}").glob("*.nc"))
+    raster = xarray.open_dataset(sample)[component_cfg.layer].values[::-1]
+    transform = rasterio.transform.from_origin(lon[0], lat[-1], lon[1] - lon[0], lat[1] - lat[0])
+
+    for polygon_name, polygon in layers.items():
+        counts = dict(n_polygons=len(polygon), n_cells=int(raster.size))
+
+        # == mapping construction
+        cells, stats = time_in_process(
+            lambda: polygon_to_raster_cells(polygon, raster, affine=transform, all_touched=True, nodata=np.nan)
+        )
+        record(f"mapping_feature_{polygon_name}", stats, **counts)
+
+        _, stats = time_in_process(
+            lambda: polygon_to_raster_cells_layer(polygon, raster, affine=transform, all_touched=True, nodata=np.nan)
+        )
+        record(f"mapping_layer_{polygon_name}", stats, **counts)
+
+        # == per-file reduction with a precomputed mapping
+        offsets, flat = cells_to_csr(cells, raster.shape)
+        _, stats = time_in_process(lambda: zonal_means(raster, offsets, flat), repeats=cfg.reduction_repeats)
+        record(f"reduction_{polygon_name}", stats, n_mapped_cells=int(len(flat)), **counts)
+
+        # == full jobs, with a cold and a warm mapping cache
+        for temporal_freq in ("yearly", "monthly"):
+            overrides = [
+                f"polygon_name={polygon_name}", f"++temporal_freq={temporal_freq}",
+                f"++year={cfg.year}", f"++component={cfg.component}",
+            ]
+            shutil.rmtree("data/intermediate/mapping_cache", ignore_errors=True)
+            for cache in ("cold", "warm"):
+                name = f"job_{temporal_freq}_{polygon_name}_{cache}"
+                record(name, time_job("src/aggregate_components.py", overrides, f"logs/{name}.log"), **counts)
+
+            # all the components at once, then the merge of the intermediates
+            overrides = [f"polygon_name={polygon_name}", f"++temporal_freq={temporal_freq}", f"++year={cfg.year}"]
+            name = f"job_all_components_{temporal_freq}_{polygon_name}"
+            record(name, time_job("src/aggregate_all_components.py", [*overrides, "++write_merged=false"], f"logs/{name}.log"), **counts)
+            name = f"merge_{temporal_freq}_{polygon_name}"
+            record(name, time_job("src/merge_components.py", overrides, f"logs/{name}.log"), **counts)
+
+    # == layer mapping at the scale of the census tracts: one rasterize per color of the greedy coloring of
+    # the feature windows, on a grid of the size of the component files (in memory, no job is run)
+    if cfg.tract_scale.enabled:
+        extent = cfg.tract_scale.extent
+        res = cfg.grid.resolution
+        shape = (round((extent.lat_max - extent.lat_min) / res), round((extent.lon_max - extent.lon_min) / res))
+        tract_raster = np.zeros(shape, dtype="float32")
+        tract_transform = rasterio.transform.from_origin(extent.lon_min, extent.lat_max, res, res)
+        polygons = list(voronoi_polygons(rng, cfg.tract_scale.n_polygons, extent))
+        counts = dict(n_polygons=len(polygons), n_cells=int(tract_raster.size))
+
+        windows = bounds_windows(shapely.bounds(polygons), tract_transform)
+        colors, stats = time_in_process(lambda: color_windows(windows))
+        record("coloring_tract_scale", stats, n_colors=int(colors.max()) + 1, **counts)
+        _, stats = time_in_process(
+            lambda: polygon_to_raster_cells_layer(
+                polygons, tract_raster, affine=tract_transform, all_touched=True, nodata=np.nan, windows=windows
+            )
+        )
+        record("mapping_layer_tract_scale", stats, **counts)
+
+    # == write results and compare against the baseline
+    report = {
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": {
+            "grid": dict(cfg.grid),
+            "geographies": dict(cfg.geographies),
+            "year": cfg.year,
+            "component": cfg.component,
+            "tract_scale": dict(cfg.tract_scale, extent=dict(cfg.tract_scale.extent)),
+        },
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump(report, f, indent=1)
+    LOGGER.info(f"Wrote benchmark results to {output_path}")
+
+    if not os.path.exists(baseline_path):
+        LOGGER.info(f"No baseline found at {baseline_path}, copy {output_path} there to create one.")
+        return
+
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    if baseline.get("config") != report["config"]:
+        LOGGER.warning("Baseline was recorded with a different benchmark config, ratios are not comparable.")
+
+    regressions = compare_to_baseline(results, baseline, cfg.regression_threshold)
+    for name, metric, before, now in regressions:
+        LOGGER.warning(f"Regression in {name} {metric}: {before:.3f} -> {now:.3f}")
+
+    if regressions and cfg.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
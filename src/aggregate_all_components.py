@@ -0,0 +1,197 @@
+import xarray
+import pandas as pd
+import pyarrow as pa
+import hydra
+import logging
+import pathlib
+
+from utils.faster_zonal_stats import validate_stats, zonal_statistics
+from utils.instrumentation import stage
+from utils.component_files import available_shapefile_year, list_component_files, manifest_path
+from utils.fingerprints import (
+    combine_digests,
+    config_digest,
+    file_digests,
+    plan_outputs,
+    save_record,
+    slice_key,
+)
+from src.aggregate_components import (
+    component_output_path,
+    get_polygon_mapping,
+    long_format,
+    open_zarr_cube,
+    output_config_digest,
+    polygon_window,
+    rollup_sums,
+    save_component_output,
+    shapefile_digest,
+    upsert_slices,
+)
+from src.merge_components import merge_component_tables, merged_output_path, save_merged_output
+
+
+# configure logger to print at info level
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+def group_components_by_file(cfg, components):
+    """
+    Group the components that are read from the same files (e.g. om and om_h2o are two layers of the same file)
+    """
+    groups = {}
+    for component in components:
+        file_prefix = cfg.satellite_component.component[component].file_prefix
+        groups.setdefault(file_prefix, []).append(component)
+    return list(groups.values())
+
+
+def aggregate_file_group(cfg, components, files, year):
+    """
+    Aggregate all the layers of a group of components, opening each file only once.
+    Returns a dict with a long format dataframe per component.
+    """
+    shapefile_years_list = list(cfg.shapefiles[cfg.polygon_name].keys())
+    shapefile_year = available_shapefile_year(year, shapefile_years_list)
+
+    mappings = {}
+    component_data = {component: [] for component in components}
+
+    # each component has its own zarr store, of which only the tiles covering the polygons are read
+    cubes = {component: open_zarr_cube(cfg, component, files) for component in components} if cfg.zarr.enabled else {}
+
+    for i, (file_year, month, filename) in enumerate(files):
+        LOGGER.info(f"Aggregating {filename} for {components} as {cfg.temporal_freq} for year {file_year} month {month if cfg.temporal_freq == 'monthly' else 'N/A'}")
+        ds = None
+        if not cfg.zarr.enabled:
+            with stage("open_dataset"):
+                ds = xarray.open_dataset(filename)
+
+        try:
+            for component in components:
+                if cfg.zarr.enabled:
+                    layer = cubes[component].isel(time=i)
+                else:
+                    layer = getattr(ds, cfg.satellite_component.component[component].layer)
+
+                # == window and mapping computed from the first file of each component (shared when the grids match)
+                if component not in mappings:
+                    window, transform = polygon_window(cfg, shapefile_year, layer)
+                    with stage("read_raster"):
+                        raster = layer.isel(window).values[::-1]
+                    mappings[component] = window, get_polygon_mapping(cfg, shapefile_year, raster, transform)
+                else:
+                    with stage("read_raster"):
+                        raster = layer.isel(mappings[component][0]).values[::-1]
+                offsets, flat, polygon_ids, weights = mappings[component][1]
+
+                stats = zonal_statistics(raster, offsets, flat, cfg.stats, weights)
+                if cfg.rollup.enabled:
+                    stats.update(rollup_sums(cfg, raster, offsets, flat, polygon_ids, weights))
+                component_data[component].append(
+                    long_format(cfg, component, stats, polygon_ids, [file_year], [month])
+                )
+        finally:
+            if ds is not None:
+                ds.close()
+
+    return {
+        component: pd.concat(dfs, ignore_index=True)
+        for component, dfs in component_data.items() if dfs
+    }
+
+
+@hydra.main(config_path="../conf", config_name="config", version_base=None)
+def main(cfg):
+    # get aggregation defaults
+    components = list(cfg.components) if cfg.get("components") else list(cfg.satellite_component.component.keys())
+    years = list(cfg.years) if cfg.get("years") else [cfg.year]
+    LOGGER.info(f"Running aggregation for: {components} {cfg.temporal_freq} {cfg.polygon_name} {years}")
+    validate_stats(cfg.stats)
+
+    if not (cfg.write_intermediate or cfg.write_merged):
+        raise ValueError("At least one of write_intermediate and write_merged must be true.")
+
+    groups = group_components_by_file(cfg, components)
+
+    for year in years:
+        group_files = []
+
+        for group in groups:
+            # == filenames to be aggregated for this group, taken from the first component directory with files
+            files = []
+            for component in group:
+                component_path = pathlib.Path(f"data/input/pm25_components__randall/{cfg.temporal_freq}/{component}/")
+                if component_path.exists():
+                    manifest = manifest_path(cfg.temporal_freq, component)
+                    files = list_component_files(component_path, cfg.temporal_freq, [year], manifest=manifest)
+                if files:
+                    break
+
+            if not files:
+                raise FileNotFoundError(f"No files found for components {group} year {year}.")
+            group_files.append((files, manifest))
+
+        # == incremental mode: only aggregate the slices whose input files changed since the outputs were written
+        if cfg.incremental.enabled:
+            outputs = []
+            group_slices = [file_digests(files, manifest=manifest) for files, manifest in group_files]
+            if cfg.write_intermediate:
+                for group, slices in zip(groups, group_slices):
+                    outputs += [
+                        (component_output_path(cfg, c, year), output_config_digest(cfg, c), slices) for c in group
+                    ]
+            if cfg.write_merged:
+                keys = sorted(set().union(*group_slices))
+                merged_slices = {k: combine_digests([slices.get(k, "") for slices in group_slices]) for k in keys}
+                merged_config = config_digest(*[output_config_digest(cfg, c) for c in components])
+                outputs.append((merged_output_path(cfg, year), merged_config, merged_slices))
+
+            recompute, drops = plan_outputs(outputs, shapefile_digest(cfg, year))
+            if recompute is not None:
+                group_files = [
+                    ([f for f in files if slice_key(f[0], f[1]) in recompute], manifest)
+                    for files, manifest in group_files
+                ]
+                if not any(drops.values()):
+                    LOGGER.info(f"Outputs of year {year} are up to date.")
+                    continue
+            LOGGER.info(f"Incremental mode: aggregating {'all' if recompute is None else sorted(recompute)} slices.")
+
+        component_dfs = {}
+        for group, (files, _) in zip(groups, group_files):
+            if files:
+                component_dfs.update(aggregate_file_group(cfg, group, files, year))
+
+        if cfg.write_intermediate:
+            for component in components:
+                path = component_output_path(cfg, component, year)
+                final_df = component_dfs.get(component)
+                if cfg.incremental.enabled and recompute is not None:
+                    final_df = upsert_slices(cfg, path, final_df, drops[path])
+                save_component_output(cfg, component, year, final_df)
+
+        if cfg.write_merged:
+            path = merged_output_path(cfg, year)
+            with stage("merge", n_components=len(components)):
+                if component_dfs:
+                    final_table = merge_component_tables(
+                        [pa.Table.from_pandas(component_dfs[c], preserve_index=False) for c in components],
+                        components,
+                        cfg.polygon_name,
+                        cfg.temporal_freq,
+                    )
+                if cfg.incremental.enabled and recompute is not None:
+                    final_df = upsert_slices(cfg, path, final_table.to_pandas() if component_dfs else None, drops[path])
+                    final_table = pa.Table.from_pandas(final_df, preserve_index=False)
+            save_merged_output(cfg, year, final_table)
+
+        if cfg.incremental.enabled:
+            shapefile = shapefile_digest(cfg, year)
+            for path, config, slices in outputs:
+                save_record(path, config, shapefile, slices)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import pandas as pd
+import hydra
+import logging
+import itertools
+import os
+import time
+
+from omegaconf import OmegaConf
+from src import aggregate_components
+from src.aggregate_components import aggregate_component
+
+
+# configure logger to print at info level
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+item_columns = ["component", "temporal_freq", "year", "polygon_name"]
+
+
+def work_items(cfg):
+    """
+    List of work items (dicts with component, temporal_freq, year, polygon_name), read from cfg.batch.items_file
+    or built from all the combinations of the cfg.batch lists
+    """
+    if cfg.batch.items_file is not None:
+        df = pd.read_csv(cfg.batch.items_file, dtype={"year": int})
+        missing = set(item_columns) - set(df.columns)
+        if missing:
+            raise ValueError(f"Work items file {cfg.batch.items_file} is missing columns {sorted(missing)}.")
+        items = df[item_columns].to_dict("records")
+    else:
+        items = [
+            dict(zip(item_columns, values))
+            for values in itertools.product(
+                cfg.batch.components or [cfg.component],
+                cfg.batch.temporal_freqs or [cfg.temporal_freq],
+                cfg.batch.years or [cfg.year],
+                cfg.batch.polygon_names or [cfg.polygon_name],
+            )
+        ]
+
+    # consecutive items share the same files (all the polygons of a component year) and mappings
+    return sorted(items, key=lambda item: (item["temporal_freq"], int(item["year"]), item["component"], item["polygon_name"]))
+
+
+def item_log_path(cfg, item):
+    """
+    Log file of a work item, named as the log of the Snakefile aggregation job
+    """
+    return os.path.join(
+        cfg.batch.log_dir,
+        f"aggregate_{item['component']}_{item['polygon_name']}_{item['temporal_freq']}_{item['year']}.log",
+    )
+
+
+@hydra.main(config_path="../conf", config_name="config", version_base=None)
+def main(cfg):
+    """
+    Aggregate a batch of work items in a single process. Shapefiles, mappings and open datasets are
+    kept in memory across the items, and each item writes the same outputs and log as aggregate_components.py.
+    """
+    items = work_items(cfg)
+    LOGGER.info(f"Running {len(items)} work items.")
+    aggregate_components.MAX_OPEN_DATASETS = cfg.batch.max_open_datasets
+
+    formatter = logging.Formatter("[%(asctime)s][%(name)s][%(levelname)s] - %(message)s")
+    os.makedirs(cfg.batch.log_dir, exist_ok=True)
+
+    failed = []
+    for i, item in enumerate(items):
+        item_cfg = OmegaConf.merge(cfg, {**item, "year": int(item["year"]), "years": None})
+
+        # the messages of the item also go to its own log file
+        handler = logging.FileHandler(item_log_path(cfg, item), mode="w")
+        handler.setFormatter(formatter)
+        logging.getLogger().addHandler(handler)
+
+        t0 = time.perf_counter()
+        try:
+            if not aggregate_component(item_cfg):
+                failed.append(item)
+        except Exception:
+            LOGGER.exception(f"Work item {item} failed.")
+            failed.append(item)
+        finally:
+            logging.getLogger().removeHandler(handler)
+            handler.close()
+
+        LOGGER.info(f"[{i + 1}/{len(items)}] {item} done in {time.perf_counter() - t0:.2f}s.")
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(items)} work items failed: {failed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,170 +1,846 @@
 import xarray
 import rasterio
 import pandas as pd
+import pyarrow as pa
 import geopandas as gpd
 import numpy as np
+import shapely
 import hydra
-import logging  
+import logging
 import pathlib
 import os
-import re
+import struct
+from collections import OrderedDict
 
-from hydra.core.hydra_config import HydraConfig
-from utils.faster_zonal_stats import polygon_to_raster_cells
+from affine import Affine
+from rasterstats.io import bounds_window
+from utils.component_files import (
+    available_shapefile_year,
+    list_component_files,
+    manifest_path,
+    zarr_store_path,
+)
+from utils.faster_zonal_stats import (
+    bounds_windows,
+    cell_ownership,
+    polygon_cell_coverage,
+    polygon_to_raster_cells_layer,
+    polygon_to_raster_cells_parallel,
+    validate_stats,
+    zonal_statistics,
+    zonal_sums_counts,
+)
+from utils.fingerprints import config_digest, file_digests, plan_outputs, save_record, slice_key
+from utils.instrumentation import current_rss_mb, stage, write_metrics
+from utils.mapping_cache import (
+    cells_to_csr,
+    find_cached_cells,
+    hash_geometries,
+    hash_nodata_mask,
+    hash_shapefile,
+    load_mapping,
+    load_weights,
+    mapping_cache_key,
+    save_mapping,
+    save_weights,
+)
+from utils.output_paths import component_output_file
+from utils.shapefile_cache import (
+    feature_windows,
+    preprocessed_path,
+    read_bounds,
+    read_preprocessed,
+    shapefile_crs,
+    to_raster_crs,
+)
+from utils.output_writer import StreamingWriter, compact_table, read_output, write_table
+from src.merge_components import key_columns
 
 
 # configure logger to print at info level
 logging.basicConfig(level=logging.INFO)
 LOGGER = logging.getLogger(__name__)
 
-# mapping for month abbreviations to numbers
-month_map = {
-    "JAN": "01", "FEB": "02", "MAR": "03", "APR": "04",
-    "MAY": "05", "JUN": "06", "JUL": "07", "AUG": "08",
-    "SEP": "09", "OCT": "10", "NOV": "11", "DEC": "12"
-}
+def grid_transform(layer, cfg):
+    """
+    Affine transform of a 2d netcdf layer (rows flipped so that the first row is the northernmost)
+    """
+    dims = layer.dims
+    assert len(dims) == 2, "netcdf coordinates must be 2d"
+    lon = layer[cfg.satellite_component.longitude_layer].values
+    lat = layer[cfg.satellite_component.latitude_layer].values
+    return rasterio.transform.from_origin(
+        lon[0], lat[-1], lon[1] - lon[0], lat[1] - lat[0]
+    )
+
 
+def shapefile_path(cfg, shapefile_year):
+    return f'data/input/shapefiles/shapefile_{cfg.polygon_name}_{shapefile_year}/shapefile.shp'
 
-def available_shapefile_year(year, shapefile_years_list: list):
+
+def shapefile_bounds(shape_path):
     """
-    Given a list of shapefile years,
-    return the latest year in the shapefile_years_list that is less than or equal to the given year
+    Bounding box (xmin, ymin, xmax, ymax) of all the shapes, read from the .shp file header
     """
-    for shapefile_year in sorted(shapefile_years_list, reverse=True):
-        if year >= shapefile_year:
-            return shapefile_year
- 
-    return min(shapefile_years_list)  # Returns the last element if year is greater than the last element
+    with open(shape_path, "rb") as f:
+        header = f.read(100)
+    return struct.unpack("<4d", header[36:68])
 
 
-@hydra.main(config_path="../conf", config_name="config", version_base=None)
-def main(cfg):
-    # get aggregation defaults
-    LOGGER.info(f"Running aggregation for: {cfg.component} {cfg.temporal_freq} {cfg.polygon_name} {cfg.year}")
-    logging_dir = HydraConfig.get().runtime.output_dir
+def polygon_bounds(cfg, shapefile_year):
+    """
+    Bounding box of the polygons in the crs of the rasters (cfg.shapefile_cache.crs): read from the .shp
+    header when the polygons are not reprojected, otherwise from the bounds columns of the preprocessed
+    file, or from the reprojected polygons
+    """
+    shape_path = shapefile_path(cfg, shapefile_year)
+    crs = cfg.shapefile_cache.crs
+    if cfg.shapefile_cache.enabled:
+        bounds = read_bounds(preprocessed_path(shape_path), shapefile_hash(shape_path), crs)
+        if bounds is not None:
+            return bounds
 
-    # == load shapefile
-    LOGGER.info("Loading shapefile.")
-    shapefile_years_list = list(cfg.shapefiles[cfg.polygon_name].keys())
-    shapefile_year = available_shapefile_year(cfg.year, shapefile_years_list)
+    source_crs = shapefile_crs(shape_path)
+    if crs is None or source_crs is None or source_crs == crs:
+        return shapefile_bounds(shape_path)
+    return tuple(load_shapefile(cfg, shape_path).total_bounds)
 
-    shape_path = f'data/input/shapefiles/shapefile_{cfg.polygon_name}_{shapefile_year}/shapefile.shp'
-    polygon = gpd.read_file(shape_path)
-    polygon_ids = polygon[cfg.shapefiles[cfg.polygon_name][shapefile_year].idvar].values
 
-    # == filenames to be aggregated for this component
-    component_path = pathlib.Path(f"data/input/pm25_components__randall/{cfg.temporal_freq}/{cfg.component}/")
-    if not component_path.exists():
-        LOGGER.error(f"Component path {component_path} does not exist.")
-        return
+def grid_window(cfg, layer, bounds):
+    """
+    Window (row_start, row_stop, col_start, col_stop) of the full grid of the layer covering
+    bounds (xmin, ymin, xmax, ymax) plus cfg.window.buffer cells, clipped to the grid
+    """
+    lat_dim = cfg.satellite_component.latitude_layer
+    lon_dim = cfg.satellite_component.longitude_layer
+    transform = grid_transform(layer.isel({d: 0 for d in layer.dims if d not in (lat_dim, lon_dim)}), cfg)
 
-    filenames = component_path.glob("*.nc")
-    filenames = [str(f) for f in filenames if f.is_file()]
+    n_rows, n_cols = layer.sizes[lat_dim], layer.sizes[lon_dim]
+    (row_start, row_stop), (col_start, col_stop) = bounds_window(bounds, transform)
+    row_start = min(max(row_start - cfg.window.buffer, 0), n_rows)
+    row_stop = min(max(row_stop + cfg.window.buffer, row_start), n_rows)
+    col_start = min(max(col_start - cfg.window.buffer, 0), n_cols)
+    col_stop = min(max(col_stop + cfg.window.buffer, col_start), n_cols)
+    return row_start, row_stop, col_start, col_stop
 
-    if not filenames:
-        LOGGER.error(f"No files found for component {cfg.component}.")
-        return
 
-    # == compute mapping from vector geometries to raster cells (only once per component)
-    LOGGER.info(f"Mapping polygons to raster cells for {cfg.component}.")
+def window_indexers(cfg, layer, window):
+    """
+    Returns the isel indexers of a window (row_start, row_stop, col_start, col_stop) of the full grid
+    of the layer and the affine transform of the (row flipped) window
+    """
+    lat_dim = cfg.satellite_component.latitude_layer
+    lon_dim = cfg.satellite_component.longitude_layer
+    transform = grid_transform(layer.isel({d: 0 for d in layer.dims if d not in (lat_dim, lon_dim)}), cfg)
 
-    ds = xarray.open_dataset(filenames[0])
-    layer = getattr(ds, cfg.satellite_component.component[cfg.component].layer)
+    n_rows = layer.sizes[lat_dim]
+    row_start, row_stop, col_start, col_stop = window
+    # rows are flipped with respect to the latitude dimension
+    indexers = {
+        lat_dim: slice(n_rows - row_stop, n_rows - row_start),
+        lon_dim: slice(col_start, col_stop),
+    }
+    return indexers, transform * Affine.translation(col_start, row_start)
 
-    # obtain affine transform/boundaries
-    dims = layer.dims
-    assert len(dims) == 2, "netcdf coordinates must be 2d"
-    lon = layer[cfg.satellite_component.longitude_layer].values
-    lat = layer[cfg.satellite_component.latitude_layer].values
-    transform = rasterio.transform.from_origin(
-        lon[0], lat[-1], lon[1] - lon[0], lat[1] - lat[0]
+
+def polygon_window(cfg, shapefile_year, layer):
+    """
+    Returns the isel indexers of the layer window covering the polygons (plus cfg.window.buffer cells)
+    and the affine transform of the (row flipped) window.
+    The full grid is returned when cfg.window.enabled is false.
+    """
+    lat_dim = cfg.satellite_component.latitude_layer
+    lon_dim = cfg.satellite_component.longitude_layer
+    transform = grid_transform(layer.isel({d: 0 for d in layer.dims if d not in (lat_dim, lon_dim)}), cfg)
+
+    if not cfg.window.enabled:
+        return {}, transform
+
+    window = grid_window(cfg, layer, polygon_bounds(cfg, shapefile_year))
+    row_start, row_stop, col_start, col_stop = window
+    LOGGER.info(
+        f"Raster window rows {row_start}:{row_stop} cols {col_start}:{col_stop} "
+        f"of {layer.sizes[lat_dim]}x{layer.sizes[lon_dim]}."
     )
+    return window_indexers(cfg, layer, window)
+
+
+# in-process caches, shared by all the aggregations done in the same job
+_shapefiles = {}
+_shapefile_metadata = {}
+_shapefile_hashes = {}
+_mappings = {}
+_weights = {}
+_ownership = {}
+_datasets = OrderedDict()
+
+# number of files kept open by open_component_dataset (e.g. when a batch aggregates a file into several polygons)
+MAX_OPEN_DATASETS = 32
+
+
+def open_component_dataset(filename):
+    """
+    Open a netcdf file, reusing the datasets opened by the previous aggregations of the process
+    """
+    if filename in _datasets:
+        _datasets.move_to_end(filename)
+        return _datasets[filename]
+
+    with stage("open_dataset"):
+        _datasets[filename] = xarray.open_dataset(filename)
+    while len(_datasets) > MAX_OPEN_DATASETS:
+        _, ds = _datasets.popitem(last=False)
+        ds.close()
+    return _datasets[filename]
+
+
+def shapefile_hash(shape_path):
+    """
+    Content hash of a shapefile, computed once per process
+    """
+    if shape_path not in _shapefile_hashes:
+        _shapefile_hashes[shape_path] = hash_shapefile(shape_path)
+    return _shapefile_hashes[shape_path]
+
+
+def load_shapefile(cfg, shape_path):
+    """
+    Read a shapefile once per process, in the crs of the rasters. The preprocessed geoparquet copy
+    (src/convert_shapefile.py) is read instead when it exists and was made from the same shapefile.
+    """
+    if shape_path not in _shapefiles:
+        with stage("read_shapefile") as counts:
+            cached = None
+            if cfg.shapefile_cache.enabled:
+                cached = read_preprocessed(
+                    preprocessed_path(shape_path), shapefile_hash(shape_path), cfg.shapefile_cache.crs
+                )
+            if cached is not None:
+                LOGGER.info(f"Loading preprocessed shapefile {preprocessed_path(shape_path)}.")
+                polygon, _shapefile_metadata[shape_path] = cached
+            else:
+                LOGGER.info(f"Loading shapefile {shape_path}.")
+                polygon, _shapefile_metadata[shape_path] = gpd.read_file(shape_path), None
+            _shapefiles[shape_path] = to_raster_crs(polygon, cfg.shapefile_cache.crs)
+            counts["n_polygons"] = len(polygon)
+    return _shapefiles[shape_path]
+
 
-    # compute mapping
-    poly2cells = polygon_to_raster_cells(
-        polygon,
-        layer.values[::-1],
-        affine=transform,
-        all_touched=True,
-        nodata=np.nan,
-        verbose=cfg.show_progress,
+def polygon_mapping_key(cfg, shapefile_year, transform, shape, raster=None):
+    """
+    Key of the mapping of a shapefile in the cache, the mapping only depends on the shapefile and the grid
+    (transform, shape and nodata mask of the raster). Without raster, key of the grid without the nodata
+    mask, under which the mappings of the shapefile for that grid are indexed.
+    """
+    shape_path = shapefile_path(cfg, shapefile_year)
+    with stage("mapping_cache_key"):
+        return mapping_cache_key(
+            shapefile_hash(shape_path),
+            cfg.shapefiles[cfg.polygon_name][shapefile_year].idvar,
+            transform,
+            shape,
+            all_touched=True,
+            nodata_hash=hash_nodata_mask(raster) if raster is not None else None,
+            crs=cfg.shapefile_cache.crs,
+        )
+
+
+def get_polygon_mapping(cfg, shapefile_year, raster, transform):
+    """
+    Returns the CSR mapping (offsets, flat) from polygons to raster cells, the polygon ids and
+    the cell weights (None for binary weighting), loading them from memory or from the mapping
+    cache when possible
+    """
+    if cfg.weighting not in ("binary", "area"):
+        raise ValueError(f"Unknown weighting {cfg.weighting}, must be binary or area.")
+
+    shape_path = shapefile_path(cfg, shapefile_year)
+    idvar = cfg.shapefiles[cfg.polygon_name][shapefile_year].idvar
+    cache_key = polygon_mapping_key(cfg, shapefile_year, transform, raster.shape, raster)
+
+    if cache_key not in _mappings:
+        # look up the mapping in the cache
+        with stage("load_mapping_cache"):
+            cached = load_mapping(cfg.mapping_cache.dir, cache_key) if cfg.mapping_cache.enabled else None
+        if cached is not None:
+            LOGGER.info(f"Loaded cached mapping {cache_key} from {cfg.mapping_cache.dir}.")
+            offsets, flat, _, polygon_ids = cached
+        else:
+            polygon = load_shapefile(cfg, shape_path)
+            polygon_ids = polygon[idvar].values
+            windows = feature_windows(polygon, _shapefile_metadata[shape_path], transform, raster.shape)
+            if windows is None:
+                windows = bounds_windows(shapely.bounds(polygon.geometry.values), transform)
+            nodata_mask = np.isnan(raster)
+
+            # == cells of the polygons that did not change since a cached mapping of the same grid (e.g. the
+            # counties of the previous vintage), only the new and changed polygons are rasterized
+            poly2cells = [None] * len(polygon)
+            with stage("reuse_cached_cells") as counts:
+                geometry_hashes = hash_geometries(polygon.geometry.values)
+                if cfg.mapping_cache.enabled and cfg.mapping_cache.reuse_polygons:
+                    is_polygon = np.isin(shapely.get_type_id(polygon.geometry.values), (3, 6))
+                    found = find_cached_cells(
+                        cfg.mapping_cache.dir,
+                        np.where(is_polygon, geometry_hashes, ""),
+                        windows,
+                        transform,
+                        nodata_mask,
+                        all_touched=True,
+                    )
+                    for i, indices in found.items():
+                        poly2cells[i] = indices
+                    counts["n_polygons"] = len(found)
+            todo = np.array([i for i, indices in enumerate(poly2cells) if indices is None], dtype=np.int64)
+            if len(todo) < len(polygon):
+                LOGGER.info(f"Reused the cells of {len(polygon) - len(todo)} of {len(polygon)} polygons from cached mappings.")
+
+            # compute mapping
+            with stage(f"mapping_{cfg.mapping_backend}", n_polygons=len(todo), n_cells=raster.size):
+                if len(todo) == 0:
+                    todo_cells = []
+                elif cfg.mapping_backend == "layer":
+                    todo_cells = polygon_to_raster_cells_layer(
+                        polygon.iloc[todo],
+                        raster,
+                        affine=transform,
+                        all_touched=True,
+                        nodata=np.nan,
+                        verbose=cfg.show_progress,
+                        windows=windows[todo],
+                    )
+                elif cfg.mapping_backend == "feature":
+                    todo_cells = polygon_to_raster_cells_parallel(
+                        polygon.iloc[todo],
+                        raster,
+                        affine=transform,
+                        all_touched=True,
+                        nodata=np.nan,
+                        n_jobs=cfg.mapping_workers,
+                        chunk_size=cfg.mapping_chunk_size,
+                        verbose=cfg.show_progress,
+                        windows=windows[todo],
+                    )
+                else:
+                    raise ValueError(f"Unknown mapping_backend {cfg.mapping_backend}, must be feature or layer.")
+            for i, indices in zip(todo, todo_cells):
+                poly2cells[i] = indices
+
+            offsets, flat = cells_to_csr(poly2cells, raster.shape)
+            if cfg.mapping_cache.enabled:
+                path = save_mapping(
+                    cfg.mapping_cache.dir,
+                    cache_key,
+                    offsets,
+                    flat,
+                    raster.shape,
+                    polygon_ids,
+                    geometry_hashes=geometry_hashes,
+                    affine=transform,
+                    nodata_mask=nodata_mask,
+                    all_touched=True,
+                    grid_key=polygon_mapping_key(cfg, shapefile_year, transform, raster.shape),
+                )
+                LOGGER.info(f"Saved mapping to cache {path}.")
+
+        _mappings[cache_key] = offsets, flat, polygon_ids
+
+    offsets, flat, polygon_ids = _mappings[cache_key]
+
+    # == fraction of each cell covered by its polygon, computed once and cached next to the mapping
+    if cfg.weighting == "area" and cache_key not in _weights:
+        weights = load_weights(cfg.mapping_cache.dir, cache_key, cfg.weighting) if cfg.mapping_cache.enabled else None
+        if weights is not None:
+            LOGGER.info(f"Loaded cached cell weights {cache_key} from {cfg.mapping_cache.dir}.")
+        else:
+            LOGGER.info("Computing cell coverage fractions.")
+            polygon = load_shapefile(cfg, shape_path)
+            weights = polygon_cell_coverage(polygon.geometry.values, offsets, flat, raster.shape, transform)
+            if cfg.mapping_cache.enabled:
+                path = save_weights(cfg.mapping_cache.dir, cache_key, cfg.weighting, weights)
+                LOGGER.info(f"Saved cell weights to cache {path}.")
+        _weights[cache_key] = weights
+
+    return offsets, flat, polygon_ids, _weights.get(cache_key) if cfg.weighting == "area" else None
+
+
+def stat_column(component, stat):
+    """
+    Output column of a statistic, the mean keeps the component name
+    """
+    return component if stat == "mean" else f"{component}_{stat}"
+
+
+def rollup_sums(cfg, raster, offsets, flat, polygon_ids, weights):
+    """
+    Sums and valid cell counts of each polygon for each roll-up level of cfg.rollup.levels (src/rollup_components.py),
+    as sum__<level> and count__<level> statistics. With binary weighting only the cells owned by a polygon within
+    its group of the level (polygons with the same id prefix) are counted, so that a cell shared by neighbours
+    of the same group is counted once. With area weighting the coverage fractions of the polygons of a group
+    add up to the coverage of the group, all the cells are used.
+    """
+    stats = {}
+    for level, prefix_length in cfg.rollup.levels.items():
+        if weights is None:
+            key = (id(flat), prefix_length)
+            if key not in _ownership or _ownership[key][0] is not flat:
+                with stage("cell_ownership", n_polygons=len(polygon_ids), n_cells=len(flat)):
+                    _, groups = np.unique(np.asarray(polygon_ids, dtype=str).astype(f"U{prefix_length}"), return_inverse=True)
+                    _ownership[key] = flat, cell_ownership(offsets, flat, groups).astype(np.float64)
+            level_weights = _ownership[key][1]
+        else:
+            level_weights = weights
+        stats[f"sum__{level}"], stats[f"count__{level}"] = zonal_sums_counts(raster, offsets, flat, level_weights)
+    return stats
+
+
+def long_format(cfg, component, stats, polygon_ids, years, months):
+    """
+    Long format dataframe from a dict of (time, polygon) arrays, one per statistic
+    """
+    n_times, n_polygons = np.atleast_2d(next(iter(stats.values()))).shape
+
+    df_data = {stat_column(component, stat): np.atleast_2d(values).ravel() for stat, values in stats.items()}
+    df_data["year"] = np.repeat(np.asarray(years, dtype=int), n_polygons)
+    df_data[cfg.polygon_name] = np.tile(polygon_ids, n_times)
+
+    if cfg.temporal_freq == "monthly":
+        df_data["month"] = np.repeat(np.asarray(months, dtype=int), n_polygons)
+
+    return pd.DataFrame(df_data)
+
+
+def long_table(cfg, component, stats, polygon_ids, years, months):
+    """
+    Long format arrow table from a dict of (time, polygon) arrays, one per statistic (as long_format)
+    """
+    n_times, n_polygons = np.atleast_2d(next(iter(stats.values()))).shape
+
+    columns = {stat_column(component, stat): np.atleast_2d(values).ravel() for stat, values in stats.items()}
+    columns["year"] = np.repeat(np.asarray(years, dtype=int), n_polygons)
+    # converted through pandas as the dataframes of long_format, so that streamed and in-memory outputs have the
+    # same id type (e.g. large_string for the strings of pandas >= 3)
+    columns[cfg.polygon_name] = pa.array(pd.Series(np.tile(polygon_ids, n_times)))
+
+    if cfg.temporal_freq == "monthly":
+        columns["month"] = np.repeat(np.asarray(months, dtype=int), n_polygons)
+
+    return pa.table(columns)
+
+
+def component_output_path(cfg, component, year):
+    return os.path.abspath(component_output_file(cfg.temporal_freq, component, cfg.polygon_name, year, cfg.output.layout))
+
+
+def save_component_output(cfg, component, year, final_df):
+    """
+    Save individual component output file
+    """
+    output_path = component_output_path(cfg, component, year)
+    keys = key_columns(cfg.polygon_name, cfg.temporal_freq)
+
+    LOGGER.info(f"Saving component output to {output_path}")
+    LOGGER.info(f"Component dataset shape: {final_df.shape}")
+    LOGGER.info(f"Columns: {list(final_df.columns)}")
+
+    # save to parquet
+    with stage("write_parquet", n_rows=len(final_df)):
+        table = pa.Table.from_pandas(final_df, preserve_index=False)
+        table = compact_table(table, keys, cfg.output.compact, cfg.output.float32)
+        sort_keys = keys if cfg.output.compact else []
+        write_table(table, output_path, sort_keys, cfg.output.row_group_size, cfg.output.compression)
+
+    LOGGER.info(f"Successfully created component file: {output_path}")
+
+    if cfg.metrics.enabled:
+        write_metrics(
+            output_path,
+            cfg.metrics.dir,
+            component=component,
+            polygon_name=cfg.polygon_name,
+            temporal_freq=cfg.temporal_freq,
+            year=int(year),
+        )
+
+
+# == incremental recompute
+
+def output_config_digest(cfg, component):
+    """
+    Hash of the config values the output of a component depends on
+    """
+    return config_digest(
+        cfg.polygon_name,
+        cfg.weighting,
+        list(cfg.stats),
+        cfg.satellite_component.component[component].layer,
+        cfg.output.compact,
+        cfg.output.float32,
+        *([dict(cfg.rollup.levels)] if cfg.rollup.enabled else []),
     )
 
-    # Store component data for all files
-    component_data = []
+
+def shapefile_digest(cfg, year):
+    """
+    Content hash of the shapefile used for a year
+    """
+    shapefile_year = available_shapefile_year(year, list(cfg.shapefiles[cfg.polygon_name].keys()))
+    return shapefile_hash(shapefile_path(cfg, shapefile_year))
+
+
+def row_slice_keys(cfg, df):
+    """
+    Slice keys (year, or year-month for monthly data) of the rows of a long format dataframe
+    """
+    keys = df["year"].astype(int).astype(str)
+    if cfg.temporal_freq == "monthly":
+        keys = keys + "-" + df["month"].astype(int).map("{:02d}".format)
+    return keys
+
+
+def upsert_slices(cfg, output_path, new_df, drop):
+    """
+    Replace the drop slices of an existing output with the recomputed rows, keeping the rows sorted by time
+    """
+    existing = read_output(output_path).to_pandas()
+    kept = existing[~row_slice_keys(cfg, existing).isin(drop)]
+    LOGGER.info(f"Keeping {len(kept)} of {len(existing)} rows of {output_path}.")
+
+    combined = pd.concat([kept] + ([new_df] if new_df is not None else []), ignore_index=True)
+    time_columns = ["year", "month"] if cfg.temporal_freq == "monthly" else ["year"]
+    return combined.sort_values(time_columns, kind="stable", ignore_index=True)
+
+
+def iter_file_stats(cfg, files):
+    """
+    Reduce the files one at a time using the same mapping. Yields the (stats, polygon_ids, years, months)
+    of each file, the raster of a file is released before the next one is read.
+    """
+    layer_name = cfg.satellite_component.component[cfg.component].layer
+
+    # == compute mapping from vector geometries to raster cells (only once per component)
+    LOGGER.info(f"Mapping polygons to raster cells for {cfg.component}.")
+
+    shapefile_years_list = list(cfg.shapefiles[cfg.polygon_name].keys())
+    shapefile_year = available_shapefile_year(cfg.year, shapefile_years_list)
+
+    # only the window covering the polygons is read from the files
+    ds = open_component_dataset(files[0][2])
+    layer = getattr(ds, layer_name)
+    window, transform = polygon_window(cfg, shapefile_year, layer)
+    with stage("read_raster"):
+        raster = layer.isel(window).values[::-1]
+
+    offsets, flat, polygon_ids, weights = get_polygon_mapping(cfg, shapefile_year, raster, transform)
 
     # == aggregate for all the files using the same mapping
-    for i, filename in enumerate(filenames):
-        
-        # Extract year from filename
-        match = re.search(r"(20\d{2})(?:-\1-|\d{3}-\1\d{3})", filename)
-        file_year = match.group(1) if match else None
-        if not file_year:
-            raise ValueError(f"Filename {filename} does not contain a valid year.")
-        
-        # Only process files for the requested year
-        if int(file_year) != cfg.year:
-            continue
-            
-        if cfg.temporal_freq == "monthly":
-            match = re.search(r"(?<!\d)(JAN|FEB|MAR|APR|MAY|JUN|JUL|AUG|SEP|OCT|NOV|DEC)(?!\w)", filename)
-            month_abbr = match.group(0) if match else None
-            if not month_abbr:
-                raise ValueError(f"Filename {filename} does not contain a valid month abbreviation.")
-            month = month_map[month_abbr]
-        else:
-            month = None
-            
+    for i, (file_year, month, filename) in enumerate(files):
         LOGGER.info(f"Aggregating {filename} as {cfg.temporal_freq} for year {file_year} month {month if cfg.temporal_freq == 'monthly' else 'N/A'}")
 
         if i > 0:
             # reload the file only if it is different from the first one
-            ds = xarray.open_dataset(filenames[i])
-            layer = getattr(ds, cfg.satellite_component.component[cfg.component].layer)
+            ds = open_component_dataset(filename)
+            with stage("read_raster"):
+                raster = getattr(ds, layer_name).isel(window).values[::-1]
 
         # === obtain stats quickly using precomputed mapping
-        stats = []
-        for indices in poly2cells:
-            if len(indices[0]) == 0:
-                # no cells found for this polygon
-                stats.append(np.nan)
-                continue
-            cells = layer.values[::-1][indices]
-            stats.append(np.nanmean(cells))
-
-        df_data = {
-            cfg.component: stats, 
-            "year": int(file_year),
-            cfg.polygon_name: polygon_ids
-        }
-        
-        if cfg.temporal_freq == "monthly":
-            df_data["month"] = int(month)
-            
-        component_data.append(pd.DataFrame(df_data))
+        stats = zonal_statistics(raster, offsets, flat, cfg.stats, weights)
+        if cfg.rollup.enabled:
+            stats.update(rollup_sums(cfg, raster, offsets, flat, polygon_ids, weights))
+        del raster
+        yield stats, polygon_ids, [file_year], [month]
+
 
+def aggregate_per_file(cfg, files):
+    """
+    Aggregate the files one at a time using the same mapping. Returns a long format dataframe.
+    """
     # concatenate all data (necessary for monthly files to combine all months)
-    if component_data:
-        final_df = pd.concat(component_data, ignore_index=True)
+    return pd.concat(
+        [long_format(cfg, cfg.component, *block) for block in iter_file_stats(cfg, files)], ignore_index=True
+    )
+
+
+def open_file_cube(cfg, files):
+    """
+    The layer of cfg.component in the files, stacked lazily into a (time, lat, lon) cube
+    """
+    layer_name = cfg.satellite_component.component[cfg.component].layer
+
+    # only keep the requested layer, files with several layers (om, om_h2o) are not read twice
+    with stage("open_dataset", n_files=len(files)):
+        ds = xarray.open_mfdataset(
+            [f for _, _, f in files],
+            combine="nested",
+            concat_dim="time",
+            preprocess=lambda ds: ds[[layer_name]],
+            data_vars="all",
+            coords="minimal",
+            compat="override",
+            chunks={"time": cfg.cube.time_chunk},
+        )
+    return getattr(ds, layer_name)
+
+
+def open_zarr_cube(cfg, component, files):
+    """
+    The slices of the files read lazily from the zarr store of the component (src/ingest_zarr.py), as a
+    (time, lat, lon) cube chunked in the tiles of the store
+    """
+    layer_name = cfg.satellite_component.component[component].layer
+    store = zarr_store_path(cfg.temporal_freq, component)
+    if not os.path.exists(store):
+        raise FileNotFoundError(f"Zarr store {store} does not exist, run src/ingest_zarr.py first.")
+
+    with stage("open_dataset", n_files=1):
+        ds = xarray.open_zarr(store)
+    index = {
+        slice_key(year, month or None): i
+        for i, (year, month) in enumerate(zip(ds["year"].values, ds["month"].values))
+    }
+    missing = [slice_key(year, month) for year, month, _ in files if slice_key(year, month) not in index]
+    if missing:
+        raise ValueError(f"Slices {missing} are missing from zarr store {store}, run src/ingest_zarr.py again.")
+
+    return ds[layer_name].isel(time=[index[slice_key(year, month)] for year, month, _ in files])
+
+
+def rasters_per_block(cfg, raster, flat):
+    """
+    Number of rasters reduced at once by the cube path: cube.time_chunk, lowered so that a block fits in the
+    memory left under streaming.max_memory_mb (when set)
+    """
+    if not (cfg.streaming.enabled and cfg.streaming.max_memory_mb):
+        return cfg.cube.time_chunk
+    # the raster window, and the float64 cell values, validity and weights gathered by the reduction
+    raster_mb = (raster.nbytes + len(flat) * 8 * 3) / 2**20
+    available_mb = cfg.streaming.max_memory_mb - (current_rss_mb() or 0)
+    return int(np.clip(available_mb // raster_mb, 1, cfg.cube.time_chunk))
+
+
+def iter_cube_stats(cfg, files, cube):
+    """
+    Reduce the rasters of a (time, lat, lon) cube with one raster per file in blocks of rasters.
+    Files are grouped by shapefile year so that each group is reduced with a single mapping.
+    Yields the (stats, polygon_ids, years, months) of the rasters of each year of each block.
+    """
+    shapefile_years_list = list(cfg.shapefiles[cfg.polygon_name].keys())
+    assert cube.dims[0] == "time", "cube must be stacked along time"
+
+    file_years = np.array([y for y, _, _ in files])
+    file_months = np.array([m or 0 for _, m, _ in files])
+    group_years = np.array([available_shapefile_year(int(y), shapefile_years_list) for y in file_years])
+
+    for shapefile_year in sorted(set(group_years.tolist())):
+        time_idx = np.flatnonzero(group_years == shapefile_year)
+
+        LOGGER.info(f"Mapping polygons to raster cells for {cfg.component} with shapefile {shapefile_year}.")
+        # only the chunks of the window covering the polygons are read
+        window, transform = polygon_window(cfg, shapefile_year, cube)
+        cube_window = cube.isel(window)
+
+        with stage("read_raster"):
+            first = cube_window.isel(time=int(time_idx[0])).values[::-1]
+        offsets, flat, polygon_ids, weights = get_polygon_mapping(cfg, shapefile_year, first, transform)
+        block_size = rasters_per_block(cfg, first, flat)
+        del first
+
+        # reduce the cube in blocks of time_chunk rasters to bound memory
+        for start in range(0, len(time_idx), block_size):
+            block_idx = time_idx[start:start + block_size]
+            LOGGER.info(f"Aggregating {len(block_idx)} rasters for years {sorted(set(file_years[block_idx]))}")
+            with stage("read_raster"):
+                block = cube_window.isel(time=block_idx).values[:, ::-1]
+            stats = zonal_statistics(block, offsets, flat, cfg.stats, weights)
+            if cfg.rollup.enabled:
+                stats.update(rollup_sums(cfg, block, offsets, flat, polygon_ids, weights))
+            del block
+
+            for year in np.unique(file_years[block_idx]):
+                sel = file_years[block_idx] == year
+                yield (
+                    {stat: values[sel] for stat, values in stats.items()},
+                    polygon_ids,
+                    file_years[block_idx][sel],
+                    file_months[block_idx][sel],
+                )
+
+
+def aggregate_cube(cfg, files, cube):
+    """
+    Aggregate all the files at once from a (time, lat, lon) cube with one raster per file.
+    Returns a dict of long format dataframes, one per year.
+    """
+    results = {}
+    for stats, polygon_ids, years, months in iter_cube_stats(cfg, files, cube):
+        results.setdefault(int(years[0]), []).append(long_format(cfg, cfg.component, stats, polygon_ids, years, months))
+    return {year: pd.concat(dfs, ignore_index=True) for year, dfs in results.items()}
+
+
+def stream_component(cfg, files):
+    """
+    Aggregate the files and write the statistics of each file (or block of rasters) straight to the output of
+    its year with a streaming writer, instead of collecting them into a dataframe per year.
+    Returns the years written.
+    """
+    if cfg.zarr.enabled:
+        blocks = iter_cube_stats(cfg, files, open_zarr_cube(cfg, cfg.component, files))
+    elif cfg.cube.enabled:
+        blocks = iter_cube_stats(cfg, files, open_file_cube(cfg, files))
     else:
-        LOGGER.error(f"No data processed for component {cfg.component}!")
-        return
+        blocks = iter_file_stats(cfg, files)
 
-    # == save individual component output file
-    output_dir = f"data/intermediate/pm25_components__randall/{cfg.temporal_freq}/{cfg.component}/"
-    output_filename = f"{output_dir}{cfg.component}__{cfg.polygon_name}_{cfg.temporal_freq}_{cfg.year}.parquet"
+    keys = key_columns(cfg.polygon_name, cfg.temporal_freq)
+    written, writer = [], None
+    try:
+        for stats, polygon_ids, years, months in blocks:
+            year = int(years[0])
+            if not written or written[-1] != year:
+                if year in written:
+                    raise ValueError(f"Files of year {year} are not consecutive, they cannot be streamed.")
+                if writer is not None:
+                    finish_streamed_output(cfg, writer, written[-1])
+                output_path = component_output_path(cfg, cfg.component, year)
+                LOGGER.info(f"Streaming component output to {output_path}")
+                writer = StreamingWriter(
+                    output_path,
+                    keys,
+                    cfg.output.compact,
+                    cfg.output.float32,
+                    cfg.output.row_group_size,
+                    cfg.output.compression,
+                )
+                written.append(year)
 
-    os.makedirs(output_dir, exist_ok=True)
+            with stage("write_parquet", n_rows=len(polygon_ids) * len(years)):
+                writer.write(long_table(cfg, cfg.component, stats, polygon_ids, years, months))
+            check_memory(cfg)
+        if writer is not None:
+            finish_streamed_output(cfg, writer, written[-1])
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        raise
+    return written
 
-    output_path = os.path.abspath(output_filename)
-    LOGGER.info(f"Saving component output to {output_path}")
-    LOGGER.info(f"Component dataset shape: {final_df.shape}")
-    LOGGER.info(f"Columns: {list(final_df.columns)}")
-    
-    # save to parquet
-    final_df.to_parquet(output_path, index=False)
 
-    LOGGER.info(f"Successfully created component file: {output_path}")
+def finish_streamed_output(cfg, writer, year):
+    with stage("write_parquet"):
+        writer.close()
+    LOGGER.info(f"Successfully created component file: {writer.path} ({writer.n_rows} rows)")
+
+    if cfg.metrics.enabled:
+        write_metrics(
+            str(writer.path),
+            cfg.metrics.dir,
+            component=cfg.component,
+            polygon_name=cfg.polygon_name,
+            temporal_freq=cfg.temporal_freq,
+            year=int(year),
+        )
+
+
+def check_memory(cfg):
+    """
+    Raise MemoryError when the resident memory of the job exceeds streaming.max_memory_mb
+    """
+    rss = current_rss_mb()
+    if cfg.streaming.max_memory_mb and rss is not None and rss > cfg.streaming.max_memory_mb:
+        raise MemoryError(
+            f"The job uses {rss:.0f} MB, more than streaming.max_memory_mb={cfg.streaming.max_memory_mb}."
+        )
+
+
+def aggregate_component(cfg):
+    """
+    Aggregate cfg.component into cfg.polygon_name for cfg.year (or cfg.years) and write one file per year.
+    Returns False when the input files of a year are missing.
+    """
+    years = list(cfg.years) if cfg.get("years") else [cfg.year]
+    LOGGER.info(f"Running aggregation for: {cfg.component} {cfg.temporal_freq} {cfg.polygon_name} {years}")
+    validate_stats(cfg.stats)
+
+    # == filenames to be aggregated for this component
+    component_path = pathlib.Path(f"data/input/pm25_components__randall/{cfg.temporal_freq}/{cfg.component}/")
+    if not component_path.exists():
+        LOGGER.error(f"Component path {component_path} does not exist.")
+        return False
+
+    files = list_component_files(
+        component_path, cfg.temporal_freq, years, manifest=manifest_path(cfg.temporal_freq, cfg.component)
+    )
+
+    if not files:
+        LOGGER.error(f"No files found for component {cfg.component}.")
+        return False
+
+    if len(years) > 1 and not (cfg.cube.enabled or cfg.zarr.enabled):
+        raise ValueError("Aggregating several years in one job requires cube.enabled=true or zarr.enabled=true.")
+    if cfg.streaming.enabled and cfg.incremental.enabled:
+        raise ValueError("streaming.enabled and incremental.enabled cannot be combined.")
+
+    # == incremental mode: only aggregate the slices whose input file changed since the output was written
+    plans = {}
+    if cfg.incremental.enabled:
+        digests = file_digests(files, manifest=manifest_path(cfg.temporal_freq, cfg.component))
+        config = output_config_digest(cfg, cfg.component)
+        changed_files = []
+        for year in years:
+            year_files = [f for f in files if f[0] == year]
+            slices = {slice_key(y, m): digests[slice_key(y, m)] for y, m, _ in year_files}
+            output_path = component_output_path(cfg, cfg.component, year)
+            recompute, drops = plan_outputs([(output_path, config, slices)], shapefile_digest(cfg, year))
+            plans[year] = config, slices, recompute, drops.get(output_path)
+            changed_files += [f for f in year_files if recompute is None or slice_key(f[0], f[1]) in recompute]
+        LOGGER.info(f"Incremental mode: {len(changed_files)} of {len(files)} files changed.")
+        files = changed_files
+
+    # == streaming mode: the outputs are written while the files are reduced
+    if cfg.streaming.enabled:
+        written = stream_component(cfg, files)
+        missing = [year for year in years if year not in written]
+        for year in missing:
+            LOGGER.error(f"No data processed for component {cfg.component} year {year}!")
+        return not missing
+
+    results = {}
+    if files:
+        if cfg.zarr.enabled:
+            results = aggregate_cube(cfg, files, open_zarr_cube(cfg, cfg.component, files))
+        elif cfg.cube.enabled:
+            results = aggregate_cube(cfg, files, open_file_cube(cfg, files))
+        else:
+            results = {cfg.year: aggregate_per_file(cfg, files)}
+
+    complete = True
+    for year in years:
+        output_path = component_output_path(cfg, cfg.component, year)
+        if year in plans:
+            config, slices, recompute, drop = plans[year]
+            if recompute is not None:
+                if not drop:
+                    LOGGER.info(f"{output_path} is up to date.")
+                    continue
+                results[year] = upsert_slices(cfg, output_path, results.get(year), drop)
+
+        if year not in results:
+            LOGGER.error(f"No data processed for component {cfg.component} year {year}!")
+            complete = False
+            continue
+        save_component_output(cfg, cfg.component, year, results[year])
+
+        if year in plans:
+            save_record(output_path, config, shapefile_digest(cfg, year), slices)
+
+    return complete
+
+
+@hydra.main(config_path="../conf", config_name="config", version_base=None)
+def main(cfg):
+    # get aggregation defaults
+    if not aggregate_component(cfg):
+        # a failed job, so that snakemake does not mark the output as done
+        raise RuntimeError(f"Aggregation of {cfg.component} {cfg.temporal_freq} {cfg.polygon_name} is incomplete.")
 
 
 if __name__ == "__main__":
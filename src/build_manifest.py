@@ -0,0 +1,73 @@
+import xarray
+import hydra
+import logging
+import hashlib
+import os
+
+from utils.component_files import component_path, load_manifest, manifest_path, scan_component_files, write_manifest
+from utils.fingerprints import file_digest
+
+
+# configure logger to print at info level
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+def grid_signature(filename, cfg):
+    """
+    Hash of the latitude/longitude coordinates of a netcdf file
+    """
+    digest = hashlib.sha256()
+    with xarray.open_dataset(filename) as ds:
+        for name in (cfg.satellite_component.latitude_layer, cfg.satellite_component.longitude_layer):
+            values = ds[name].values
+            digest.update(f"{name}{values.shape}{values.dtype}".encode())
+            digest.update(values.tobytes())
+    return digest.hexdigest()[:16]
+
+
+@hydra.main(config_path="../conf", config_name="config", version_base=None)
+def main(cfg):
+    """
+    Write the manifest of the downloaded files of a component, used by the aggregation jobs and the Snakefile
+    to find the files of a year without scanning the directory.
+    """
+    LOGGER.info(f"Building manifest for: {cfg.component} {cfg.temporal_freq}")
+    output_path = manifest_path(cfg.temporal_freq, cfg.component)
+
+    # digests of the files that did not change since the previous manifest are reused
+    previous = {}
+    if os.path.exists(output_path):
+        for year_entries in load_manifest(output_path).values():
+            previous.update({entry["path"]: entry for entry in year_entries})
+
+    entries = []
+    for year, month, filename in scan_component_files(component_path(cfg.temporal_freq, cfg.component), cfg.temporal_freq):
+        stat = os.stat(filename)
+        known = previous.get(filename, {})
+        if known.get("sha256") and known["size"] == stat.st_size and known["mtime"] == int(stat.st_mtime):
+            signature, sha256 = known["grid_signature"], known["sha256"]
+        else:
+            signature, sha256 = grid_signature(filename, cfg), file_digest(filename)
+        entries.append({
+            "component": cfg.component,
+            "temporal_freq": cfg.temporal_freq,
+            "year": year,
+            "month": month,
+            "path": filename,
+            "size": stat.st_size,
+            "mtime": int(stat.st_mtime),
+            "grid_signature": signature,
+            "sha256": sha256,
+        })
+
+    if not entries:
+        LOGGER.error(f"No files found for component {cfg.component}.")
+        return
+
+    write_manifest(output_path, entries)
+    LOGGER.info(f"Wrote {len(entries)} files to manifest {os.path.abspath(output_path)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import xarray
+import geopandas as gpd
+import hydra
+import logging
+
+from src.aggregate_components import grid_transform, shapefile_hash, shapefile_path
+from utils.component_files import component_path, scan_component_files
+from utils.shapefile_cache import grid_key, preprocessed_path, read_preprocessed, to_raster_crs, write_preprocessed
+
+
+# configure logger to print at info level
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+def component_grid(cfg):
+    """
+    Affine transform and shape of the full grid of the component files (taken from the first file of
+    cfg.component), or None when no file has been downloaded yet
+    """
+    files = sorted(scan_component_files(component_path(cfg.temporal_freq, cfg.component), cfg.temporal_freq))
+    if not files:
+        return None
+    lat_dim = cfg.satellite_component.latitude_layer
+    lon_dim = cfg.satellite_component.longitude_layer
+    with xarray.open_dataset(files[0][2]) as ds:
+        layer = ds[cfg.satellite_component.component[cfg.component].layer]
+        layer = layer.isel({d: 0 for d in layer.dims if d not in (lat_dim, lon_dim)})
+        return grid_transform(layer, cfg), (layer.sizes[lat_dim], layer.sizes[lon_dim])
+
+
+@hydra.main(config_path="../conf", config_name="config", version_base=None)
+def main(cfg):
+    """
+    Convert the shapefile of cfg.polygon_name for cfg.shapefile_year to a geoparquet file with the id column,
+    the geometries in the crs of the rasters, and the bounds and grid window of each polygon, read by the
+    aggregation jobs instead of the shapefile. Nothing is done when the file is up to date.
+    """
+    shape_path = shapefile_path(cfg, cfg.shapefile_year)
+    path = preprocessed_path(shape_path)
+    idvar = cfg.shapefiles[cfg.polygon_name][cfg.shapefile_year].idvar
+    source_hash = shapefile_hash(shape_path)
+
+    grid = component_grid(cfg)
+    if grid is None:
+        LOGGER.warning(f"No {cfg.component} {cfg.temporal_freq} files found, the grid windows are not stored.")
+    transform, shape = grid if grid is not None else (None, None)
+
+    cached = read_preprocessed(path, source_hash, cfg.shapefile_cache.crs)
+    if cached is not None and (grid is None or cached[1]["grid_transform"] == grid_key(transform)):
+        LOGGER.info(f"{path} is up to date.")
+        return
+
+    LOGGER.info(f"Converting {shape_path}")
+    polygon = to_raster_crs(gpd.read_file(shape_path), cfg.shapefile_cache.crs)
+    write_preprocessed(polygon, path, idvar, source_hash, transform, shape)
+    LOGGER.info(f"Wrote {len(polygon)} polygons to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,43 @@
 import logging
 import os
-import zipfile
 import hydra
-import wget
 
-@hydra.main(config_path="../conf", config_name="config", version_base=None)
-def main(cfg):
-    url = cfg.shapefiles[cfg.polygon_name][cfg.shapefile_year].url
-
-    tgt = f"data/input/shapefiles/shapefile_{cfg.polygon_name}_{cfg.shapefile_year}"
-
-    tgtdir = os.path.dirname(tgt)
-    tgtfile = os.path.basename(tgt)
-
-    tgt = f"{tgtdir}/{tgtfile}"
-    logging.info(f"Downloading {url}")
-    wget.download(url, f"{tgt}.zip")
-    logging.info("Done.")
+from utils.downloads import download, extract_zip, make_fetcher, run_concurrently
 
-    # unzip with unzip library
-    with zipfile.ZipFile(f"{tgt}.zip", "r") as zip_ref:
-        zip_ref.extractall(tgt)
-    logging.info(f"Unzipped {tgt} with files:\n {os.listdir(tgt)}")
 
-    # remove dirty zip file
-    os.remove(f"{tgt}.zip")
-    logging.info(f"Removed {tgt}.zip")
-
-    logging.info(f"Rename files to shapefile.*")
-    files = os.listdir(tgt)
-    for f in files:
-        _, ext = os.path.splitext(f)
-        os.rename(f"{tgt}/{f}", f"{tgt}/shapefile{ext}")
+@hydra.main(config_path="../conf", config_name="config", version_base=None)
+def main(cfg):
+    """
+    Download the shapefile of cfg.polygon_name for cfg.shapefile_year, or for all the years in
+    cfg.download.shapefile_years with a pool of cfg.download.workers
+    """
+    years = list(cfg.download.shapefile_years) if cfg.download.shapefile_years else [cfg.shapefile_year]
+
+    def download_shapefile(shapefile_year):
+        shapefile_cfg = cfg.shapefiles[cfg.polygon_name][shapefile_year]
+        tgt = f"data/input/shapefiles/shapefile_{cfg.polygon_name}_{shapefile_year}"
+
+        fetcher = make_fetcher(cfg.download.shapefile_fetcher, cfg.download.timeout)
+        logging.info(f"Downloading {shapefile_cfg.url}")
+        download(
+            fetcher,
+            shapefile_cfg.url,
+            f"{tgt}.zip",
+            sha256=shapefile_cfg.get("sha256"),
+            retries=cfg.download.retries,
+        )
+
+        # files are extracted directly as shapefile.*
+        files = extract_zip(f"{tgt}.zip", tgt, rename=lambda name: f"shapefile{os.path.splitext(name)[1]}")
+        logging.info(f"Unzipped {tgt} with files:\n {[os.path.basename(f) for f in files]}")
+
+        # remove dirty zip file
+        os.remove(f"{tgt}.zip")
+        logging.info(f"Removed {tgt}.zip")
+
+    run_concurrently(download_shapefile, years, cfg.download.workers)
     logging.info(f"Done.")
 
+
 if __name__ == "__main__":
     main()
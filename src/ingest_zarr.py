@@ -0,0 +1,100 @@
+import xarray
+import numpy as np
+import hydra
+import logging
+import os
+
+from utils.component_files import component_path, list_component_files, manifest_path, scan_component_files, zarr_store_path
+from utils.fingerprints import file_digests, slice_key
+
+
+# configure logger to print at info level
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+def file_slice(cfg, layer_name, year, month, filename, digest):
+    """
+    (time=1, lat, lon) dataset of the layer of a component file, with the year, month (0 for yearly
+    files) and sha256 of the file as time coordinates
+    """
+    with xarray.open_dataset(filename) as ds:
+        ds = ds[[layer_name]].load()
+    return ds.expand_dims(time=1).assign_coords(
+        year=("time", np.array([year], dtype="int32")),
+        month=("time", np.array([month or 0], dtype="int32")),
+        sha256=("time", np.array([digest], dtype="U64")),
+    )
+
+
+def check_grid(cfg, ds, reference, filename):
+    """
+    Raise if the latitude/longitude coordinates of a file differ from the ones of the store
+    """
+    for name in (cfg.satellite_component.latitude_layer, cfg.satellite_component.longitude_layer):
+        if not np.array_equal(ds[name].values, reference[name].values):
+            raise ValueError(f"File {filename} is not on the grid of the zarr store ({name} differs).")
+
+
+@hydra.main(config_path="../conf", config_name="config", version_base=None)
+def main(cfg):
+    """
+    Consolidate the files of a component into a single zarr store with a time dimension, chunked in
+    (1, zarr.chunks.lat, zarr.chunks.lon) tiles so that the aggregation only reads the tiles covering the polygons.
+    Files that are already in the store with the same content are skipped, changed files overwrite their slice
+    and new files are appended.
+    """
+    LOGGER.info(f"Ingesting {cfg.component} {cfg.temporal_freq} into zarr")
+    layer_name = cfg.satellite_component.component[cfg.component].layer
+    store = zarr_store_path(cfg.temporal_freq, cfg.component)
+
+    path = component_path(cfg.temporal_freq, cfg.component)
+    years = sorted({year for year, _, _ in scan_component_files(path, cfg.temporal_freq)})
+    files = list_component_files(path, cfg.temporal_freq, years, manifest=manifest_path(cfg.temporal_freq, cfg.component))
+    if not files:
+        LOGGER.error(f"No files found for component {cfg.component}.")
+        return
+    digests = file_digests(files, manifest=manifest_path(cfg.temporal_freq, cfg.component))
+
+    # == slices already in the store, the grid is checked once here instead of by every aggregation job
+    existing, reference = {}, None
+    if os.path.exists(store):
+        reference = xarray.open_zarr(store)
+        if layer_name not in reference:
+            raise ValueError(f"Zarr store {store} does not contain layer {layer_name}.")
+        for i, (year, month, digest) in enumerate(
+            zip(reference["year"].values, reference["month"].values, reference["sha256"].values)
+        ):
+            existing[slice_key(year, month or None)] = (i, str(digest))
+
+    n_written = 0
+    for year, month, filename in files:
+        key = slice_key(year, month)
+        digest = digests[key]
+        if key in existing and existing[key][1] == digest:
+            continue
+
+        ds = file_slice(cfg, layer_name, year, month, filename, digest)
+        if reference is None:
+            # first slice: create the store with the chunking of the layer
+            chunks = (1, min(cfg.zarr.chunks.lat, ds.sizes[cfg.satellite_component.latitude_layer]),
+                      min(cfg.zarr.chunks.lon, ds.sizes[cfg.satellite_component.longitude_layer]))
+            ds.to_zarr(store, mode="w", encoding={layer_name: {"chunks": chunks}})
+            reference = xarray.open_zarr(store)
+        else:
+            check_grid(cfg, ds, reference, filename)
+            if key in existing:
+                LOGGER.info(f"{filename} changed, overwriting slice {key}.")
+                region = {"time": slice(existing[key][0], existing[key][0] + 1)}
+                ds.drop_vars([cfg.satellite_component.latitude_layer, cfg.satellite_component.longitude_layer]).to_zarr(
+                    store, region=region
+                )
+            else:
+                ds.to_zarr(store, append_dim="time")
+        n_written += 1
+
+    LOGGER.info(f"Wrote {n_written} of {len(files)} files to {os.path.abspath(store)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,13 @@
 import pandas as pd
+import pyarrow as pa
 import hydra
-import logging  
+import logging
 import pathlib
 import os
 
-from hydra.core.hydra_config import HydraConfig
+from utils.instrumentation import stage, write_metrics
+from utils.output_paths import component_output_file, merged_output_file
+from utils.output_writer import compact_table, read_output, write_table
 
 
 # configure logger to print at info level
@@ -12,66 +15,132 @@ logging.basicConfig(level=logging.INFO)
 LOGGER = logging.getLogger(__name__)
 
 
+def key_columns(polygon_name, temporal_freq):
+    """
+    Columns identifying a row: spatial resolution, year, (month if monthly)
+    """
+    columns = [polygon_name, "year"]
+    if temporal_freq == "monthly":
+        columns.append("month")
+    return columns
+
+
+def keys_aligned(tables, keys):
+    """
+    Whether all the tables have identical key columns, row by row
+    """
+    base = tables[0].select(keys)
+    return all(t.num_rows == base.num_rows and t.select(keys).equals(base) for t in tables[1:])
+
+
+def value_columns(table, keys):
+    """
+    Statistic columns of a component table (the mean, named after the component, and e.g. no3_std).
+    The partial sums and counts kept for the roll-up (e.g. no3_sum__county) are not merged.
+    """
+    return [name for name in table.column_names if name not in keys and "__" not in name]
+
+
+def merge_component_tables(tables, components, polygon_name, temporal_freq):
+    """
+    Merge the long format tables of each component into a wide table.
+    When the keys of all the tables are aligned (the usual case, since all the components are aggregated
+    with the same polygons and files) the component columns are stacked without copying. Otherwise
+    the tables are combined with a single outer join on the keys.
+    """
+    components = list(components)
+    keys = key_columns(polygon_name, temporal_freq)
+    component_columns = {component: value_columns(table, keys) for component, table in zip(components, tables)}
+
+    if keys_aligned(tables, keys):
+        columns = {key: tables[0].column(key) for key in keys}
+        for component, table in zip(components, tables):
+            for name in component_columns[component]:
+                columns[name] = table.column(name)
+    else:
+        LOGGER.info(f"Component keys are not aligned, joining on {keys}.")
+        df = pd.concat(
+            [
+                table.to_pandas().set_index(keys)[component_columns[component]]
+                for component, table in zip(components, tables)
+            ],
+            axis=1,
+            join="outer",
+        ).reset_index()
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        columns = {name: table.column(name) for name in table.column_names}
+
+    # Reorder columns: spatial resolution, year, (month if monthly), then components in alphabetical order,
+    # each followed by its other statistics
+    column_order = keys + [name for component in sorted(components) for name in component_columns[component]]
+
+    return pa.table({name: columns[name] for name in column_order})
+
+
+def merged_output_path(cfg, year):
+    return os.path.abspath(merged_output_file(cfg.polygon_name, cfg.temporal_freq, year, cfg.output.layout))
+
+
+def save_merged_output(cfg, year, final_table):
+    """
+    Save the merged output file with all the components
+    """
+    LOGGER.info(f"Final dataset shape: {final_table.shape}")
+    LOGGER.info(f"Columns: {final_table.column_names}")
+
+    output_path = merged_output_path(cfg, year)
+    keys = key_columns(cfg.polygon_name, cfg.temporal_freq)
+
+    LOGGER.info(f"Saving final output to {output_path}")
+
+    # save to parquet
+    with stage("write_parquet", n_rows=final_table.num_rows):
+        # rows sorted by the keys in both encodings, as by the outer join of the previous versions
+        table = compact_table(final_table, keys, cfg.output.compact, cfg.output.float32).sort_by(
+            [(key, "ascending") for key in keys]
+        )
+        write_table(table, output_path, keys, cfg.output.row_group_size, cfg.output.compression)
+
+    LOGGER.info(f"Successfully created merged file: {output_path}")
+
+    if cfg.metrics.enabled:
+        write_metrics(
+            output_path,
+            cfg.metrics.dir,
+            component="merged",
+            polygon_name=cfg.polygon_name,
+            temporal_freq=cfg.temporal_freq,
+            year=int(year),
+        )
+
+
 @hydra.main(config_path="../conf", config_name="config", version_base=None)
 def main(cfg):
     # get aggregation defaults
     LOGGER.info(f"Running merge for: {cfg.temporal_freq} {cfg.polygon_name} {cfg.year}")
-    logging_dir = HydraConfig.get().runtime.output_dir
 
     components = cfg.satellite_component.component.keys()
     LOGGER.info(f"Components to merge: {list(components)}")
 
     # Load all component files and merge them
-    component_dfs = []
+    component_tables = []
     for component in components:
-        component_file = f"data/intermediate/pm25_components__randall/{cfg.temporal_freq}/{component}/{component}__{cfg.polygon_name}_{cfg.temporal_freq}_{cfg.year}.parquet"
-        
+        component_file = component_output_file(cfg.temporal_freq, component, cfg.polygon_name, cfg.year, cfg.output.layout)
+
         if not os.path.exists(component_file):
             LOGGER.error(f"Component file not found: {component_file}")
             return
-            
-        LOGGER.info(f"Loading component file: {component_file}")
-        df = pd.read_parquet(component_file)
-        component_dfs.append(df)
-
-    # Merge all components into wide format
-    base_df = component_dfs[0]
-    
-    # merge on geo id, year, month
-    merge_columns = [col for col in base_df.columns if col not in components]
-    
-    for i, df in enumerate(component_dfs[1:], 1):
-        component_name = list(components)[i]
-        base_df = base_df.merge(df, on=merge_columns, how='outer')
-
-    # Reorder columns: spatial resolution, year, (month if monthly), then components
-    column_order = [cfg.polygon_name, "year"]
-    
-    if cfg.temporal_freq == "monthly":
-        column_order.append("month")
-        
-    # Add components in alphabetical order
-    component_order = sorted(list(components))
-    column_order.extend(component_order)
-    
-    final_df = base_df[column_order]
-
-    LOGGER.info(f"Final dataset shape: {final_df.shape}")
-    LOGGER.info(f"Columns: {list(final_df.columns)}")
 
-    # == save output file
-    output_dir = f"data/output/pm25_components__randall/{cfg.polygon_name}_{cfg.temporal_freq}/"
-    output_filename = f"{output_dir}pm25_components__randall__{cfg.polygon_name}_{cfg.temporal_freq}_{cfg.year}.parquet"
+        LOGGER.info(f"Loading component file: {component_file}")
+        with stage("read_parquet"):
+            table = read_output(component_file)
+        component_tables.append(table)
 
-    os.makedirs(output_dir, exist_ok=True)
+    with stage("merge", n_components=len(component_tables)):
+        final_table = merge_component_tables(component_tables, components, cfg.polygon_name, cfg.temporal_freq)
 
-    output_path = os.path.abspath(output_filename)
-    LOGGER.info(f"Saving final output to {output_path}")
-    
-    # save to parquet
-    final_df.to_parquet(output_path, index=False)
-
-    LOGGER.info(f"Successfully created merged file: {output_path}")
+    # == save output file
+    save_merged_output(cfg, cfg.year, final_table)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,88 @@
+import pandas as pd
+import hydra
+import logging
+import json
+import pathlib
+import os
+
+
+# configure logger to print at info level
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+# stages timed inside another stage, not counted in the job totals
+NESTED_STAGES = {"rasterize_group": "mapping_layer"}
+
+
+def load_sidecars(metrics_dir):
+    """
+    Long format dataframe with one row per job output and stage from all the .metrics.json sidecars
+    """
+    rows = []
+    for path in sorted(pathlib.Path(metrics_dir).glob("**/*.metrics.json")):
+        with open(path) as f:
+            sidecar = json.load(f)
+        for name, metrics in sidecar["stages"].items():
+            rows.append({
+                **sidecar["job"],
+                "output": sidecar["output"],
+                "stage": name,
+                "calls": metrics["calls"],
+                "wall_time_s": metrics["wall_time_s"],
+                "cpu_time_s": metrics["cpu_time_s"],
+                "bytes_read": metrics["bytes_read"],
+                "peak_rss_increase_mb": metrics["peak_rss_increase_mb"],
+                "process_peak_rss_mb": metrics["process_peak_rss_mb"],
+                **metrics["counts"],
+            })
+    return pd.DataFrame(rows)
+
+
+@hydra.main(config_path="../conf", config_name="config", version_base=None)
+def main(cfg):
+    df = load_sidecars(cfg.metrics.dir)
+    if df.empty:
+        LOGGER.error(f"No .metrics.json sidecars found in {cfg.metrics.dir}, run the jobs with metrics.enabled=true.")
+        return
+    LOGGER.info(f"Loaded {df['output'].nunique()} sidecars with {len(df)} stage records.")
+
+    pd.set_option("display.width", 200)
+    pd.set_option("display.max_columns", 20)
+
+    # == time spent per stage across all the jobs
+    top_level = df[~df["stage"].isin(NESTED_STAGES)]
+    by_stage = df.groupby("stage").agg(
+        calls=("calls", "sum"),
+        wall_time_s=("wall_time_s", "sum"),
+        cpu_time_s=("cpu_time_s", "sum"),
+        read_mb=("bytes_read", lambda b: b.sum() / 2**20),
+        peak_rss_increase_mb=("peak_rss_increase_mb", "max"),
+    )
+    by_stage["wall_share"] = by_stage["wall_time_s"] / top_level["wall_time_s"].sum()
+    by_stage = by_stage.sort_values("wall_time_s", ascending=False)
+    LOGGER.info(f"Stages across all jobs:\n{by_stage.to_string(float_format='{:.3f}'.format)}")
+
+    # == slowest jobs overall
+    job_columns = [c for c in ("component", "polygon_name", "temporal_freq", "year") if c in df.columns]
+    by_job = top_level.groupby(job_columns).agg(
+        wall_time_s=("wall_time_s", "sum"),
+        cpu_time_s=("cpu_time_s", "sum"),
+        peak_rss_mb=("process_peak_rss_mb", "max"),
+    ).sort_values("wall_time_s", ascending=False)
+    LOGGER.info(f"Slowest jobs:\n{by_job.head(cfg.metrics.report_top).to_string(float_format='{:.3f}'.format)}")
+
+    # == slowest jobs of the most expensive stages
+    for name in by_stage.index[:3]:
+        top = df[df["stage"] == name].nlargest(cfg.metrics.report_top, "wall_time_s")
+        columns = job_columns + ["calls", "wall_time_s", "cpu_time_s", "peak_rss_increase_mb"]
+        LOGGER.info(f"Slowest jobs for stage {name}:\n{top[columns].to_string(index=False, float_format='{:.3f}'.format)}")
+
+    if cfg.metrics.report_output is not None:
+        output_path = cfg.metrics.report_output
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        df.to_csv(output_path, index=False)
+        LOGGER.info(f"Saved stage metrics of all the jobs to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import geopandas as gpd
+import shapely
+import hydra
+import logging
+import pathlib
+
+from utils.component_files import available_shapefile_year, list_component_files, manifest_path
+from utils.faster_zonal_stats import (
+    bounds_windows,
+    polygon_cell_coverage,
+    polygon_to_raster_cells_parallel,
+    validate_stats,
+    zonal_statistics,
+)
+from utils.instrumentation import stage
+from utils.mapping_cache import (
+    cells_to_csr,
+    find_cached_cells,
+    find_grid_mapping,
+    hash_geometries,
+    load_mapping,
+    load_weights,
+)
+from utils.shapefile_cache import BOUNDS_COLUMNS, preprocessed_path, read_feature_bounds, to_raster_crs
+from src.aggregate_components import (
+    _mappings,
+    grid_transform,
+    grid_window,
+    load_shapefile,
+    long_format,
+    open_component_dataset,
+    open_zarr_cube,
+    polygon_bounds,
+    polygon_mapping_key,
+    shapefile_hash,
+    shapefile_path,
+    window_indexers,
+)
+from src.merge_components import merge_component_tables
+
+
+# configure logger to print at info level
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+def subset_mapping(offsets, flat, positions, weights=None):
+    """
+    CSR mapping (and cell weights) of the polygons at the given positions of a mapping
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    lengths = offsets[positions + 1] - offsets[positions]
+    new_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(offsets.dtype)
+    cells = np.repeat(offsets[positions] - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+    return new_offsets, flat[cells], None if weights is None else weights[cells]
+
+
+def crop_mapping(window, shape, flat):
+    """
+    Smallest window (row_start, row_stop, col_start, col_stop of the full grid) holding the cells of a mapping
+    of the raster of window (of the given shape), and the flat cell indices in the raster of that window
+    """
+    if len(flat) == 0:
+        return (window[0], window[0] + 1, window[2], window[2] + 1), flat
+    rows, cols = np.divmod(flat.astype(np.int64), shape[1])
+    row_start, col_start = rows.min(), cols.min()
+    n_cols = cols.max() + 1 - col_start
+    cropped = (window[0] + row_start, window[0] + rows.max() + 1, window[2] + col_start, window[2] + col_start + n_cols)
+    return tuple(int(v) for v in cropped), (rows - row_start) * n_cols + (cols - col_start)
+
+
+def map_geometries(cfg, geometries, layer):
+    """
+    Mapping of custom geometries (in the crs of the rasters) to the cells of the grid of a 2d layer.
+    The geometries intersecting the grid are found with an STRtree and only the window covering them is read.
+    Polygons whose geometry is part of a cached mapping of the grid reuse its cells, the others are rasterized.
+    Returns (window, offsets, flat, weights), flat indexing the cells of the raster of window.
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    lat_dim = cfg.satellite_component.latitude_layer
+    lon_dim = cfg.satellite_component.longitude_layer
+    n_rows, n_cols = layer.sizes[lat_dim], layer.sizes[lon_dim]
+    full_transform = grid_transform(layer, cfg)
+    (west, north), (east, south) = full_transform * (0, 0), full_transform * (n_cols, n_rows)
+
+    # == geometries intersecting the grid
+    tree = shapely.STRtree(geometries)
+    inside = np.sort(tree.query(shapely.box(west, min(south, north), east, max(south, north)), predicate="intersects"))
+    if len(inside) < len(geometries):
+        LOGGER.warning(f"{len(geometries) - len(inside)} of {len(geometries)} geometries are outside of the grid.")
+    if len(inside) == 0:
+        return (0, 1, 0, 1), np.zeros(len(geometries) + 1, dtype=np.int64), np.zeros(0, dtype=np.int64), None
+
+    window = grid_window(cfg, layer, shapely.total_bounds(geometries[inside]))
+    indexers, transform = window_indexers(cfg, layer, window)
+    with stage("read_raster"):
+        raster = layer.isel(indexers).values[::-1]
+    windows = bounds_windows(shapely.bounds(geometries[inside]), transform)
+
+    poly2cells = [None] * len(inside)
+    with stage("reuse_cached_cells") as counts:
+        if cfg.mapping_cache.enabled and cfg.mapping_cache.reuse_polygons:
+            is_polygon = np.isin(shapely.get_type_id(geometries[inside]), (3, 6))
+            found = find_cached_cells(
+                cfg.mapping_cache.dir,
+                np.where(is_polygon, hash_geometries(geometries[inside]), ""),
+                windows,
+                transform,
+                np.isnan(raster),
+                all_touched=True,
+            )
+            for i, indices in found.items():
+                poly2cells[i] = indices
+            counts["n_polygons"] = len(found)
+    todo = np.array([i for i, indices in enumerate(poly2cells) if indices is None], dtype=np.int64)
+
+    with stage("mapping_feature", n_polygons=len(todo), n_cells=raster.size):
+        if len(todo):
+            todo_cells = polygon_to_raster_cells_parallel(
+                list(geometries[inside][todo]),
+                raster,
+                affine=transform,
+                all_touched=True,
+                nodata=np.nan,
+                n_jobs=cfg.mapping_workers,
+                chunk_size=cfg.mapping_chunk_size,
+                windows=windows[todo],
+            )
+            for i, indices in zip(todo, todo_cells):
+                poly2cells[i] = indices
+    LOGGER.info(f"Mapped {len(inside)} geometries, {len(inside) - len(todo)} from cached mappings.")
+
+    # the geometries outside of the grid have no cells
+    no_cells = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    cell_map = [no_cells] * len(geometries)
+    for i, indices in zip(inside, poly2cells):
+        cell_map[i] = indices
+    offsets, flat = cells_to_csr(cell_map, raster.shape)
+
+    weights = None
+    if cfg.weighting == "area":
+        weights = polygon_cell_coverage(geometries, offsets, flat, raster.shape, transform)
+    window, flat = crop_mapping(window, raster.shape, flat)
+    return window, offsets, flat, weights
+
+
+def polygon_id_bounds(cfg, shapefile_year):
+    """
+    Bounds (xmin, ymin, xmax, ymax) of the polygons of a shapefile in the crs of the rasters, indexed by id.
+    Read from the bounds columns of the preprocessed file when possible.
+    """
+    shape_path = shapefile_path(cfg, shapefile_year)
+    idvar = cfg.shapefiles[cfg.polygon_name][shapefile_year].idvar
+    bounds = None
+    if cfg.shapefile_cache.enabled:
+        bounds = read_feature_bounds(
+            preprocessed_path(shape_path), shapefile_hash(shape_path), cfg.shapefile_cache.crs, columns=[idvar]
+        )
+    if bounds is None:
+        polygon = load_shapefile(cfg, shape_path)
+        bounds = pd.DataFrame(shapely.bounds(polygon.geometry.values), columns=BOUNDS_COLUMNS)
+        bounds[idvar] = polygon[idvar].values
+    return bounds.set_index(bounds[idvar].astype(str))[BOUNDS_COLUMNS]
+
+
+def map_polygon_ids(cfg, ids, shapefile_year, layer):
+    """
+    Mapping of the polygons of cfg.polygon_name with the given ids to the cells of the grid of a 2d layer.
+    A cached mapping of the shapefile is used when its nodata mask is the one of the layer in the window of
+    the requested polygons (only that window is read), otherwise only the requested polygons are mapped.
+    Returns the ids found in the shapefile and their (window, offsets, flat, weights) as in map_geometries.
+    """
+    lat_dim = cfg.satellite_component.latitude_layer
+    lon_dim = cfg.satellite_component.longitude_layer
+    shape_path = shapefile_path(cfg, shapefile_year)
+    ids = pd.Index(np.asarray(ids).astype(str))
+
+    with stage("read_bounds"):
+        bounds = polygon_id_bounds(cfg, shapefile_year)
+    found = ids[bounds.index.get_indexer(ids) >= 0]
+    if len(found) < len(ids):
+        LOGGER.warning(f"{len(ids) - len(found)} of the {len(ids)} ids are not in {shape_path}.")
+
+    # == cached mapping of the shapefile, for the raster window read by the aggregation jobs
+    cache_key = None
+    if cfg.mapping_cache.enabled and len(found):
+        if cfg.window.enabled:
+            window = grid_window(cfg, layer, polygon_bounds(cfg, shapefile_year))
+        else:
+            window = (0, layer.sizes[lat_dim], 0, layer.sizes[lon_dim])
+        _, transform = window_indexers(cfg, layer, window)
+        shape = (window[1] - window[0], window[3] - window[2])
+
+        # nodata mask of the layer in the window of the requested polygons, compared with the stored masks
+        windows = bounds_windows(bounds.loc[found].to_numpy(), transform)
+        region = (
+            max(int(windows[:, 0].min()), 0),
+            min(int(windows[:, 1].max()), shape[0]),
+            max(int(windows[:, 2].min()), 0),
+            min(int(windows[:, 3].max()), shape[1]),
+        )
+        region_window = (window[0] + region[0], window[0] + region[1], window[2] + region[2], window[2] + region[3])
+        indexers, _ = window_indexers(cfg, layer, region_window)
+        with stage("read_raster"):
+            nodata_mask = np.isnan(layer.isel(indexers).values[::-1])
+        grid_key = polygon_mapping_key(cfg, shapefile_year, transform, shape)
+        with stage("load_mapping_cache"):
+            cache_key = find_grid_mapping(cfg.mapping_cache.dir, grid_key, region, nodata_mask)
+
+    cached = None
+    if cache_key is not None:
+        cached = _mappings.get(cache_key) or load_mapping(cfg.mapping_cache.dir, cache_key)
+        if cached is None:
+            # indexed, but removed or unreadable since
+            LOGGER.warning(f"Could not load the cached mapping {cache_key} of {shape_path}, mapping the polygons.")
+
+    if cached is not None:
+        LOGGER.info(f"Using the cached mapping {cache_key} of {shape_path}.")
+        offsets, flat, polygon_ids = cached[0], cached[1], cached[-1]
+        positions = pd.Index(np.asarray(polygon_ids).astype(str)).get_indexer(found)
+        all_weights = None
+        if cfg.weighting == "area":
+            all_weights = load_weights(cfg.mapping_cache.dir, cache_key, cfg.weighting)
+        offsets, flat, weights = subset_mapping(offsets, flat, positions, all_weights)
+        if cfg.weighting == "area" and weights is None:
+            polygon = load_shapefile(cfg, shape_path)
+            geometries = polygon.geometry.values[polygon_positions(cfg, polygon, shapefile_year, found)]
+            weights = polygon_cell_coverage(geometries, offsets, flat, shape, transform)
+        window, flat = crop_mapping(window, shape, flat)
+        mapping = window, offsets, flat, weights
+    else:
+        polygon = load_shapefile(cfg, shape_path)
+        geometries = polygon.geometry.values[polygon_positions(cfg, polygon, shapefile_year, found)]
+        mapping = map_geometries(cfg, geometries, layer)
+    return found, mapping
+
+
+def polygon_positions(cfg, polygon, shapefile_year, ids):
+    """
+    Positions of the ids in the polygons of a shapefile (-1 for the ids not found)
+    """
+    idvar = cfg.shapefiles[cfg.polygon_name][shapefile_year].idvar
+    return pd.Index(polygon[idvar].astype(str)).get_indexer(pd.Index(np.asarray(ids).astype(str)))
+
+
+def query_component(cfg, component, files, geometries=None, ids=None):
+    """
+    Statistics of a component for the files (year, month, filename) of a query, as a long format dataframe.
+    The custom geometries are mapped once, the ids once per shapefile year. For each file only the
+    window covering the cells of the polygons is read.
+    """
+    layer_name = cfg.satellite_component.component[component].layer
+
+    # files mapped with the same polygons
+    groups = {}
+    for file_year, month, filename in files:
+        key = None
+        if ids is not None:
+            key = available_shapefile_year(file_year, list(cfg.shapefiles[cfg.polygon_name].keys()))
+        groups.setdefault(key, []).append((file_year, month, filename))
+
+    dfs = []
+    for shapefile_year, group in groups.items():
+        cube = open_zarr_cube(cfg, component, group) if cfg.zarr.enabled else None
+        first = cube.isel(time=0) if cube is not None else getattr(open_component_dataset(group[0][2]), layer_name)
+        if ids is None:
+            polygon_ids = geometries.index.values
+            window, offsets, flat, weights = map_geometries(cfg, geometries.geometry.values, first)
+        else:
+            polygon_ids, (window, offsets, flat, weights) = map_polygon_ids(cfg, ids, shapefile_year, first)
+        indexers, _ = window_indexers(cfg, first, window)
+
+        with stage("read_raster"):
+            if cube is not None:
+                block = cube.isel(indexers).values[:, ::-1]
+            else:
+                block = np.stack([
+                    getattr(open_component_dataset(filename), layer_name).isel(indexers).values[::-1]
+                    for _, _, filename in group
+                ])
+        stats = zonal_statistics(block, offsets, flat, cfg.stats, weights)
+        dfs.append(long_format(cfg, component, stats, polygon_ids, [y for y, _, _ in group], [m for _, m, _ in group]))
+    return pd.concat(dfs, ignore_index=True)
+
+
+def query(cfg, geometries_or_ids, components=None, years=None, temporal_freq=None, stats=None, idvar=None):
+    """
+    Statistics of the components for a few polygons, without running the aggregation pipeline.
+    geometries_or_ids is either a list of ids of the polygons of cfg.polygon_name, or custom geometries: a
+    GeoDataFrame (with their ids in the idvar column, or its index), a GeoSeries or a list of shapely geometries
+    in the crs of the rasters. components, years, temporal_freq and stats default to the ones of cfg.
+    Returns a wide dataframe with the id, year, (month) and the statistics of each component.
+    """
+    cfg = cfg.copy()
+    cfg.temporal_freq = temporal_freq or cfg.temporal_freq
+    cfg.stats = list(stats or cfg.stats)
+    validate_stats(cfg.stats)
+    components = list(components or cfg.satellite_component.component.keys())
+    years = list(years or [cfg.year])
+
+    # == requested polygons
+    geometries, ids = None, None
+    if isinstance(geometries_or_ids, (gpd.GeoDataFrame, gpd.GeoSeries)):
+        geometries = gpd.GeoDataFrame(geometry=gpd.GeoSeries(geometries_or_ids.geometry))
+        if idvar is not None:
+            geometries.index = geometries_or_ids[idvar].values
+        geometries = to_raster_crs(geometries, cfg.shapefile_cache.crs)
+        cfg.polygon_name = idvar or geometries_or_ids.index.name or "id"
+    elif len(geometries_or_ids) and isinstance(geometries_or_ids[0], shapely.Geometry):
+        geometries = gpd.GeoDataFrame(geometry=list(geometries_or_ids))
+        cfg.polygon_name = idvar or "id"
+    else:
+        ids = list(geometries_or_ids)
+    n_polygons = len(geometries) if ids is None else len(ids)
+    LOGGER.info(f"Querying {components} {cfg.temporal_freq} {years} for {n_polygons} polygons.")
+
+    tables = []
+    for component in components:
+        component_path = pathlib.Path(f"data/input/pm25_components__randall/{cfg.temporal_freq}/{component}/")
+        files = list_component_files(
+            component_path, cfg.temporal_freq, years, manifest=manifest_path(cfg.temporal_freq, component)
+        )
+        if not files:
+            raise FileNotFoundError(f"No files found for component {component} {cfg.temporal_freq} {years}.")
+        with stage("query", n_files=len(files)):
+            df = query_component(cfg, component, files, geometries, ids)
+        tables.append(pa.Table.from_pandas(df, preserve_index=False))
+
+    return merge_component_tables(tables, components, cfg.polygon_name, cfg.temporal_freq).to_pandas()
+
+
+@hydra.main(config_path="../conf", config_name="config", version_base=None)
+def main(cfg):
+    """
+    Query the statistics of the components for the ids of cfg.query.ids (polygons of polygon_name) or the
+    geometries of the vector file cfg.query.geometries, for temporal_freq, stats and cfg.query.years.
+    """
+    if (cfg.query.ids is None) == (cfg.query.geometries is None):
+        raise ValueError("Set exactly one of query.ids and query.geometries.")
+
+    if cfg.query.geometries is not None:
+        path = cfg.query.geometries
+        polygons = gpd.read_parquet(path) if path.endswith(".parquet") else gpd.read_file(path)
+    else:
+        polygons = [str(i) for i in cfg.query.ids]
+
+    df = query(cfg, polygons, cfg.query.components, cfg.query.years, idvar=cfg.query.idvar)
+
+    if cfg.query.output is None:
+        print(df.to_string(index=False))
+    elif cfg.query.output.endswith(".parquet"):
+        df.to_parquet(cfg.query.output, index=False)
+        LOGGER.info(f"Saved {len(df)} rows to {cfg.query.output}")
+    else:
+        df.to_csv(cfg.query.output, index=False)
+        LOGGER.info(f"Saved {len(df)} rows to {cfg.query.output}")
+
+
+if __name__ == "__main__":
+    main()
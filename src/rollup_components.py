@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import hydra
+import logging
+import os
+
+from utils.instrumentation import stage
+from utils.output_paths import component_output_file
+from utils.output_writer import read_output
+from src.aggregate_components import save_component_output, stat_column
+from src.merge_components import key_columns
+
+
+# configure logger to print at info level
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+def rollup_component(cfg, df, component, level):
+    """
+    Long format dataframe of a component in the coarser geography level, from the sum__<level> and
+    count__<level> columns of the polygons of cfg.polygon_name grouped by the prefix of their ids
+    """
+    prefix_length = cfg.rollup.levels[level]
+    sum_column, count_column = stat_column(component, f"sum__{level}"), stat_column(component, f"count__{level}")
+    if sum_column not in df:
+        raise ValueError(f"{sum_column} is missing, aggregate {cfg.polygon_name} again with rollup.enabled=true.")
+
+    time_columns = key_columns(cfg.polygon_name, cfg.temporal_freq)[1:]
+    ids = df[cfg.polygon_name].astype(str).str[:prefix_length].rename(level)
+    partials = df[[sum_column, count_column]].astype(np.float64)
+    totals = partials.groupby([ids] + [df[c] for c in time_columns], sort=True).sum().reset_index()
+
+    means = np.full(len(totals), np.nan)
+    np.divide(totals[sum_column], totals[count_column], out=means, where=totals[count_column] > 0)
+    rolled = totals[[level] + time_columns].assign(**{component: means})
+    if "count" in cfg.stats:
+        rolled[stat_column(component, "count")] = totals[count_column]
+    return rolled
+
+
+@hydra.main(config_path="../conf", config_name="config", version_base=None)
+def main(cfg):
+    """
+    Write the component files of the coarser geography cfg.rollup.target (e.g. county) for cfg.year (or cfg.years)
+    from the component files of cfg.polygon_name (e.g. census_tract), aggregated with rollup.enabled=true.
+    Only the mean (and the count) can be rolled up. The merged files of the target are written by merge_components.py.
+    """
+    level = cfg.rollup.target
+    if level not in cfg.rollup.levels:
+        raise ValueError(f"Unknown roll-up level {level}, options are {list(cfg.rollup.levels)}.")
+    components = list(cfg.components) if cfg.get("components") else list(cfg.satellite_component.component.keys())
+    years = list(cfg.years) if cfg.get("years") else [cfg.year]
+    LOGGER.info(f"Rolling up {components} {cfg.temporal_freq} from {cfg.polygon_name} to {level} for {years}")
+
+    other_stats = [stat for stat in cfg.stats if stat not in ("mean", "count")]
+    if other_stats:
+        LOGGER.warning(f"Statistics {other_stats} cannot be rolled up, only the mean and count are written.")
+
+    # the outputs are written as if they had been aggregated into the target geography
+    target_cfg = cfg.copy()
+    target_cfg.polygon_name = level
+
+    for year in years:
+        for component in components:
+            path = component_output_file(cfg.temporal_freq, component, cfg.polygon_name, year, cfg.output.layout)
+            if not os.path.exists(path):
+                LOGGER.error(f"Component file not found: {path}")
+                continue
+
+            with stage("read_parquet"):
+                df = read_output(path).to_pandas()
+            with stage("rollup", n_polygons=df[cfg.polygon_name].nunique()):
+                rolled = rollup_component(cfg, df, component, level)
+            save_component_output(target_cfg, component, year, rolled)
+
+
+if __name__ == "__main__":
+    main()
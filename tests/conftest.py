@@ -0,0 +1,142 @@
+# small synthetic grids and polygons shared by the tests. The grids are built like the ones of the
+# component files (cell centers -> rasterio transform), with float32 or float64 coordinates.
+
+import os
+import pathlib
+
+import geopandas as gpd
+import numpy as np
+import pytest
+import rasterio
+import shapely
+import xarray
+from hydra import compose, initialize_config_dir
+
+from utils.component_files import component_path, month_map
+
+CONF_DIR = pathlib.Path(__file__).resolve().parents[1] / "conf"
+
+LON_MIN, LON_MAX, LAT_MIN, LAT_MAX, RESOLUTION = -90.0, -86.0, 35.0, 39.0, 0.01
+
+
+def make_grid(dtype):
+    """
+    Affine transform and (rows, cols) of a grid with cell center coordinates of the given dtype
+    """
+    lat, lon = make_coordinates(dtype)
+    transform = rasterio.transform.from_origin(lon[0], lat[-1], lon[1] - lon[0], lat[1] - lat[0])
+    return transform, (lat.size, lon.size)
+
+
+def make_coordinates(dtype="float64"):
+    lon = np.arange(LON_MIN + RESOLUTION / 2, LON_MAX, RESOLUTION).astype(dtype)
+    lat = np.arange(LAT_MIN + RESOLUTION / 2, LAT_MAX, RESOLUTION).astype(dtype)
+    return lat, lon
+
+
+def make_layer(values, dtype="float64"):
+    """
+    (lat, lon) layer as in the component files (ascending latitudes) of a raster whose first row is the northernmost
+    """
+    lat, lon = make_coordinates(dtype)
+    return xarray.DataArray(np.asarray(values)[::-1], coords={"lat": lat, "lon": lon}, dims=("lat", "lon"))
+
+
+def make_raster(shape, seed=1, nodata_rows=20):
+    """
+    Random float32 raster with a block of nodata (NaN) rows
+    """
+    raster = np.random.default_rng(seed).random(shape, dtype="float32")
+    raster[:nodata_rows] = np.nan
+    return raster
+
+
+def make_polygons(n_polygons, seed=0, bounds=(LON_MIN, LAT_MIN, LON_MAX, LAT_MAX)):
+    """
+    Voronoi tessellation of bounds (a partition, as census geographies)
+    """
+    rng = np.random.default_rng(seed)
+    extent = shapely.box(*bounds)
+    points = shapely.points(rng.uniform(bounds[0], bounds[2], n_polygons), rng.uniform(bounds[1], bounds[3], n_polygons))
+    cells = shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(points), extend_to=extent))
+    return shapely.intersection(cells, extent)
+
+
+@pytest.fixture(params=["float32", "float64"])
+def grid(request):
+    transform, shape = make_grid(request.param)
+    return transform, make_raster(shape)
+
+
+@pytest.fixture(scope="session")
+def polygons():
+    return make_polygons(2000)
+
+
+def same_cells(cell_map, other):
+    """
+    Positions of the features whose cells differ between two cell maps
+    """
+    return [
+        i for i, (a, b) in enumerate(zip(cell_map, other))
+        if not (np.array_equal(a[0], b[0]) and np.array_equal(a[1], b[1]))
+    ]
+
+
+@pytest.fixture
+def cfg():
+    """
+    Project config, with the polygons kept in EPSG:4269 (the crs of the test shapefiles)
+    """
+    with initialize_config_dir(config_dir=str(CONF_DIR), version_base=None):
+        return compose("config", overrides=["polygon_name=county", "shapefile_cache.crs=EPSG:4269"])
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """
+    Empty working directory (the data/ paths are relative), with the in-process caches of the aggregation cleared
+    """
+    from src import aggregate_components
+
+    monkeypatch.chdir(tmp_path)
+    for cache in (
+        aggregate_components._shapefiles,
+        aggregate_components._shapefile_metadata,
+        aggregate_components._shapefile_hashes,
+        aggregate_components._mappings,
+        aggregate_components._weights,
+        aggregate_components._ownership,
+    ):
+        cache.clear()
+    return tmp_path
+
+
+def write_shapefile(cfg, shapefile_year, geometries, ids=None, crs="EPSG:4269"):
+    """
+    Write polygons (given in EPSG:4269) as the shapefile of cfg.polygon_name for shapefile_year, in crs
+    """
+    idvar = cfg.shapefiles[cfg.polygon_name][shapefile_year].idvar
+    ids = ids if ids is not None else [f"{i:05d}" for i in range(len(geometries))]
+    polygon = gpd.GeoDataFrame({idvar: ids}, geometry=list(geometries), crs="EPSG:4269").to_crs(crs)
+    path = f"data/input/shapefiles/shapefile_{cfg.polygon_name}_{shapefile_year}/shapefile.shp"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    polygon.to_file(path)
+    return path
+
+
+def write_component_files(cfg, component, temporal_freq, year, rasters):
+    """
+    Write rasters (first row northernmost) as the netcdf files of a component for a year, with float32 coordinates as
+    in the component files: one yearly file, or one file per month from January for monthly data
+    """
+    layer = cfg.satellite_component.component[component].layer
+    directory = component_path(temporal_freq, component)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for raster, month in zip(rasters, month_map):
+        period = f"{year}-{year}-{month}" if temporal_freq == "monthly" else f"{year}001-{year}365"
+        path = f"{directory}V5NA05.02.Hybrid{component.upper()}-{component.upper()}.NorthAmerica.{period}.nc"
+        make_layer(raster, "float32").to_dataset(name=layer).to_netcdf(path)
+        paths.append(path)
+    return paths
@@ -0,0 +1,43 @@
+import logging
+
+import pandas as pd
+from omegaconf import OmegaConf
+
+from tests.conftest import make_polygons, make_raster, write_component_files, write_shapefile
+from src import aggregate_batch
+from src.aggregate_components import aggregate_component, component_output_path
+from utils.output_writer import read_output
+
+items = [
+    {"component": "so4", "temporal_freq": "monthly", "year": 2015, "polygon_name": "county"},
+    {"component": "no3", "temporal_freq": "yearly", "year": 2015, "polygon_name": "county"},
+]
+
+
+def item_output(cfg, item):
+    item_cfg = OmegaConf.merge(cfg, item)
+    return read_output(component_output_path(item_cfg, item["component"], item["year"])).to_pandas()
+
+
+def test_batch_items_match_single_jobs(cfg, workdir, caplog):
+    # info messages, as configured by hydra in the jobs
+    caplog.set_level(logging.INFO)
+    write_shapefile(cfg, 2015, make_polygons(50))
+    write_component_files(cfg, "no3", "yearly", 2015, [make_raster((400, 400))])
+    write_component_files(cfg, "so4", "monthly", 2015, [make_raster((400, 400), seed=s) for s in range(2, 4)])
+    pd.DataFrame(items).to_csv("items.csv", index=False)
+    cfg.batch.items_file = "items.csv"
+
+    # each item runs with its own component, frequency and year, and logs to its own file
+    aggregate_batch.main(cfg)
+    batch_outputs = [item_output(cfg, item) for item in items]
+    messages = [f"Running aggregation for: {item['component']} {item['temporal_freq']} county [2015]" for item in items]
+    for item in items:
+        with open(aggregate_batch.item_log_path(cfg, item)) as f:
+            log = f.read()
+        assert [message in log for message in messages] == [other is item for other in items]
+
+    # same outputs as the jobs run one at a time
+    for item, batch_output in zip(items, batch_outputs):
+        assert aggregate_component(OmegaConf.merge(cfg, item))
+        pd.testing.assert_frame_equal(batch_output, item_output(cfg, item))
@@ -0,0 +1,112 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from omegaconf import OmegaConf
+
+from tests.conftest import make_layer, make_polygons, make_raster, write_component_files, write_shapefile
+from src import ingest_zarr
+from src.aggregate_components import (
+    aggregate_component,
+    component_output_path,
+    grid_window,
+    polygon_mapping_key,
+    polygon_window,
+    save_component_output,
+    shapefile_hash,
+    upsert_slices,
+)
+from utils.output_writer import read_output
+from utils.shapefile_cache import preprocessed_path, write_preprocessed
+
+
+def test_window_covers_reprojected_polygons(cfg, workdir):
+    layer = make_layer(make_raster((400, 400)))
+    # projected shapefile, reprojected to EPSG:4269 when loaded
+    path = write_shapefile(cfg, 2015, make_polygons(50, bounds=(-89, 36, -87, 38)), crs="EPSG:3857")
+    expected = grid_window(cfg, layer, gpd.read_file(path).to_crs("EPSG:4269").total_bounds)
+
+    indexers, _ = polygon_window(cfg, 2015, layer)
+    assert (indexers["lat"].start, indexers["lat"].stop) == (400 - expected[1], 400 - expected[0])
+    assert (indexers["lon"].start, indexers["lon"].stop) == (expected[2], expected[3])
+
+    # same window from the bounds of the preprocessed file
+    polygon = gpd.read_file(path).to_crs("EPSG:4269")
+    write_preprocessed(polygon, preprocessed_path(path), "GEOID", shapefile_hash(path))
+    assert polygon_window(cfg, 2015, layer)[0] == indexers
+
+
+def test_mapping_key_depends_on_crs(cfg, workdir):
+    write_shapefile(cfg, 2015, make_polygons(10))
+    raster, transform = np.zeros((4, 4)), (1, 0, 0, 0, -1, 0)
+    key = polygon_mapping_key(cfg, 2015, transform, raster.shape, raster)
+    cfg.shapefile_cache.crs = "EPSG:4326"
+    assert polygon_mapping_key(cfg, 2015, transform, raster.shape, raster) != key
+
+
+def monthly_frame(months, value):
+    return pd.DataFrame({
+        "no3": value + np.arange(3 * len(months), dtype=np.float64),
+        "year": 2015,
+        "county": np.tile(["00000", "00001", "00002"], len(months)),
+        "month": np.repeat(months, 3),
+    })
+
+
+def test_upsert_replaces_recomputed_months(cfg, workdir):
+    cfg.temporal_freq = "monthly"
+    existing = monthly_frame([1, 2, 3], 0)
+    save_component_output(cfg, "no3", 2015, existing)
+
+    # month 2 recomputed and month 4 added: the rows of a full run, in time order
+    recomputed = pd.concat([monthly_frame([2], 100), monthly_frame([4], 200)], ignore_index=True)
+    upserted = upsert_slices(cfg, component_output_path(cfg, "no3", 2015), recomputed, {"2015-02", "2015-04"})
+    expected = pd.concat([existing[existing.month == 1], recomputed[:3], existing[existing.month == 3], recomputed[3:]])
+    pd.testing.assert_frame_equal(upserted[existing.columns], expected.reset_index(drop=True), check_dtype=False)
+
+
+def write_monthly_inputs(cfg, n_months=3):
+    write_shapefile(cfg, 2015, make_polygons(50))
+    rasters = [make_raster((400, 400), seed=seed) for seed in range(1, n_months + 1)]
+    write_component_files(cfg, "no3", "monthly", 2015, rasters)
+    cfg.temporal_freq, cfg.component, cfg.year = "monthly", "no3", 2015
+
+
+def aggregated_output(cfg, overrides=None):
+    """
+    Output of aggregate_component with the config overrides ({dotted key: value}), sorted by time and polygon
+    """
+    cfg = cfg.copy()
+    for key, value in (overrides or {}).items():
+        OmegaConf.update(cfg, key, value, force_add=True)
+    assert aggregate_component(cfg)
+    df = read_output(component_output_path(cfg, cfg.component, cfg.year)).to_pandas()
+    return df.sort_values(["year", "month", cfg.polygon_name], ignore_index=True)
+
+
+def test_cube_matches_per_file_aggregation(cfg, workdir):
+    write_monthly_inputs(cfg)
+    expected = aggregated_output(cfg)
+    assert len(expected) == 3 * 50 and expected["no3"].notna().any()
+    # blocks of two rasters, so that the last block is partial
+    output = aggregated_output(cfg, {"cube.enabled": True, "cube.time_chunk": 2})
+    pd.testing.assert_frame_equal(output, expected)
+
+
+def test_zarr_store_matches_component_files(cfg, workdir):
+    write_monthly_inputs(cfg)
+    expected = aggregated_output(cfg)
+    ingest_zarr.main(cfg)
+    pd.testing.assert_frame_equal(aggregated_output(cfg, {"zarr.enabled": True}), expected)
+
+
+def test_streamed_output_matches_in_memory_output(cfg, workdir):
+    write_monthly_inputs(cfg)
+    expected = aggregated_output(cfg)
+    path = component_output_path(cfg, "no3", 2015)
+    schema = pq.read_schema(path)
+
+    for overrides in ({}, {"cube.enabled": True, "cube.time_chunk": 2}):
+        output = aggregated_output(cfg, {"streaming.enabled": True, **overrides})
+        assert pq.read_schema(path).remove_metadata() == schema.remove_metadata()
+        pd.testing.assert_frame_equal(output, expected)
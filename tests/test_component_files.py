@@ -0,0 +1,39 @@
+import logging
+import os
+
+from tests.conftest import make_raster, write_component_files
+from src import build_manifest
+from utils.component_files import component_path, list_component_files, manifest_path, scan_component_files, write_manifest
+
+
+def manifest_entry(year, month, path):
+    return {"year": year, "month": month, "path": path, "size": 0, "mtime": 0, "grid_signature": "grid"}
+
+
+def test_new_year_missing_from_manifest_is_scanned(cfg, workdir):
+    write_component_files(cfg, "no3", "yearly", 2015, [make_raster((400, 400))])
+    manifest = manifest_path("yearly", "no3")
+    write_manifest(manifest, [manifest_entry(2014, None, "no3_2014.nc")])
+
+    # the manifest was built before the files of 2015 were added
+    files = list_component_files(component_path("yearly", "no3"), "yearly", [2015], manifest=manifest)
+    assert files == scan_component_files(component_path("yearly", "no3"), "yearly") != []
+
+
+def test_manifest_lists_the_scanned_files(cfg, workdir, caplog):
+    for year in (2014, 2015):
+        write_component_files(cfg, "no3", "monthly", year, [make_raster((400, 400), seed=s) for s in range(1, 4)])
+    cfg.component, cfg.temporal_freq = "no3", "monthly"
+    build_manifest.main(cfg)
+    assert os.path.exists(manifest_path("monthly", "no3"))
+
+    path = component_path("monthly", "no3")
+    for years in ([2015], [2014, 2015]):
+        expected = sorted(
+            (f for f in scan_component_files(path, "monthly") if f[0] in years), key=lambda f: (f[0], f[1])
+        )
+        assert len(expected) == 3 * len(years)
+        with caplog.at_level(logging.WARNING):
+            assert list_component_files(path, "monthly", years, manifest=manifest_path("monthly", "no3")) == expected
+        # found in the manifest, without scanning the directory
+        assert "scanning" not in caplog.text
@@ -0,0 +1,157 @@
+import hashlib
+import http.server
+import os
+import pathlib
+import shutil
+import socket
+import threading
+import zipfile
+
+import pytest
+
+from utils.downloads import HttpFetcher, download, extract_zip, verify_file
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None, body=b""):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.body = body
+
+    def close(self):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise OSError(f"status {self.status_code}")
+
+    def iter_content(self, chunk_size):
+        yield self.body
+
+
+def fetcher_returning(response):
+    fetcher = HttpFetcher()
+    fetcher.session.get = lambda url, headers=None, stream=True, timeout=None: response
+    return fetcher
+
+
+@pytest.mark.parametrize("headers,size", [({}, None), ({}, 5), ({"Content-Range": "bytes */5"}, None)])
+def test_complete_partial_download_is_kept(tmp_path, headers, size):
+    path = tmp_path / "archive.zip"
+    (tmp_path / "archive.zip.part").write_bytes(b"12345")
+    download(fetcher_returning(FakeResponse(416, headers)), "http://host/archive.zip", str(path), size=size)
+    assert path.read_bytes() == b"12345"
+
+
+def test_partial_download_of_another_size_is_removed(tmp_path):
+    path = tmp_path / "archive.zip"
+    (tmp_path / "archive.zip.part").write_bytes(b"12345")
+    with pytest.raises(ValueError):
+        download(fetcher_returning(FakeResponse(416)), "http://host/archive.zip", str(path), size=6)
+    assert not os.path.exists(f"{path}.part")
+
+
+def test_resumed_download(tmp_path):
+    path = tmp_path / "archive.zip"
+    (tmp_path / "archive.zip.part").write_bytes(b"123")
+    response = FakeResponse(206, {"Content-Range": "bytes 3-4/5"}, b"45")
+    download(fetcher_returning(response), "http://host/archive.zip", str(path))
+    assert path.read_bytes() == b"12345"
+
+
+class ArchiveHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the files of the directory of the server with range requests, and drops the connection half way
+    through the first response of each file
+    """
+
+    def do_GET(self):
+        path = os.path.join(self.server.directory, self.path.lstrip("/"))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        start = int(self.headers["Range"].split("=")[1].split("-")[0]) if "Range" in self.headers else 0
+        self.server.requests.append((self.path, self.headers.get("Range")))
+        if start >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.end_headers()
+            return
+        if start:
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(size - start))
+        self.end_headers()
+
+        with open(path, "rb") as f:
+            f.seek(start)
+            data = f.read()
+        if self.path not in self.server.dropped:
+            self.server.dropped.add(self.path)
+            self.wfile.write(data[:len(data) // 2])
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def archive_server(tmp_path):
+    """
+    Url of a local http server of a zip archive (archive.zip, with its members and sha256 on the server)
+    """
+    directory = tmp_path / "server"
+    directory.mkdir()
+    members = {"a.nc": os.urandom(300_000), "b.nc": os.urandom(100_000)}
+    with zipfile.ZipFile(directory / "archive.zip", "w") as archive:
+        for name, data in members.items():
+            archive.writestr(f"folder/{name}", data)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ArchiveHandler)
+    server.directory = str(directory)
+    server.requests = []
+    server.dropped = set()
+    server.members = members
+    server.sha256 = hashlib.sha256((directory / "archive.zip").read_bytes()).hexdigest()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, f"http://127.0.0.1:{server.server_port}/archive.zip"
+    server.shutdown()
+    server.server_close()
+
+
+def test_dropped_connection_is_resumed(tmp_path, archive_server):
+    server, url = archive_server
+    path = tmp_path / "download" / "archive.zip"
+    download(HttpFetcher(timeout=10), url, str(path), sha256=server.sha256)
+
+    # the second request resumes at the chunks written before the connection was dropped
+    (_, first), (_, second) = server.requests
+    assert first is None and 0 < int(second[len("bytes="):-1]) <= os.path.getsize(path) // 2
+    assert not os.path.exists(f"{path}.part")
+    verify_file(str(path), size=os.path.getsize(os.path.join(server.directory, "archive.zip")), sha256=server.sha256)
+
+    paths = extract_zip(str(path), str(tmp_path / "files"))
+    assert {os.path.basename(p): pathlib.Path(p).read_bytes() for p in paths} == server.members
+
+
+def test_complete_part_file_is_verified(tmp_path, archive_server):
+    server, url = archive_server
+    path = tmp_path / "archive.zip"
+    shutil.copy(os.path.join(server.directory, "archive.zip"), f"{path}.part")
+    download(HttpFetcher(timeout=10), url, str(path), sha256=server.sha256)
+    assert server.requests[-1][1] == f"bytes={os.path.getsize(path)}-"
+
+    # a part file of the right size but other contents is removed
+    shutil.copy(path, f"{path}.part")
+    with open(f"{path}.part", "r+b") as f:
+        f.write(b"corrupted")
+    with pytest.raises(ValueError, match="sha256"):
+        download(HttpFetcher(timeout=10), url, str(path), sha256=server.sha256)
+    assert not os.path.exists(f"{path}.part")
@@ -0,0 +1,133 @@
+import warnings
+
+import numpy as np
+import shapely
+from rasterstats.io import bounds_window
+
+from tests.conftest import make_grid, make_polygons, make_raster, same_cells
+from utils.faster_zonal_stats import (
+    bounds_windows,
+    polygon_cell_coverage,
+    polygon_to_raster_cells,
+    polygon_to_raster_cells_layer,
+    polygon_to_raster_cells_parallel,
+    zonal_means,
+    zonal_statistics,
+)
+from utils.mapping_cache import cells_to_csr
+
+
+def test_bounds_windows_match_rasterstats(grid, polygons):
+    transform, _ = grid
+    expected = np.array([sum(bounds_window(tuple(p.bounds), transform), ()) for p in polygons])
+    np.testing.assert_array_equal(bounds_windows(shapely.bounds(polygons), transform), expected)
+
+
+def test_precomputed_windows_give_same_cells(grid, polygons):
+    transform, raster = grid
+    geometries = list(polygons)
+    kwargs = dict(affine=transform, all_touched=True, nodata=np.nan)
+    expected = polygon_to_raster_cells(geometries, raster, **kwargs)
+    windows = bounds_windows(shapely.bounds(polygons), transform)
+    assert same_cells(polygon_to_raster_cells(geometries, raster, windows=windows, **kwargs), expected) == []
+
+
+def test_backends_give_same_cells(grid, polygons):
+    transform, raster = grid
+    geometries = list(polygons)
+    kwargs = dict(affine=transform, all_touched=True, nodata=np.nan)
+    expected = polygon_to_raster_cells(geometries, raster, **kwargs)
+    windows = bounds_windows(shapely.bounds(polygons), transform)
+
+    assert same_cells(polygon_to_raster_cells_layer(geometries, raster, **kwargs), expected) == []
+    assert same_cells(polygon_to_raster_cells_layer(geometries, raster, windows=windows, **kwargs), expected) == []
+    parallel = polygon_to_raster_cells_parallel(geometries, raster, n_jobs=2, chunk_size=300, windows=windows, **kwargs)
+    assert same_cells(parallel, expected) == []
+
+
+def nanmean_loop(raster, cell_map, dtype):
+    """
+    Means of the per-polygon np.nanmean loop of the previous versions, computed in dtype
+    """
+    # polygons without valid cells warn of an empty slice
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.array([np.nanmean(raster[rows, cols].astype(dtype)) for rows, cols in cell_map])
+
+
+def test_segment_means_match_nanmean_loop(polygons):
+    transform, shape = make_grid("float64")
+    raster = make_raster(shape)
+    cell_map = polygon_to_raster_cells(list(polygons), raster, affine=transform, all_touched=True, nodata=np.nan)
+    offsets, flat = cells_to_csr(cell_map, shape)
+
+    means = zonal_means(raster, offsets, flat)
+    # accumulated in float64: the loop over the cells converted to float64, up to the order of the additions
+    np.testing.assert_allclose(means, nanmean_loop(raster, cell_map, np.float64), rtol=1e-12, equal_nan=True)
+
+    # the previous versions accumulated the float32 cells in float32 (np.nanmean of the float32 rasters): the
+    # means stored as float32 differ from theirs by a few float32 ulps (up to 2.6e-7 relative on these rasters)
+    np.testing.assert_allclose(
+        means.astype(np.float32), nanmean_loop(raster, cell_map, np.float32), rtol=4 * np.finfo(np.float32).eps
+    )
+
+
+def test_statistics_match_nan_functions(polygons):
+    transform, shape = make_grid("float64")
+    raster = make_raster(shape)
+    cell_map = polygon_to_raster_cells(list(polygons), raster, affine=transform, all_touched=True, nodata=np.nan)
+    # a polygon on the nodata rows only and one without cells
+    cell_map += [(np.arange(5), np.arange(5)), (np.array([], dtype=int), np.array([], dtype=int))]
+    offsets, flat = cells_to_csr(cell_map, shape)
+
+    stats = ("mean", "std", "min", "max", "count", "median", "p0", "p10", "p95", "p100")
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        results = zonal_statistics(raster, offsets, flat, stats)
+
+    functions = {
+        "mean": np.nanmean,
+        "std": np.nanstd,
+        "min": np.nanmin,
+        "max": np.nanmax,
+        "count": lambda values: np.count_nonzero(~np.isnan(values)),
+        "median": np.nanmedian,
+        "p0": lambda values: np.nanpercentile(values, 0),
+        "p10": lambda values: np.nanpercentile(values, 10),
+        "p95": lambda values: np.nanpercentile(values, 95),
+        "p100": lambda values: np.nanpercentile(values, 100),
+    }
+    for stat, function in functions.items():
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            # the nan* reductions raise on polygons without cells
+            empty = 0 if stat == "count" else np.nan
+            expected = np.array([
+                function(raster[rows, cols].astype(np.float64)) if len(rows) else empty for rows, cols in cell_map
+            ])
+        np.testing.assert_allclose(results[stat], expected, rtol=1e-12, equal_nan=True, err_msg=stat)
+    assert np.isnan([results[s][-2:] for s in stats if s != "count"]).all()
+
+
+def test_area_weighted_means_match_cell_intersections():
+    transform, shape = make_grid("float64")
+    raster = make_raster(shape)
+    polygons = make_polygons(30)
+    cell_map = polygon_to_raster_cells(list(polygons), raster, affine=transform, all_touched=True, nodata=np.nan)
+    offsets, flat = cells_to_csr(cell_map, shape)
+    weights = polygon_cell_coverage(list(polygons), offsets, flat, shape, transform)
+
+    # covered fraction of each cell from the intersection of the polygon with the box of the cell
+    expected_means = []
+    for polygon, (rows, cols), start in zip(polygons, cell_map, offsets):
+        x, y = transform * (cols, rows)
+        cells = shapely.box(x, y + transform.e, x + transform.a, y)
+        fractions = shapely.area(shapely.intersection(polygon, cells)) / shapely.area(cells)
+        np.testing.assert_allclose(weights[start:start + len(rows)], fractions, atol=1e-6)
+
+        values = raster[rows, cols].astype(np.float64)
+        valid = ~np.isnan(values)
+        expected_means.append(np.average(values[valid], weights=fractions[valid]) if valid.any() else np.nan)
+
+    means = zonal_means(raster, offsets, flat, weights)
+    np.testing.assert_allclose(means, expected_means, rtol=1e-6, equal_nan=True)
@@ -0,0 +1,90 @@
+import logging
+
+import numpy as np
+import shapely
+from affine import Affine
+
+from tests.conftest import make_layer, make_polygons, make_raster, same_cells, write_shapefile
+from src.aggregate_components import _mappings, get_polygon_mapping, polygon_window
+from utils.faster_zonal_stats import polygon_to_raster_cells
+from utils.instrumentation import _stages
+from utils.mapping_cache import cells_to_csr, csr_to_cells, find_cached_cells, hash_geometries, save_mapping
+
+
+def polygon_mapping(cfg, shapefile_year, layer):
+    indexers, transform = polygon_window(cfg, shapefile_year, layer)
+    raster = layer.isel(indexers).values[::-1]
+    return get_polygon_mapping(cfg, shapefile_year, raster, transform)
+
+
+def test_cached_mapping_round_trip(cfg, workdir):
+    layer = make_layer(make_raster((400, 400)))
+    polygons = make_polygons(200)
+    write_shapefile(cfg, 2015, polygons)
+    indexers, transform = polygon_window(cfg, 2015, layer)
+    raster = layer.isel(indexers).values[::-1]
+    # cells of the per-polygon rasterization of the previous versions
+    expected = polygon_to_raster_cells(list(polygons), raster, affine=transform, all_touched=True, nodata=np.nan)
+    assert same_cells(csr_to_cells(*cells_to_csr(expected, raster.shape), raster.shape), expected) == []
+
+    built = polygon_mapping(cfg, 2015, layer)
+    _mappings.clear()
+    _stages.clear()
+    loaded = polygon_mapping(cfg, 2015, layer)
+    assert "load_mapping_cache" in _stages and "reuse_cached_cells" not in _stages
+    for array, other in zip(built[:3], loaded[:3]):
+        np.testing.assert_array_equal(array, other)
+    assert same_cells(csr_to_cells(loaded[0], loaded[1], raster.shape), expected) == []
+    assert list(loaded[2]) == [f"{i:05d}" for i in range(len(polygons))]
+
+
+def test_cached_mapping_keeps_id_dtype(cfg, workdir):
+    layer = make_layer(make_raster((400, 400)))
+    polygons = make_polygons(50)
+    write_shapefile(cfg, 2015, polygons, ids=np.arange(len(polygons)) * 10)
+
+    built = polygon_mapping(cfg, 2015, layer)
+    _mappings.clear()
+    loaded = polygon_mapping(cfg, 2015, layer)
+    assert loaded[2].dtype == built[2].dtype and loaded[2].dtype.kind == "i"
+    np.testing.assert_array_equal(loaded[2], built[2])
+
+
+def test_reused_cells_equal_fresh_mapping(cfg, workdir):
+    layer = make_layer(make_raster((400, 400)))
+    polygons = make_polygons(200)
+    write_shapefile(cfg, 2014, polygons)
+    polygon_mapping(cfg, 2014, layer)
+
+    # next vintage: a changed polygon and fewer polygons, so that the window of the raster moves
+    vintage = list(polygons[20:150]) + [shapely.buffer(polygons[150], 0.01)]
+    write_shapefile(cfg, 2015, vintage)
+    _stages.clear()
+    offsets, flat, polygon_ids, _ = polygon_mapping(cfg, 2015, layer)
+    assert _stages["reuse_cached_cells"]["counts"]["n_polygons"] > 100
+
+    _mappings.clear()
+    cfg.mapping_cache.reuse_polygons = False
+    cfg.mapping_cache.dir = "fresh_cache"
+    expected = polygon_mapping(cfg, 2015, layer)
+    np.testing.assert_array_equal(offsets, expected[0])
+    np.testing.assert_array_equal(flat, expected[1])
+    np.testing.assert_array_equal(polygon_ids, expected[2])
+
+
+def test_mappings_without_shared_geometries_are_not_opened(workdir, caplog):
+    polygons = make_polygons(20, bounds=(0, 0, 10, 10))
+    kwargs = dict(affine=Affine(1.0, 0.0, 0.0, 0.0, -1.0, 10.0), nodata_mask=np.zeros((10, 10), bool), all_touched=True)
+    offsets, flat = np.zeros(11, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    save_mapping("cache", "a", offsets, flat, (10, 10), np.arange(10), geometry_hashes=hash_geometries(polygons[:10]), **kwargs)
+    # a broken mapping is reported when it is opened
+    with open("cache/poly2cells_a.npz", "wb") as f:
+        f.write(b"broken")
+
+    with caplog.at_level(logging.WARNING):
+        windows = np.tile([0, 10, 0, 10], (10, 1))
+        assert find_cached_cells("cache", hash_geometries(polygons[10:]), windows, **kwargs) == {}
+    assert "Could not read mapping cache" not in caplog.text
+    with caplog.at_level(logging.WARNING):
+        find_cached_cells("cache", hash_geometries(polygons[:10]), windows, **kwargs)
+    assert "Could not read mapping cache" in caplog.text
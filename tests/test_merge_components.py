@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from src.merge_components import merge_component_tables
+
+
+def component_tables(components, n_polygons=30, months=(1, 2, 3), seed=0):
+    rng = np.random.default_rng(seed)
+    ids = [f"{i:05d}" for i in range(n_polygons)]
+    frames = {}
+    for component in components:
+        df = pd.DataFrame({
+            component: rng.random(n_polygons * len(months)),
+            "year": 2015,
+            "county": np.tile(ids, len(months)),
+            "month": np.repeat(months, n_polygons),
+        })
+        df.loc[::7, component] = np.nan
+        frames[component] = df
+    return frames
+
+
+def outer_merge(frames):
+    """
+    Merged dataframe of the previous versions: outer joins on the keys, components in alphabetical order
+    """
+    merged = None
+    for component, df in frames.items():
+        merged = df if merged is None else merged.merge(df, on=["year", "county", "month"], how="outer")
+    return merged[["county", "year", "month"] + sorted(frames)]
+
+
+def test_stacked_and_joined_merges_match_outer_merge():
+    frames = component_tables(["so4", "no3", "bc"])
+    expected = outer_merge(frames).sort_values(["county", "year", "month"], ignore_index=True)
+    keys = ["county", "year", "month"]
+
+    # aligned keys: the component columns are stacked
+    tables = [pa.Table.from_pandas(df, preserve_index=False) for df in frames.values()]
+    stacked = merge_component_tables(tables, frames, "county", "monthly").to_pandas()
+    pd.testing.assert_frame_equal(stacked.sort_values(keys, ignore_index=True), expected, check_dtype=False)
+
+    # rows in another order and a missing polygon: outer join
+    frames["no3"] = frames["no3"].sample(frac=1, random_state=0)
+    frames["bc"] = frames["bc"][frames["bc"].county != "00003"]
+    tables = [pa.Table.from_pandas(df, preserve_index=False) for df in frames.values()]
+    joined = merge_component_tables(tables, frames, "county", "monthly").to_pandas()
+    expected = outer_merge(frames).sort_values(keys, ignore_index=True)
+    pd.testing.assert_frame_equal(joined.sort_values(keys, ignore_index=True), expected, check_dtype=False)
+    assert joined.loc[joined.county == "00003", "bc"].isna().all()
@@ -0,0 +1,64 @@
+import pathlib
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from omegaconf import open_dict
+
+from tests.conftest import make_polygons, make_raster, write_component_files, write_shapefile
+from src.aggregate_components import aggregate_component, save_component_output
+from utils.output_writer import read_output
+
+# outputs of aggregate_components.py before the optimizations, for the inputs of test_default_output_matches_baseline
+BASELINE_DIR = pathlib.Path(__file__).resolve().parent / "data" / "baseline"
+
+
+def component_frame():
+    return pd.DataFrame({
+        "no3": [1.5, 2.5, 3.5, 4.5],
+        "year": [2015] * 4,
+        "county": ["00002", "00001", "00002", "00001"],
+        "month": [1, 1, 2, 2],
+    })
+
+
+@pytest.mark.parametrize("temporal_freq,n_files", [("yearly", 1), ("monthly", 3)])
+def test_default_output_matches_baseline(cfg, workdir, temporal_freq, n_files):
+    write_shapefile(cfg, 2015, make_polygons(50))
+    rasters = [make_raster((400, 400), seed=seed) for seed in range(1, n_files + 1)]
+    write_component_files(cfg, "no3", temporal_freq, 2015, rasters)
+    cfg.temporal_freq, cfg.component, cfg.year = temporal_freq, "no3", 2015
+    assert aggregate_component(cfg)
+
+    name = f"no3__county_{temporal_freq}_2015.parquet"
+    output = pq.read_table(f"data/intermediate/pm25_components__randall/{temporal_freq}/no3/{name}")
+    baseline = pq.read_table(BASELINE_DIR / name)
+    assert output.schema.remove_metadata() == baseline.schema.remove_metadata()
+
+    # the baseline months are in the order of the directory listing. The means are computed in float64 and
+    # rounded to float32, the float32 np.nanmean of the baseline can differ in the last bits
+    keys = ["year", "month", "county"] if temporal_freq == "monthly" else ["county"]
+    pd.testing.assert_frame_equal(
+        output.to_pandas().sort_values(keys, ignore_index=True),
+        baseline.to_pandas().sort_values(keys, ignore_index=True),
+        rtol=1e-6,
+    )
+
+
+def test_compact_hive_output_is_opt_in(cfg, workdir):
+    cfg.temporal_freq = "monthly"
+    with open_dict(cfg):
+        cfg.output.layout = "hive"
+        cfg.output.compact = True
+        cfg.output.float32 = True
+    save_component_output(cfg, "no3", 2015, component_frame())
+
+    path = "data/intermediate/pm25_components__randall/monthly/no3/county/year=2015/part-0.parquet"
+    schema = pq.read_schema(path)
+    assert pa.types.is_dictionary(schema.field("county").type)
+    assert schema.field("month").type == pa.int8()
+    assert schema.field("no3").type == pa.float32()
+    table = read_output(path)
+    assert table.column("county").to_pylist() == ["00001", "00001", "00002", "00002"]
+    assert table.column("year").to_pylist() == [2015] * 4
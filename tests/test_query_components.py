@@ -0,0 +1,58 @@
+import logging
+
+import numpy as np
+
+from tests.conftest import make_layer, make_polygons, make_raster, write_shapefile
+from tests.test_mapping_cache import polygon_mapping
+from src.aggregate_components import _mappings, window_indexers
+from src import query_components
+from src.query_components import map_geometries, map_polygon_ids
+from utils.faster_zonal_stats import zonal_means
+
+
+def query_means(cfg, layer, mapping):
+    window, offsets, flat, weights = mapping
+    indexers, _ = window_indexers(cfg, layer, window)
+    return zonal_means(layer.isel(indexers).values[::-1], offsets, flat, weights)
+
+
+def test_polygon_ids_use_cached_mapping(cfg, workdir, caplog):
+    layer = make_layer(make_raster((400, 400)))
+    write_shapefile(cfg, 2015, make_polygons(200))
+    offsets, flat, polygon_ids, _ = polygon_mapping(cfg, 2015, layer)
+    expected = zonal_means(layer.values[::-1], offsets, flat)
+
+    ids = ["00003", "00150", "00042", "99999"]
+    _mappings.clear()
+    with caplog.at_level(logging.INFO):
+        found, mapping = map_polygon_ids(cfg, ids, 2015, layer)
+    assert "Using the cached mapping" in caplog.text
+    assert list(found) == ids[:3]
+    np.testing.assert_allclose(query_means(cfg, layer, mapping), expected[[3, 150, 42]])
+
+    # same statistics when the requested polygons are mapped on the fly
+    cfg.mapping_cache.enabled = False
+    found, mapping = map_polygon_ids(cfg, ids, 2015, layer)
+    np.testing.assert_allclose(query_means(cfg, layer, mapping), expected[[3, 150, 42]])
+
+
+def test_missing_cached_mapping_falls_back_to_mapping(cfg, workdir, caplog, monkeypatch):
+    layer = make_layer(make_raster((400, 400)))
+    write_shapefile(cfg, 2015, make_polygons(200))
+    offsets, flat, _, _ = polygon_mapping(cfg, 2015, layer)
+    expected = zonal_means(layer.values[::-1], offsets, flat)
+
+    # the mapping is found in the index of the grid, but removed (e.g. by another job) before it is loaded
+    monkeypatch.setattr(query_components, "load_mapping", lambda cache_dir, key: None)
+    _mappings.clear()
+    with caplog.at_level(logging.INFO):
+        found, mapping = map_polygon_ids(cfg, ["00003", "00150"], 2015, layer)
+    assert "Could not load the cached mapping" in caplog.text
+    np.testing.assert_allclose(query_means(cfg, layer, mapping), expected[[3, 150]])
+
+
+def test_geometries_outside_of_the_grid_have_no_cells(cfg, workdir):
+    layer = make_layer(make_raster((400, 400)))
+    polygons = list(make_polygons(5)) + list(make_polygons(2, bounds=(0, 0, 1, 1)))
+    window, offsets, flat, _ = map_geometries(cfg, polygons, layer)
+    assert np.all(np.diff(offsets)[:5] > 0) and np.all(np.diff(offsets)[5:] == 0)
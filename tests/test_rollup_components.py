@@ -0,0 +1,45 @@
+import numpy as np
+import shapely
+
+from tests.conftest import make_grid, make_polygons, make_raster
+from src.aggregate_components import long_format, rollup_sums
+from src.rollup_components import rollup_component
+from utils.faster_zonal_stats import polygon_to_raster_cells, zonal_means
+from utils.mapping_cache import cells_to_csr
+
+
+def split_polygons(polygons):
+    """
+    Halves of each polygon (west and east of its centroid), with ids nested in the ids of the polygons
+    """
+    halves, ids = [], []
+    for i, polygon in enumerate(polygons):
+        x = shapely.centroid(polygon).x
+        minx, miny, maxx, maxy = polygon.bounds
+        for j, half in enumerate([shapely.box(minx, miny, x, maxy), shapely.box(x, miny, maxx, maxy)]):
+            halves.append(shapely.intersection(polygon, half))
+            ids.append(f"{i:05d}{j:06d}")
+    return halves, np.array(ids)
+
+
+def polygon_csr(geometries, raster, transform):
+    cell_map = polygon_to_raster_cells(geometries, raster, affine=transform, all_touched=True, nodata=np.nan)
+    return cells_to_csr(cell_map, raster.shape)
+
+
+def test_rollup_matches_direct_aggregation(cfg):
+    transform, shape = make_grid("float64")
+    raster = make_raster(shape)
+    counties = make_polygons(50)
+    tracts, tract_ids = split_polygons(counties)
+
+    offsets, flat = polygon_csr(tracts, raster, transform)
+    stats = {"mean": zonal_means(raster, offsets, flat)}
+    stats.update(rollup_sums(cfg, raster, offsets, flat, tract_ids, None))
+    df = long_format(cfg, "no3", stats, tract_ids, [2015], [None])
+    rolled = rollup_component(cfg, df, "no3", "county")
+
+    # means of the cells of the counties, each cell shared by the tracts of a county counted once
+    expected = zonal_means(raster, *polygon_csr(list(counties), raster, transform))
+    assert list(rolled["county"]) == [f"{i:05d}" for i in range(len(counties))]
+    np.testing.assert_allclose(rolled["no3"], expected, rtol=1e-12)
@@ -0,0 +1,151 @@
+# lightweight helpers to find the component files of a year, either by parsing the filenames
+# or from the manifest written by src/build_manifest.py. This module only uses the standard
+# library so that it can be imported cheaply (e.g. by the Snakefile while planning the DAG).
+
+import json
+import logging
+import os
+import pathlib
+import re
+import tempfile
+
+LOGGER = logging.getLogger(__name__)
+
+# mapping for month abbreviations to numbers
+month_map = {
+    "JAN": "01", "FEB": "02", "MAR": "03", "APR": "04",
+    "MAY": "05", "JUN": "06", "JUL": "07", "AUG": "08",
+    "SEP": "09", "OCT": "10", "NOV": "11", "DEC": "12"
+}
+
+
+def available_shapefile_year(year, shapefile_years_list: list):
+    """
+    Given a list of shapefile years,
+    return the latest year in the shapefile_years_list that is less than or equal to the given year
+    """
+    for shapefile_year in sorted(shapefile_years_list, reverse=True):
+        if year >= shapefile_year:
+            return shapefile_year
+
+    return min(shapefile_years_list)  # Returns the last element if year is greater than the last element
+
+
+def parse_filename(filename, temporal_freq):
+    """
+    Extract the year and month (None for yearly files) from a component filename
+    """
+    # Extract year from filename
+    match = re.search(r"(20\d{2})(?:-\1-|\d{3}-\1\d{3})", filename)
+    file_year = match.group(1) if match else None
+    if not file_year:
+        raise ValueError(f"Filename {filename} does not contain a valid year.")
+
+    if temporal_freq == "monthly":
+        match = re.search(r"(?<!\d)(JAN|FEB|MAR|APR|MAY|JUN|JUL|AUG|SEP|OCT|NOV|DEC)(?!\w)", filename)
+        month_abbr = match.group(0) if match else None
+        if not month_abbr:
+            raise ValueError(f"Filename {filename} does not contain a valid month abbreviation.")
+        month = int(month_map[month_abbr])
+    else:
+        month = None
+
+    return int(file_year), month
+
+
+def component_path(temporal_freq, component):
+    return f"data/input/pm25_components__randall/{temporal_freq}/{component}/"
+
+
+def manifest_path(temporal_freq, component):
+    return f"data/input/pm25_components__randall/manifest/{temporal_freq}/{component}.json"
+
+
+def zarr_store_path(temporal_freq, component):
+    return f"data/input/pm25_components__randall/zarr/{temporal_freq}/{component}.zarr"
+
+
+def scan_component_files(path, temporal_freq):
+    """
+    List the (year, month, filename) of all the netcdf files of a component directory
+    """
+    files = []
+    for f in pathlib.Path(path).glob("*.nc"):
+        if f.is_file():
+            file_year, month = parse_filename(str(f), temporal_freq)
+            files.append((file_year, month, str(f)))
+    return files
+
+
+def write_manifest(path, entries):
+    """
+    Write the manifest entries (one dict per file) to a json file, atomically
+    """
+    path = pathlib.Path(path)
+    os.makedirs(path.parent, exist_ok=True)
+    entries = sorted(entries, key=lambda e: (e["year"], e["month"] or 0))
+
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({"files": entries}, f, indent=1)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_manifest(path):
+    """
+    Load a manifest as a dict {year: [entries sorted by month]}
+    """
+    with open(path) as f:
+        entries = json.load(f)["files"]
+
+    by_year = {}
+    for entry in entries:
+        by_year.setdefault(int(entry["year"]), []).append(entry)
+    return by_year
+
+
+def manifest_files(manifest, years):
+    """
+    Paths of the files of the requested years in a manifest loaded with load_manifest
+    """
+    return [entry["path"] for year in years for entry in manifest.get(int(year), [])]
+
+
+def is_stale(entry):
+    """
+    Whether the file of a manifest entry is missing or changed since the manifest was built
+    """
+    try:
+        stat = os.stat(entry["path"])
+    except FileNotFoundError:
+        return True
+    return stat.st_size != entry["size"] or int(stat.st_mtime) != entry["mtime"]
+
+
+def list_component_files(path, temporal_freq, years, manifest=None):
+    """
+    List the (year, month, filename) of the component files for the requested years, sorted by time.
+    Files are looked up in the manifest when it exists, lists files for the years and is up to date, otherwise
+    the directory is scanned (e.g. for the files of a new year added after the manifest was built).
+    """
+    if manifest is not None and os.path.exists(manifest):
+        by_year = load_manifest(manifest)
+        entries = [entry for year in years for entry in by_year.get(int(year), [])]
+
+        if not entries:
+            LOGGER.warning(f"Manifest {manifest} has no files for years {years}, scanning {path} instead.")
+        elif any(is_stale(entry) for entry in entries):
+            LOGGER.warning(f"Manifest {manifest} is out of date, scanning {path} instead.")
+        else:
+            signatures = {entry["grid_signature"] for entry in entries}
+            if len(signatures) > 1:
+                raise ValueError(f"Files in {manifest} for years {years} are on different grids: {signatures}")
+            return [(int(entry["year"]), entry["month"], entry["path"]) for entry in entries]
+
+    files = [f for f in scan_component_files(path, temporal_freq) if f[0] in years]
+    return sorted(files, key=lambda x: (x[0], x[1] or 0))
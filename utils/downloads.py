@@ -0,0 +1,261 @@
+# download subsystem of the component and shapefile archives. A fetcher opens a url at a byte offset and
+# returns the chunks of the response; the download helpers resume partial downloads with range requests,
+# verify the size and checksum of the archives, and extract the zip members straight to their final names.
+# Fetchers (download.*_fetcher):
+#   http: plain http(s) urls (shapefiles, or a local stand-in server for tests)
+#   browser: pages with a download button (the box folders of the components), the download url is resolved
+#            with headless chrome (its download is cancelled) and the file itself is fetched with http requests
+#   local: urls that are local paths or file:// urls (e.g. a mirror of the archives)
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import unquote, urlparse
+
+import requests
+
+LOGGER = logging.getLogger(__name__)
+
+# small chunks, so that little data is lost when a connection drops in the middle of a chunk
+CHUNK_SIZE = 1 << 16
+
+
+class HttpFetcher:
+    """
+    Fetch http(s) urls with requests. Requests time out after timeout seconds without data,
+    so that a stalled server fails the attempt instead of hanging.
+    """
+
+    def __init__(self, timeout=60, cookies=None):
+        self.timeout = timeout
+        self.session = requests.Session()
+        if cookies:
+            self.session.cookies.update(cookies)
+
+    def resolve(self, url):
+        return url
+
+    def open(self, url, offset=0):
+        """
+        Returns (chunks, start, total): an iterator over the response data, the offset at which it
+        starts (0 when the server ignores the range request) and the size of the file (None if unknown)
+        """
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        response = self.session.get(url, headers=headers, stream=True, timeout=self.timeout)
+        if offset and response.status_code == 416:
+            # the partial file is already complete, its size is only known from a "bytes */<size>" Content-Range
+            # (otherwise it is verified against the expected size and sha256, when given)
+            response.close()
+            total = response.headers.get("Content-Range", "*/*").rsplit("/", 1)[1]
+            return iter(()), offset, int(total) if total.strip().isdigit() else None
+        response.raise_for_status()
+
+        start = offset if response.status_code == 206 else 0
+        if response.status_code == 206 and "Content-Range" in response.headers:
+            total = response.headers["Content-Range"].rsplit("/", 1)[1]
+            total = int(total) if total != "*" else None
+        elif "Content-Length" in response.headers:
+            total = start + int(response.headers["Content-Length"])
+        else:
+            total = None
+        return response.iter_content(chunk_size=CHUNK_SIZE), start, total
+
+
+class LocalFetcher:
+    """
+    Fetch local paths or file:// urls, e.g. from a mirror of the archives
+    """
+
+    def __init__(self, timeout=None):
+        pass
+
+    def resolve(self, url):
+        return unquote(urlparse(url).path) if url.startswith("file://") else url
+
+    def open(self, url, offset=0):
+        total = os.path.getsize(url)
+
+        def chunks():
+            with open(url, "rb") as f:
+                f.seek(offset)
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    yield chunk
+
+        return chunks(), offset, total
+
+
+class BrowserFetcher(HttpFetcher):
+    """
+    Fetch the file behind the download button of a page (the box folders of the components). The page is
+    opened with headless chrome, the button is clicked and the url of the download is taken from the
+    download event of the browser, which cancels the download of the browser; the file is then fetched with
+    http requests, using the cookies of the page.
+    """
+
+    def __init__(self, timeout=60, button_selector="button[aria-label='Download']"):
+        super().__init__(timeout)
+        self.button_selector = button_selector
+
+    def resolve(self, url):
+        # selenium is only needed by this fetcher
+        from selenium import webdriver
+        from selenium.webdriver.chrome.options import Options
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.webdriver.support.ui import WebDriverWait
+
+        chrome_options = Options()
+        chrome_options.add_argument("--headless=new")
+        chrome_options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+        driver = webdriver.Chrome(options=chrome_options)
+
+        # the download started by chrome is only used to learn its url: it is cancelled as soon as it begins,
+        # the first bytes received until then go to a scratch directory
+        scratch_dir = tempfile.mkdtemp(prefix="download_")
+        try:
+            driver.execute_cdp_cmd(
+                "Browser.setDownloadBehavior", {"behavior": "allow", "downloadPath": scratch_dir, "eventsEnabled": True}
+            )
+            # reload the page (removes popup)
+            driver.get(url)
+            driver.refresh()
+            download_button = WebDriverWait(driver, self.timeout).until(
+                EC.element_to_be_clickable((By.CSS_SELECTOR, self.button_selector))
+            )
+            download_button.click()
+            LOGGER.info(f"Waiting for the download of {url} to begin.")
+            event = WebDriverWait(driver, self.timeout).until(download_event)
+            driver.execute_cdp_cmd("Browser.cancelDownload", {"guid": event["guid"]})
+            download_url = event["url"]
+            self.session.cookies.update({c["name"]: c["value"] for c in driver.get_cookies()})
+        finally:
+            driver.quit()
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+        LOGGER.info(f"Resolved {url} to {download_url}")
+        return download_url
+
+
+def download_event(driver):
+    """
+    Parameters (url, guid, ...) of the first download started by the browser, read from its performance log
+    (False if none yet)
+    """
+    for entry in driver.get_log("performance"):
+        message = json.loads(entry["message"])["message"]
+        if message["method"] in ("Page.downloadWillBegin", "Browser.downloadWillBegin"):
+            return message["params"]
+    return False
+
+
+FETCHERS = {"http": HttpFetcher, "browser": BrowserFetcher, "local": LocalFetcher}
+
+
+def make_fetcher(name, timeout):
+    if name not in FETCHERS:
+        raise ValueError(f"Unknown fetcher {name}, options are {list(FETCHERS)}.")
+    return FETCHERS[name](timeout=timeout)
+
+
+def verify_file(path, size=None, sha256=None):
+    """
+    Raise ValueError if the size or the sha256 of a file differ from the expected ones (when given)
+    """
+    actual_size = os.path.getsize(path)
+    if size is not None and actual_size != size:
+        raise ValueError(f"{path} has {actual_size} bytes, expected {size}.")
+    if sha256 is not None:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+        if digest.hexdigest() != sha256:
+            raise ValueError(f"{path} has sha256 {digest.hexdigest()}, expected {sha256}.")
+
+
+def download(fetcher, url, path, size=None, sha256=None, retries=3):
+    """
+    Download url to path. The data is written to path.part, which is kept when an attempt fails so that the
+    next attempt (or the next run) resumes it with a range request. The size (given or announced by the server)
+    and the sha256 (when given) are verified before the file is renamed to path.
+    """
+    part_path = f"{path}.part"
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    url = fetcher.resolve(url)
+
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        try:
+            chunks, start, total = fetcher.open(url, offset)
+            if offset:
+                LOGGER.info(f"Resuming {path} at {start} bytes.")
+            with open(part_path, "r+b" if start else "wb") as f:
+                f.seek(start)
+                f.truncate()
+                for chunk in chunks:
+                    f.write(chunk)
+            break
+        except OSError as e:
+            # requests exceptions are OSErrors
+            if attempt == retries:
+                raise
+            LOGGER.warning(f"Download of {url} failed ({e}), retrying ({attempt + 1}/{retries}).")
+
+    try:
+        verify_file(part_path, size if size is not None else total, sha256)
+    except ValueError:
+        os.remove(part_path)
+        raise
+    os.replace(part_path, path)
+    LOGGER.info(f"Downloaded {url} to {path} ({os.path.getsize(path)} bytes).")
+    return path
+
+
+def extract_zip(zip_path, dest_dir, rename=None):
+    """
+    Extract the files of a zip archive into dest_dir, without the folders of the archive. Each member is
+    streamed to a temporary file next to its final path and renamed, and its crc is checked while reading.
+    rename maps the name of a member to the name of its file in dest_dir. Returns the extracted paths.
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    paths = []
+    with zipfile.ZipFile(zip_path) as archive:
+        for member in archive.infolist():
+            if member.is_dir():
+                continue
+            name = os.path.basename(member.filename)
+            target = pathlib.Path(dest_dir) / (rename(name) if rename is not None else name)
+            tmp_path = target.with_name(f".{target.name}.tmp")
+            try:
+                with archive.open(member) as src, open(tmp_path, "wb") as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                os.replace(tmp_path, target)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            paths.append(str(target))
+    return paths
+
+
+def run_concurrently(fn, items, workers):
+    """
+    Call fn on each item with a pool of workers threads. Raises RuntimeError listing the failed items.
+    """
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(fn, item): item for item in items}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                LOGGER.exception(f"Download of {futures[future]} failed.")
+                failed.append(futures[future])
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(items)} downloads failed: {failed}")
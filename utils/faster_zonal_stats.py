@@ -5,15 +5,66 @@
 # Copyright (c) 2013 Matthew Perry
 # All rights reserved.
 
+import os
+import re
 import warnings
 import numpy as np
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 from tqdm import tqdm
 from affine import Affine
+from rasterio import features
 from shapely.geometry import shape
 
 
 from rasterstats.io import Raster, read_features, bounds_window
 from rasterstats.utils import boxify_points, rasterize_geom
+from utils.instrumentation import stage
+
+
+def as_geometries(vectors, layer=0):
+    """Returns the shapely geometries of a GeoDataFrame, GeoSeries or sequence of shapely geometries.
+
+    Other sources (paths, GeoJSON-like features) are read with ``rasterstats.io.read_features``.
+    """
+    if hasattr(vectors, "geometry"):
+        return list(vectors.geometry.values)
+    if isinstance(vectors, (list, tuple, np.ndarray)) and all(isinstance(g, shapely.Geometry) for g in vectors):
+        return list(vectors)
+    return [shape(feat["geometry"]) for feat in read_features(vectors, layer)]
+
+
+def bounds_windows(bounds, affine):
+    """Vectorized ``rasterstats.io.bounds_window``.
+
+    Parameters
+    ----------
+    bounds: ndarray
+        (n, 4) array of ``xmin, ymin, xmax, ymax`` per feature.
+
+    Returns
+    -------
+    ndarray
+        (n, 4) int64 array of ``row_start, row_stop, col_start, col_stop`` per feature.
+
+    Notes
+    -----
+    ``bounds_window`` subtracts the affine coefficients from python floats, so the
+    arithmetic is done in the dtype of the coefficients when they are numpy scalars
+    (e.g. float32 for a transform built from float32 coordinates). The same dtype
+    is used here, so that the windows are identical to the ones of ``bounds_window``.
+    """
+    dtype = np.result_type(0.0 - affine.f, 0.0 - affine.c)
+    a, c, e, f = (np.asarray(v, dtype=dtype) for v in (affine.a, affine.c, affine.e, affine.f))
+    bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4).astype(dtype)
+    west, south, east, north = bounds.T
+    return np.stack([
+        np.floor((north - f) / e),
+        np.ceil((south - f) / e),
+        np.floor((west - c) / a),
+        np.ceil((east - c) / a),
+    ], axis=1).astype(np.int64)
 
 
 def polygon_to_raster_cells(
@@ -26,6 +77,7 @@ def polygon_to_raster_cells(
     all_touched=False,
     boundless=True,
     verbose=False,
+    windows=None,
     **kwargs,
 ):
     """Returns an index map for each vector geometry to indices in the raster source.
@@ -63,6 +115,10 @@ def polygon_to_raster_cells(
     prefix: string
         add a prefix to the keys (default: None)
 
+    windows: ndarray, optional
+        (n, 4) array of ``row_start, row_stop, col_start, col_stop`` of each feature in the raster
+        (see ``bounds_windows``), computed from the feature bounds when not given.
+
     Returns
     -------
     dict
@@ -93,20 +149,25 @@ def polygon_to_raster_cells(
 
     cell_map = []
 
-    rast = Raster(raster, affine, nodata, band)
-
     with Raster(raster, affine, nodata, band) as rast:
-        features_iter = read_features(vectors, layer)
-
+        # geometries, bounds and windows are taken in bulk instead of parsing each feature
+        geometries = as_geometries(vectors, layer)
+        if windows is None and geometries:
+            windows = bounds_windows(shapely.bounds(np.asarray(geometries, dtype=object)), rast.affine)
 
-        for feat in tqdm(features_iter, disable=(not verbose)):
-            geom = shape(feat["geometry"])
+        for i, geom in enumerate(tqdm(geometries, disable=(not verbose))):
+            window = windows[i] if windows is not None else None
 
             if "Point" in geom.geom_type:
                 geom = boxify_points(geom, rast)
+                window = None
 
-            geom_bounds = tuple(geom.bounds)
-            fsrc = rast.read(bounds=geom_bounds, boundless=boundless)
+            # the cells are offset by the window that is actually read
+            if window is None:
+                (row_start, row_stop), (col_start, col_stop) = bounds_window(tuple(geom.bounds), rast.affine)
+            else:
+                row_start, row_stop, col_start, col_stop = (int(v) for v in window)
+            fsrc = rast.read(window=((row_start, row_stop), (col_start, col_stop)), boundless=boundless)
 
             # rasterized geometry
             rv_array = rasterize_geom(geom, like=fsrc, all_touched=all_touched)
@@ -124,8 +185,535 @@ def polygon_to_raster_cells(
             indices = np.nonzero(rv_array & ~isnodata)
 
             # add row and col start
-            (row_start, _), (col_start, _) = bounds_window(geom.bounds, affine)
             indices = (indices[0] + row_start, indices[1] + col_start)
             cell_map.append(indices)
 
         return cell_map
+
+
+def default_n_jobs():
+    """Number of processes for parallel work: ``SLURM_CPUS_PER_TASK`` if set, otherwise 1."""
+    return int(os.environ.get("SLURM_CPUS_PER_TASK", 1))
+
+
+def spatial_order(geometries, grid_size=1024):
+    """Returns an ordering of the geometries along a Z-order (Morton) curve of their bounding box centers.
+
+    Consecutive geometries in this order are spatially close, so chunks of it
+    read nearby raster windows.
+    """
+    bounds = shapely.bounds(np.asarray(geometries, dtype=object))
+    cx = (bounds[:, 0] + bounds[:, 2]) / 2
+    cy = (bounds[:, 1] + bounds[:, 3]) / 2
+
+    def scale(v):
+        v = np.nan_to_num(v, nan=np.nanmin(v) if np.isfinite(v).any() else 0)
+        span = v.max() - v.min()
+        return np.zeros(len(v), np.uint64) if span == 0 else ((v - v.min()) / span * (grid_size - 1)).astype(np.uint64)
+
+    x, y = scale(cx), scale(cy)
+    code = np.zeros(len(geometries), dtype=np.uint64)
+    for bit in range(int(np.ceil(np.log2(grid_size)))):
+        code |= ((x >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit)
+        code |= ((y >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit + 1)
+
+    return np.argsort(code, kind="stable")
+
+
+# raster shared with the worker processes of polygon_to_raster_cells_parallel
+_worker_shm = None
+_worker_raster = None
+
+
+def _init_mapping_worker(shm_name, shape, dtype):
+    global _worker_shm, _worker_raster
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_raster = np.ndarray(shape, dtype=dtype, buffer=_worker_shm.buf)
+
+
+def _map_chunk(args):
+    positions, geometries, kwargs = args
+    return positions, polygon_to_raster_cells(geometries, _worker_raster, **kwargs)
+
+
+def polygon_to_raster_cells_parallel(
+    vectors,
+    raster,
+    affine,
+    layer=0,
+    nodata=None,
+    all_touched=False,
+    boundless=True,
+    n_jobs=None,
+    chunk_size=256,
+    verbose=False,
+    windows=None,
+):
+    """Parallel version of ``polygon_to_raster_cells`` for an ndarray raster.
+
+    Features are sorted along a space filling curve, split into spatially
+    coherent chunks of ``chunk_size`` features and mapped in a process pool.
+    The raster is placed in shared memory once, so it is not pickled for each
+    chunk. The result is identical to ``polygon_to_raster_cells`` and is
+    returned in feature order.
+
+    Parameters
+    ----------
+    vectors: GeoDataFrame, GeoSeries, or any source accepted by ``polygon_to_raster_cells``
+
+    raster: ndarray
+
+    affine: Affine instance
+
+    n_jobs: int, optional
+        number of processes, defaults to ``SLURM_CPUS_PER_TASK`` or 1.
+        With 1 process ``polygon_to_raster_cells`` is called directly.
+
+    chunk_size: int, optional
+        number of features sent to a worker at once.
+
+    windows: ndarray, optional
+        precomputed windows of the features, see ``polygon_to_raster_cells``.
+
+    Returns
+    -------
+    list
+        A list with the (rows, cols) raster indices of each vector geometry.
+    """
+    n_jobs = n_jobs or default_n_jobs()
+    kwargs = dict(affine=affine, nodata=nodata, all_touched=all_touched, boundless=boundless)
+
+    if n_jobs <= 1:
+        return polygon_to_raster_cells(vectors, raster, layer=layer, verbose=verbose, windows=windows, **kwargs)
+
+    geometries = as_geometries(vectors, layer)
+    if windows is None:
+        windows = bounds_windows(shapely.bounds(np.asarray(geometries, dtype=object)), affine)
+
+    order = spatial_order(geometries)
+    chunks = [
+        (positions, [geometries[i] for i in positions], {**kwargs, "windows": windows[positions]})
+        for positions in np.array_split(order, max(1, int(np.ceil(len(order) / chunk_size))))
+    ]
+
+    raster = np.asarray(raster)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, raster.nbytes))
+    try:
+        np.ndarray(raster.shape, dtype=raster.dtype, buffer=shm.buf)[:] = raster
+
+        cell_map = [None] * len(geometries)
+        with ProcessPoolExecutor(
+            max_workers=n_jobs,
+            initializer=_init_mapping_worker,
+            initargs=(shm.name, raster.shape, raster.dtype.str),
+        ) as pool:
+            results = pool.map(_map_chunk, chunks)
+            for positions, chunk_cells in tqdm(results, total=len(chunks), disable=(not verbose)):
+                for position, indices in zip(positions, chunk_cells):
+                    cell_map[position] = indices
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return cell_map
+
+
+def color_windows(windows):
+    """Greedy coloring of raster windows so that windows with the same color never overlap.
+
+    Parameters
+    ----------
+    windows: ndarray
+        (n, 4) array of ``row_start, row_stop, col_start, col_stop`` per feature.
+
+    Returns
+    -------
+    ndarray
+        color (0, 1, ...) of each window.
+    """
+    boxes = shapely.box(windows[:, 2], windows[:, 0], windows[:, 3], windows[:, 1])
+    tree = shapely.STRtree(boxes)
+    left, right = tree.query(boxes, predicate="intersects")
+
+    # neighbors of each window in CSR form
+    order = np.argsort(left, kind="stable")
+    left, right = left[order], right[order]
+    starts = np.searchsorted(left, np.arange(len(windows) + 1))
+
+    colors = np.full(len(windows), -1, dtype=np.int64)
+    for i in range(len(windows)):
+        neighbor_colors = colors[right[starts[i]:starts[i + 1]]]
+        used = set(neighbor_colors[neighbor_colors >= 0].tolist())
+        color = 0
+        while color in used:
+            color += 1
+        colors[i] = color
+
+    return colors
+
+
+def polygon_to_raster_cells_layer(
+    vectors,
+    raster,
+    affine,
+    layer=0,
+    nodata=None,
+    all_touched=False,
+    verbose=False,
+    windows=None,
+):
+    """Whole-layer version of ``polygon_to_raster_cells`` for an ndarray raster.
+
+    Instead of reading a window and rasterizing each feature separately, the
+    features are split into groups whose cell windows do not overlap, and each
+    group is burned into a label grid of feature ids with a single
+    ``rasterio.features.rasterize`` call. The groups are the colors of a
+    greedy coloring of the windows, only neighbouring windows overlap so
+    there are few of them whatever the number of features (8 for 85,000
+    tract-sized polygons, see ``coloring_tract_scale`` in the benchmarks).
+    A vectorized group-by on the label
+    grid gives the cells of every feature. Since features in a group never share
+    a cell, cells touched by neighbouring polygons under ``all_touched=True``
+    are assigned correctly. Cells are clipped to the feature's bounds window
+    and returned in the same order as ``polygon_to_raster_cells``, which is also
+    used for non-polygonal features (e.g. points).
+
+    Returns
+    -------
+    list
+        A list with the (rows, cols) raster indices of each vector geometry.
+    """
+    raster = np.asarray(raster)
+    geometries = as_geometries(vectors, layer)
+
+    isnodata = raster == nodata if nodata is not None else np.zeros(raster.shape, dtype=bool)
+    if np.issubdtype(raster.dtype, np.floating):
+        isnodata = isnodata | np.isnan(raster)
+
+    cell_map = [None] * len(geometries)
+    empty = (np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+
+    # points and other non polygonal features go through the per-feature function
+    is_polygon = np.array(["Polygon" in geom.geom_type for geom in geometries], dtype=bool)
+    others = np.flatnonzero(~is_polygon)
+    if len(others):
+        other_cells = polygon_to_raster_cells(
+            [geometries[i] for i in others], raster, affine=affine, nodata=nodata, all_touched=all_touched
+        )
+        for i, indices in zip(others, other_cells):
+            cell_map[i] = indices
+
+    polygons = np.flatnonzero(is_polygon)
+    if len(polygons) == 0:
+        return cell_map
+
+    if windows is None:
+        windows = bounds_windows(shapely.bounds(np.asarray([geometries[i] for i in polygons], dtype=object)), affine)
+    else:
+        windows = np.asarray(windows, dtype=np.int64)[polygons]
+    colors = color_windows(windows)
+
+    for color in tqdm(range(colors.max() + 1), disable=(not verbose)):
+        members = np.flatnonzero(colors == color)
+
+        # burn the (1-based) position of each feature of the group into a label grid
+        with stage("rasterize_group", n_polygons=len(members)):
+            labels = features.rasterize(
+                ((geometries[polygons[m]], int(m) + 1) for m in members),
+                out_shape=raster.shape,
+                transform=affine,
+                fill=0,
+                dtype="int32",
+                all_touched=all_touched,
+            )
+        labels[isnodata] = 0
+
+        # group-by label, a stable sort keeps the row-major order of the cells within each feature
+        flat = np.flatnonzero(labels)
+        label = labels.ravel()[flat] - 1
+        order = np.argsort(label, kind="stable")
+        flat, label = flat[order], label[order]
+        rows, cols = np.divmod(flat, raster.shape[1])
+
+        # only keep the cells inside each feature's bounds window
+        w = windows[label]
+        inside = (rows >= w[:, 0]) & (rows < w[:, 1]) & (cols >= w[:, 2]) & (cols < w[:, 3])
+        rows, cols, label = rows[inside], cols[inside], label[inside]
+
+        bounds = np.searchsorted(label, members, side="left"), np.searchsorted(label, members, side="right")
+        for m, start, end in zip(members, *bounds):
+            cell_map[polygons[m]] = (rows[start:end], cols[start:end])
+
+    return [indices if indices is not None else empty for indices in cell_map]
+
+
+def polygon_cell_coverage(geometries, offsets, flat, shape, affine):
+    """Returns the fraction of each mapped raster cell covered by its polygon.
+
+    Parameters
+    ----------
+    geometries: sequence of shapely geometries
+        polygons in the same order used to build the mapping.
+
+    offsets, flat: ndarray
+        CSR-style mapping from polygons to flat (row-major) cell indices,
+        as produced by ``utils.mapping_cache.cells_to_csr``.
+
+    shape: tuple
+        (rows, cols) of the raster.
+
+    affine: Affine instance
+        transform of the raster used to build the mapping.
+
+    Returns
+    -------
+    ndarray
+        float32 array aligned with ``flat`` with the covered fraction (0 to 1)
+        of each cell. Polygons without any covered area (e.g. points or lines)
+        fall back to binary weights.
+    """
+    rows, cols = np.unravel_index(np.asarray(flat, dtype=np.int64), shape)
+
+    # cell boxes, the affine maps (col, row) to the top left corner of the cell
+    xmin = affine.c + cols * affine.a
+    ymax = affine.f + rows * affine.e
+    xmax = xmin + affine.a
+    ymin = ymax + affine.e
+    cell_area = abs(affine.a * affine.e)
+
+    weights = np.ones(len(flat), dtype=np.float32)
+    with stage("cell_coverage", n_polygons=len(geometries), n_cells=len(flat)):
+        for i, geom in enumerate(geometries):
+            start, end = offsets[i], offsets[i + 1]
+            if start == end or geom is None:
+                continue
+
+            shapely.prepare(geom)
+            boxes = shapely.box(xmin[start:end], ymin[start:end], xmax[start:end], ymax[start:end])
+            fraction = shapely.area(shapely.intersection(geom, boxes)) / cell_area
+
+            if fraction.sum() > 0:
+                weights[start:end] = np.clip(fraction, 0, 1)
+
+    return weights
+
+
+def zonal_sums_counts(raster, offsets, flat, weights=None):
+    """Computes NaN-aware sums and valid cell counts for all polygons in one vectorized pass.
+
+    Parameters
+    ----------
+    raster: ndarray
+        raster of shape (rows, cols), or a stack of rasters of shape (..., rows, cols),
+        indexed in the same orientation used to build the mapping.
+
+    offsets: ndarray
+        CSR-style offsets (length n_polygons + 1) into ``flat``,
+        as produced by ``utils.mapping_cache.cells_to_csr``.
+
+    flat: ndarray
+        flat (row-major) cell indices of all polygons, concatenated.
+
+    weights: ndarray, optional
+        weight of each entry of ``flat`` (e.g. from ``polygon_cell_coverage``).
+        If given, weighted sums and the sums of the weights of valid cells
+        are returned instead of plain sums and counts.
+
+    Returns
+    -------
+    tuple
+        ``(sums, counts)`` arrays of shape (..., n_polygons). Sums are
+        accumulated in float64 and nodata cells are ignored.
+    """
+    raster = np.asarray(raster)
+    n_rasters = int(np.prod(raster.shape[:-2]))
+
+    with stage("reduction", n_rasters=n_rasters, n_polygons=len(offsets) - 1, n_cells=n_rasters * len(flat)):
+        lead_shape = raster.shape[:-2]
+        cells = raster.reshape(lead_shape + (-1,))[..., flat]
+
+        if np.issubdtype(cells.dtype, np.floating):
+            valid = ~np.isnan(cells)
+            cells = np.where(valid, cells, 0)
+        else:
+            valid = np.ones(cells.shape, dtype=bool)
+
+        if weights is not None:
+            valid = valid * np.asarray(weights, dtype=np.float64)
+            cells = cells * valid
+
+        # segment reduce over the polygons that have at least one cell,
+        # reduceat would otherwise return a cell value for empty segments
+        n_polygons = len(offsets) - 1
+        starts = np.asarray(offsets[:-1])
+        nonempty = np.diff(offsets) > 0
+        count_dtype = np.int64 if weights is None else np.float64
+
+        sums = np.zeros(lead_shape + (n_polygons,))
+        counts = np.zeros(lead_shape + (n_polygons,), dtype=count_dtype)
+        if nonempty.any():
+            sums[..., nonempty] = np.add.reduceat(cells, starts[nonempty], axis=-1, dtype=np.float64)
+            counts[..., nonempty] = np.add.reduceat(valid, starts[nonempty], axis=-1, dtype=count_dtype)
+
+    return sums, counts
+
+
+def cell_ownership(offsets, flat, groups):
+    """Returns the entries of ``flat`` that own their cell within their group of polygons.
+
+    With ``all_touched=True`` neighbouring polygons share the cells along their
+    common boundary. Within each group (e.g. the tracts of a county), a cell is
+    owned by the first polygon that contains it, so that the sums and counts of
+    the owned cells of the polygons of a group add up to the sums and counts of
+    the cells of the group, each cell counted once.
+
+    Parameters
+    ----------
+    offsets, flat:
+        as in ``zonal_sums_counts``.
+
+    groups: ndarray
+        integer group of each polygon.
+
+    Returns
+    -------
+    ndarray
+        boolean mask with the length of ``flat``.
+    """
+    group_of_entry = np.repeat(np.asarray(groups, dtype=np.int64), np.diff(offsets))
+    n_cells = int(flat.max()) + 1 if len(flat) else 0
+    # np.unique returns the index of the first occurrence of each (group, cell) pair
+    _, first = np.unique(group_of_entry * n_cells + flat.astype(np.int64), return_index=True)
+    owned = np.zeros(len(flat), dtype=bool)
+    owned[first] = True
+    return owned
+
+
+def zonal_means(raster, offsets, flat, weights=None):
+    """Computes the NaN-aware mean of the raster cells of every polygon.
+
+    Equivalent to calling ``np.nanmean`` on the cells of each polygon, but
+    done for all polygons (and all rasters of a stack) at once. The sums are
+    accumulated in float64, while ``np.nanmean`` of float32 cells accumulates
+    in float32: for float32 rasters the means differ from it by a few float32
+    ulps (a relative difference of a few 1e-7). With
+    ``weights``, a weighted mean is computed instead.
+    Polygons with no valid cells get NaN.
+    """
+    sums, counts = zonal_sums_counts(raster, offsets, flat, weights=weights)
+    means = np.full(sums.shape, np.nan)
+    np.divide(sums, counts, out=means, where=counts > 0)
+    return means
+
+
+def stat_percentile(stat):
+    """Returns the percentile (0 to 100) of a ``pNN`` or ``median`` statistic, None for other statistics."""
+    if stat == "median":
+        return 50.0
+    match = re.fullmatch(r"p(\d+(?:\.\d+)?)", stat)
+    if match and float(match.group(1)) <= 100:
+        return float(match.group(1))
+    return None
+
+
+def validate_stats(stats):
+    """Raises a ValueError for unknown statistics."""
+    unknown = [s for s in stats if s not in ("mean", "std", "min", "max", "count") and stat_percentile(s) is None]
+    if unknown:
+        raise ValueError(f"Unknown statistics {unknown}, must be mean, std, min, max, count, median or pNN.")
+
+
+def zonal_statistics(raster, offsets, flat, stats=("mean",), weights=None):
+    """Computes several NaN-aware statistics of the raster cells of every polygon in one pass.
+
+    Parameters
+    ----------
+    raster, offsets, flat, weights:
+        as in ``zonal_sums_counts``.
+
+    stats: sequence of str
+        ``mean``, ``std`` (population, as ``np.nanstd``), ``min``, ``max``,
+        ``count`` (number of valid cells), ``median`` and percentiles ``pNN``
+        (linear interpolation, as ``np.nanpercentile``). With ``weights`` the
+        mean and std are weighted, the other statistics are not.
+
+    Returns
+    -------
+    dict
+        array of shape (..., n_polygons) for each statistic. Polygons with no
+        valid cells get NaN (and a count of 0).
+
+    Notes
+    -----
+    Minimum and maximum are segment reductions over ``flat``. Order statistics
+    sort the values of all the polygons at once by (polygon, value) and pick the
+    ranks of each polygon from its segment, so no per-polygon call is made.
+    """
+    validate_stats(stats)
+    raster = np.asarray(raster)
+    lead_shape = raster.shape[:-2]
+    n_polygons = len(offsets) - 1
+    sizes = np.diff(offsets)
+    starts = np.asarray(offsets[:-1])
+    nonempty = sizes > 0
+
+    results = {}
+    sums, wcounts = zonal_sums_counts(raster, offsets, flat, weights=weights)
+    means = np.full(sums.shape, np.nan)
+    np.divide(sums, wcounts, out=means, where=wcounts > 0)
+    if "mean" in stats:
+        results["mean"] = means
+    if set(stats) <= {"mean"}:
+        return results
+
+    def segment_reduce(ufunc, values, fill, dtype=np.float64):
+        out = np.full(lead_shape + (n_polygons,), fill, dtype=dtype)
+        if nonempty.any():
+            out[..., nonempty] = ufunc.reduceat(values, starts[nonempty], axis=-1, dtype=dtype)
+        return out
+
+    with stage("reduction_stats", n_rasters=int(np.prod(lead_shape)), n_polygons=n_polygons, n_cells=len(flat)):
+        cells = raster.reshape(lead_shape + (-1,))[..., flat].astype(np.float64)
+        valid = ~np.isnan(cells)
+        counts = segment_reduce(np.add, valid, 0, dtype=np.int64)
+        empty = counts == 0
+
+        if "count" in stats:
+            results["count"] = counts
+
+        if "std" in stats:
+            deviations = np.where(valid, cells - np.repeat(means, sizes, axis=-1), 0)
+            squares = deviations ** 2 if weights is None else deviations ** 2 * np.asarray(weights, dtype=np.float64)
+            variances = np.full(sums.shape, np.nan)
+            np.divide(segment_reduce(np.add, squares, 0), wcounts, out=variances, where=wcounts > 0)
+            results["std"] = np.sqrt(variances)
+
+        if "min" in stats:
+            results["min"] = np.where(empty, np.nan, segment_reduce(np.minimum, np.where(valid, cells, np.inf), np.inf))
+
+        if "max" in stats:
+            results["max"] = np.where(empty, np.nan, segment_reduce(np.maximum, np.where(valid, cells, -np.inf), -np.inf))
+
+        percentiles = {s: stat_percentile(s) for s in stats if stat_percentile(s) is not None}
+        for s in percentiles:
+            results[s] = np.full(counts.shape, np.nan)
+        if percentiles and len(flat):
+            # sort by polygon then value, nodata cells (as +inf) come last in each segment
+            polygon_of_cell = np.broadcast_to(np.repeat(np.arange(n_polygons), sizes), cells.shape)
+            ordered = np.where(valid, cells, np.inf)
+            ordered = np.take_along_axis(ordered, np.lexsort((ordered, polygon_of_cell), axis=-1), axis=-1)
+
+            last = len(flat) - 1
+            for s, q in percentiles.items():
+                position = q / 100 * np.maximum(counts - 1, 0)
+                lower = np.floor(position).astype(np.int64)
+                upper = np.ceil(position).astype(np.int64)
+                lower_values = np.take_along_axis(ordered, np.minimum(starts + lower, last), axis=-1)
+                upper_values = np.take_along_axis(ordered, np.minimum(starts + upper, last), axis=-1)
+                # the segments without valid cells only hold +inf (inf - inf), they are left out of the
+                # interpolation, which is also skipped when both ranks are the same (e.g. one cell)
+                interpolate = ~empty & (lower != upper)
+                deltas = np.subtract(upper_values, lower_values, out=np.zeros(counts.shape), where=interpolate)
+                results[s] = np.where(empty, np.nan, lower_values) + deltas * (position - lower)
+
+    return {s: results[s] for s in stats}
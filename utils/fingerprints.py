@@ -0,0 +1,134 @@
+# content fingerprints of the inputs of each output file, used by the incremental mode of the
+# aggregation jobs to only recompute the (year, month) slices whose input raster changed.
+# The record of an output is a json file next to it:
+#   {"version": .., "config": .., "shapefile": .., "slices": {"2020-01": <digest of the input file>, ...}}
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import tempfile
+
+from utils import output_paths
+from utils.component_files import is_stale, load_manifest
+
+LOGGER = logging.getLogger(__name__)
+
+# bump when the outputs of the same inputs change (e.g. a fix in the aggregation)
+FINGERPRINT_VERSION = 1
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    sha256 of the contents of a file
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def config_digest(*parts):
+    """
+    Hash of the config values an output depends on (statistics, weighting, layer...)
+    """
+    return hashlib.sha256(json.dumps([FINGERPRINT_VERSION, *parts], default=str).encode()).hexdigest()
+
+
+def slice_key(year, month):
+    return f"{int(year)}" if month is None else f"{int(year)}-{int(month):02d}"
+
+
+def file_digests(files, manifest=None):
+    """
+    {slice key: digest} of (year, month, filename) files. Digests are taken from the manifest when
+    it lists the file and the file did not change since, otherwise the file is hashed.
+    """
+    known = {}
+    if manifest is not None and os.path.exists(manifest):
+        for entries in load_manifest(manifest).values():
+            for entry in entries:
+                if entry.get("sha256") and not is_stale(entry):
+                    known[os.path.abspath(entry["path"])] = entry["sha256"]
+
+    digests = {}
+    for year, month, filename in files:
+        digest = known.get(os.path.abspath(filename))
+        digests[slice_key(year, month)] = digest if digest is not None else file_digest(filename)
+    return digests
+
+
+def record_path(output_path):
+    return output_paths.sidecar_path(output_path, ".inputs.json")
+
+
+def load_record(output_path):
+    """
+    Input fingerprints of an output file, None if the output or its record is missing
+    """
+    path = record_path(output_path)
+    if not (os.path.exists(output_path) and os.path.exists(path)):
+        return None
+    with open(path) as f:
+        record = json.load(f)
+    return record if record.get("version") == FINGERPRINT_VERSION else None
+
+
+def save_record(output_path, config, shapefile, slices):
+    """
+    Write the input fingerprints of an output file, atomically
+    """
+    path = pathlib.Path(record_path(output_path))
+    record = {"version": FINGERPRINT_VERSION, "config": config, "shapefile": shapefile, "slices": slices}
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(record, f, indent=1)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return str(path)
+
+
+def combine_digests(digests):
+    """
+    Single digest of several digests (e.g. the files of all the components of a slice)
+    """
+    return hashlib.sha256("|".join(digests).encode()).hexdigest()
+
+
+def plan_slices(record, config, shapefile, slices):
+    """
+    Compare the current input fingerprints with the record of an existing output.
+    Returns (recompute, drop): the slice keys to aggregate again and the slice keys to remove
+    from the existing output. recompute is None when the whole output must be rebuilt
+    (no record, or the config or shapefile changed).
+    """
+    if record is None or record["config"] != config or record["shapefile"] != shapefile:
+        return None, set()
+
+    previous = record["slices"]
+    recompute = {key for key, digest in slices.items() if previous.get(key) != digest}
+    drop = recompute | (set(previous) - set(slices))
+    return recompute, drop
+
+
+def plan_outputs(outputs, shapefile):
+    """
+    Plan the incremental update of several outputs computed from the same slices (e.g. the
+    intermediate file of each component and the merged file), given as (output_path, config, slices).
+    Returns (recompute, drops): the union of the slices to aggregate again (None to rebuild all the
+    outputs) and, for each output path, the slices to remove from the existing file before the
+    recomputed slices are appended.
+    """
+    plans = [plan_slices(load_record(path), config, shapefile, slices) for path, config, slices in outputs]
+    if any(recompute is None for recompute, _ in plans):
+        return None, {}
+
+    recompute = set().union(*(recompute for recompute, _ in plans))
+    drops = {path: drop | recompute for (path, _, _), (_, drop) in zip(outputs, plans)}
+    return recompute, drops
@@ -0,0 +1,122 @@
+# lightweight per-stage instrumentation of the aggregation jobs. Stages are timed with the
+# `stage` context manager and the metrics collected since the last sidecar are written as a json
+# file per output parquet file in the metrics directory (see src/metrics_report.py to roll them up).
+
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger(__name__)
+
+# metrics of the stages run since the last call to write_metrics, by stage name
+_stages = {}
+
+
+def bytes_read():
+    """
+    Bytes read by this process so far (including page cache hits), None if not available (non linux)
+    """
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process so far
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    return maxrss / (2**20 if sys.platform == "darwin" else 2**10)
+
+
+def current_rss_mb():
+    """
+    Current resident memory of this process, None if not available (non linux)
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return None
+
+
+@contextmanager
+def stage(name, **counts):
+    """
+    Record the wall time, cpu time, bytes read and memory of a block of code under name.
+    Repeated stages (e.g. one per file) are accumulated, keyword arguments are recorded as counts
+    (e.g. n_polygons, n_cells) and the yielded dict can be used to add counts known at the end.
+    The peak RSS of the process is not reset per stage: process_peak_rss_mb is the peak of the job
+    so far, peak_rss_increase_mb is how much the stage raised it (the largest increase of its calls).
+    """
+    counts = dict(counts)
+    read0 = bytes_read()
+    peak0 = peak_rss_mb()
+    t0, c0 = time.perf_counter(), time.process_time()
+    try:
+        yield counts
+    finally:
+        wall, cpu = time.perf_counter() - t0, time.process_time() - c0
+        read1 = bytes_read()
+
+        peak1 = peak_rss_mb()
+
+        metrics = _stages.setdefault(name, {
+            "calls": 0,
+            "wall_time_s": 0.0,
+            "cpu_time_s": 0.0,
+            "bytes_read": 0,
+            "peak_rss_increase_mb": 0.0,
+            "counts": {},
+        })
+        metrics["calls"] += 1
+        metrics["wall_time_s"] += wall
+        metrics["cpu_time_s"] += cpu
+        if read0 is not None and read1 is not None:
+            metrics["bytes_read"] += read1 - read0
+        metrics["peak_rss_increase_mb"] = max(metrics["peak_rss_increase_mb"], peak1 - peak0)
+        metrics["process_peak_rss_mb"] = peak1
+        # counts of repeated stages (e.g. cells reduced per file) are summed
+        for key, value in counts.items():
+            metrics["counts"][key] = metrics["counts"].get(key, 0) + int(value)
+
+
+def sidecar_path(output_path, metrics_dir):
+    """
+    Path of the metrics of an output in metrics_dir, under its path relative to data/
+    (e.g. data/metrics/intermediate/.../no3__county_yearly_2015.metrics.json)
+    """
+    relative = os.path.splitext(os.path.relpath(output_path, "data"))[0]
+    return os.path.join(metrics_dir, f"{relative}.metrics.json")
+
+
+def write_metrics(output_path, metrics_dir, **job):
+    """
+    Write the metrics of the stages run since the last call for output_path in metrics_dir and reset them.
+    Keyword arguments describe the job (component, polygon_name, temporal_freq, year...).
+    """
+    path = sidecar_path(output_path, metrics_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    sidecar = {
+        "output": os.path.relpath(output_path),
+        "job": job,
+        "host": platform.node(),
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": dict(_stages),
+    }
+    with open(path, "w") as f:
+        json.dump(sidecar, f, indent=1)
+    _stages.clear()
+    LOGGER.info(f"Saved stage metrics to {path}")
+    return path
@@ -0,0 +1,345 @@
+# on-disk cache for the polygon -> raster cell mappings produced by polygon_to_raster_cells.
+# the mapping only depends on the shapefile and the raster grid, so it can be reused by every
+# component/year/frequency job that aggregates into the same polygons.
+
+import hashlib
+import logging
+import os
+import pathlib
+import tempfile
+
+import numpy as np
+import shapely
+from affine import Affine
+
+LOGGER = logging.getLogger(__name__)
+
+# bump when the on-disk layout changes so stale entries are never read
+CACHE_VERSION = 3
+
+
+def hash_shapefile(shape_path, chunk_size=1 << 20):
+    """
+    Hash the contents of a shapefile and its sidecar files (.shp, .shx, .dbf, .prj, ...).
+    """
+    shape_path = pathlib.Path(shape_path)
+    digest = hashlib.sha256()
+    for path in sorted(shape_path.parent.glob(f"{shape_path.stem}.*")):
+        digest.update(path.suffix.encode())
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_nodata_mask(values):
+    """
+    Hash the nodata (NaN) mask of a raster. Cells that are nodata in the raster used to
+    build the mapping are excluded from it, so the mask is part of the cache key.
+    """
+    mask = np.isnan(values) if np.issubdtype(values.dtype, np.floating) else np.zeros(values.shape, bool)
+    return hashlib.sha256(np.packbits(mask).tobytes()).hexdigest()
+
+
+def hash_geometries(geometries):
+    """
+    Hash the WKB of each geometry. Features with the same geometry in different shapefiles (e.g. the
+    counties that did not change between two vintages) have the same hash.
+    """
+    return np.array([hashlib.sha256(wkb).hexdigest() for wkb in shapely.to_wkb(geometries)], dtype="U64")
+
+
+def mapping_cache_key(shapefile_hash, idvar, affine, shape, all_touched, nodata_hash=None, crs=None):
+    """
+    Build the cache key from everything the mapping depends on, including the crs the polygons are
+    reprojected to before they are rasterized.
+    """
+    digest = hashlib.sha256()
+    parts = [
+        f"v{CACHE_VERSION}",
+        shapefile_hash,
+        str(idvar),
+        ",".join(repr(float(x)) for x in tuple(affine)[:6]),
+        ",".join(str(int(x)) for x in shape),
+        str(bool(all_touched)),
+        str(nodata_hash),
+        str(crs),
+    ]
+    digest.update("|".join(parts).encode())
+    return digest.hexdigest()
+
+
+def cells_to_csr(cell_map, shape):
+    """
+    Convert a list of (rows, cols) index tuples into CSR-style offsets and flat cell indices.
+    """
+    n_cells = int(shape[0]) * int(shape[1])
+    index_dtype = np.int32 if n_cells < np.iinfo(np.int32).max else np.int64
+
+    counts = np.fromiter((len(rows) for rows, _ in cell_map), dtype=np.int64, count=len(cell_map))
+    offsets = np.zeros(len(cell_map) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    flat = np.empty(offsets[-1], dtype=index_dtype)
+    for i, (rows, cols) in enumerate(cell_map):
+        flat[offsets[i]:offsets[i + 1]] = np.ravel_multi_index((rows, cols), shape)
+
+    return offsets, flat
+
+
+def csr_to_cells(offsets, flat, shape):
+    """
+    Inverse of cells_to_csr, returns the list of (rows, cols) tuples of polygon_to_raster_cells.
+    """
+    rows, cols = np.unravel_index(flat.astype(np.int64), shape)
+    return [
+        (rows[start:end], cols[start:end])
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ]
+
+
+def cache_path(cache_dir, key, kind="poly2cells"):
+    return pathlib.Path(cache_dir) / f"{kind}_{key}.npz"
+
+
+def load_mapping(cache_dir, key):
+    """
+    Load a cached mapping. Returns (offsets, flat, shape, polygon_ids) or None on a miss.
+    """
+    path = cache_path(cache_dir, key)
+    if not path.exists():
+        return None
+
+    try:
+        with np.load(path, allow_pickle=False) as npz:
+            return npz["offsets"], npz["flat"], tuple(npz["shape"]), npz["polygon_ids"]
+    except Exception as e:
+        # a broken entry is treated as a miss, it will be rebuilt and overwritten
+        LOGGER.warning(f"Could not read mapping cache {path}: {e}")
+        return None
+
+
+def _atomic_savez(path, **arrays):
+    """
+    Write an .npz file to a temporary name in the same directory and atomically rename it,
+    so concurrent jobs building the same entry never see a partial file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.stem}.", suffix=".npz.tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return path
+
+
+def save_mapping(
+    cache_dir,
+    key,
+    offsets,
+    flat,
+    shape,
+    polygon_ids,
+    geometry_hashes=None,
+    affine=None,
+    nodata_mask=None,
+    all_touched=None,
+    grid_key=None,
+):
+    """
+    Save a mapping to the cache. The geometry hashes of the polygons, the transform and nodata mask of the
+    raster and all_touched are stored with it (when given), so that find_cached_cells can reuse the cells of
+    unchanged polygons when the mapping of another shapefile is built. The mapping is indexed under grid_key
+    (its key without the nodata mask, when given) for find_grid_mapping.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    # numeric ids keep their dtype, string ids (object arrays would need pickling) are stored as unicode
+    polygon_ids = np.asarray(polygon_ids)
+    if polygon_ids.dtype == object:
+        polygon_ids = polygon_ids.astype(str)
+    arrays = {}
+    if geometry_hashes is not None:
+        arrays = dict(
+            geometry_hashes=np.asarray(geometry_hashes, dtype="U64"),
+            affine=np.array(tuple(affine)[:6], dtype=np.float64),
+            nodata_mask=np.packbits(nodata_mask),
+            all_touched=np.array(bool(all_touched)),
+        )
+    path = _atomic_savez(
+        cache_path(cache_dir, key),
+        offsets=offsets,
+        flat=flat,
+        shape=np.asarray(shape, dtype=np.int64),
+        polygon_ids=polygon_ids,
+        **arrays,
+    )
+    if geometry_hashes is not None:
+        # small index of the geometries of the mapping, scanned by find_cached_cells (written after the mapping)
+        _atomic_savez(
+            cache_path(cache_dir, key, kind="geomindex"),
+            hash_prefixes=np.unique(hash_prefixes(geometry_hashes)),
+            affine=arrays["affine"],
+            shape=np.asarray(shape, dtype=np.int64),
+            all_touched=arrays["all_touched"],
+        )
+    if grid_key is not None and nodata_mask is not None:
+        _atomic_savez(cache_path(cache_dir, f"{grid_key}_{key}", kind="gridindex"), shape=np.asarray(shape, dtype=np.int64))
+    return path
+
+
+def find_grid_mapping(cache_dir, grid_key, region, nodata_mask):
+    """
+    Key of a cached mapping indexed under grid_key whose nodata mask is nodata_mask in region
+    (row_start, row_stop, col_start, col_stop of its raster), or None. Only the rows of the region are
+    unpacked from the stored masks, so the raster of the mapping does not need to be read.
+    """
+    row_start, row_stop, col_start, col_stop = region
+    prefix = f"gridindex_{grid_key}_"
+    markers = sorted(pathlib.Path(cache_dir).glob(f"{prefix}*.npz"), key=os.path.getmtime, reverse=True)
+    for marker in markers:
+        key = marker.stem[len(prefix):]
+        path = cache_path(cache_dir, key)
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                n_cols = int(npz["shape"][1])
+                start, stop = row_start * n_cols, row_stop * n_cols
+                packed = npz["nodata_mask"][start // 8:(stop + 7) // 8]
+            bits = np.unpackbits(packed)[start % 8:start % 8 + stop - start].reshape(row_stop - row_start, n_cols)
+            if np.array_equal(bits[:, col_start:col_stop].astype(bool), nodata_mask):
+                return key
+        except Exception as e:
+            LOGGER.warning(f"Could not read mapping cache {path}: {e}")
+    return None
+
+
+def hash_prefixes(geometry_hashes):
+    """
+    First 64 bits of each geometry hash, 0 for the geometries without a hash
+    """
+    return np.array([int(h[:16], 16) if h else 0 for h in geometry_hashes], dtype=np.uint64)
+
+
+# geometry indexes read by find_cached_cells, by path and modification time
+_geometry_indexes = {}
+
+
+def read_geometry_index(path):
+    """
+    Hash prefixes, transform, shape and all_touched of the geometry index of a cached mapping
+    """
+    stamp = (str(path), os.path.getmtime(path))
+    if stamp not in _geometry_indexes:
+        with np.load(path, allow_pickle=False) as npz:
+            _geometry_indexes[stamp] = (
+                npz["hash_prefixes"], Affine(*npz["affine"]), tuple(npz["shape"]), bool(npz["all_touched"])
+            )
+    return _geometry_indexes[stamp]
+
+
+def grid_offset(old_affine, new_affine, tolerance=1e-6):
+    """
+    (rows, cols) to add to the cell indices of a raster with old_affine to get the cell indices of the same
+    cells in a raster with new_affine, or None if the cells of the two rasters are not on the same grid
+    (e.g. two windows of the same grid are, two resolutions are not)
+    """
+    a, b, c, d, e, f = (float(x) for x in tuple(old_affine)[:6])
+    if (a, b, d, e) != tuple(float(x) for x in (new_affine.a, new_affine.b, new_affine.d, new_affine.e)) or b or d:
+        return None
+    rows, cols = (f - new_affine.f) / e, (c - new_affine.c) / a
+    if abs(rows - round(rows)) > tolerance or abs(cols - round(cols)) > tolerance:
+        return None
+    return int(round(rows)), int(round(cols))
+
+
+def find_cached_cells(cache_dir, geometry_hashes, windows, affine, nodata_mask, all_touched):
+    """
+    Cells of the polygons whose geometry is part of a cached mapping of the same grid (any shapefile).
+    A cached mapping is only used when its nodata mask is the same as nodata_mask where the two rasters
+    overlap, and a polygon only when its window (row_start, row_stop, col_start, col_stop in the new raster)
+    is inside both rasters, so that the cells are the ones the polygon would be rasterized to.
+    Returns {position of the polygon: (rows, cols)}, the most recent mappings are looked at first.
+    Only the small geometry index of each mapping (hash prefixes and grid) is read, a mapping is opened
+    when its index has some of the geometries.
+    """
+    positions = {}
+    for i, geometry_hash in enumerate(geometry_hashes):
+        positions.setdefault(geometry_hash, []).append(i)
+    prefixes = hash_prefixes(geometry_hashes)
+    shape = nodata_mask.shape
+
+    found = {}
+    indexes = sorted(pathlib.Path(cache_dir).glob("geomindex_*.npz"), key=os.path.getmtime, reverse=True)
+    for index_path in indexes:
+        if len(found) == len(geometry_hashes):
+            break
+        path = index_path.with_name(index_path.name.replace("geomindex_", "poly2cells_", 1))
+        try:
+            index_prefixes, index_affine, old_shape, index_all_touched = read_geometry_index(index_path)
+            if index_all_touched != bool(all_touched):
+                continue
+            offset = grid_offset(index_affine, affine)
+            if offset is None:
+                continue
+
+            # overlap of the two rasters, in the cells of the new raster
+            row_start, col_start = max(offset[0], 0), max(offset[1], 0)
+            row_stop, col_stop = min(old_shape[0] + offset[0], shape[0]), min(old_shape[1] + offset[1], shape[1])
+            if row_start >= row_stop or col_start >= col_stop:
+                continue
+            pending = (prefixes != 0) & ~np.isin(np.arange(len(prefixes)), list(found))
+            if not np.isin(prefixes[pending], index_prefixes).any():
+                continue
+
+            with np.load(path, allow_pickle=False) as npz:
+                matches = [
+                    (j, i) for j, h in enumerate(npz["geometry_hashes"]) for i in positions.get(h, ()) if i not in found
+                ]
+                if not matches:
+                    continue
+
+                old_mask = np.unpackbits(npz["nodata_mask"], count=old_shape[0] * old_shape[1]).reshape(old_shape)
+                old_overlap = old_mask[
+                    row_start - offset[0]:row_stop - offset[0], col_start - offset[1]:col_stop - offset[1]
+                ]
+                if not np.array_equal(old_overlap.astype(bool), nodata_mask[row_start:row_stop, col_start:col_stop]):
+                    continue
+
+                offsets, flat = npz["offsets"], npz["flat"]
+                for j, i in matches:
+                    w = windows[i]
+                    if w[0] < row_start or w[1] > row_stop or w[2] < col_start or w[3] > col_stop:
+                        continue
+                    rows, cols = np.unravel_index(flat[offsets[j]:offsets[j + 1]].astype(np.int64), old_shape)
+                    found[i] = (rows + offset[0], cols + offset[1])
+        except Exception as e:
+            # a broken entry is skipped, its polygons are rasterized
+            LOGGER.warning(f"Could not read mapping cache {path}: {e}")
+    return found
+
+
+def load_weights(cache_dir, key, weighting):
+    """
+    Load the cell weights (aligned with the flat cell indices) of a cached mapping, or None on a miss.
+    """
+    path = cache_path(cache_dir, key, kind=f"weights_{weighting}")
+    if not path.exists():
+        return None
+
+    try:
+        with np.load(path, allow_pickle=False) as npz:
+            return npz["weights"]
+    except Exception as e:
+        LOGGER.warning(f"Could not read weights cache {path}: {e}")
+        return None
+
+
+def save_weights(cache_dir, key, weighting, weights):
+    """
+    Save the cell weights of a mapping next to the mapping itself.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    return _atomic_savez(cache_path(cache_dir, key, kind=f"weights_{weighting}"), weights=weights)
@@ -0,0 +1,60 @@
+# paths of the intermediate (one per component) and merged output files, shared by the aggregation
+# scripts and the Snakefile. Like utils/component_files.py this module only uses the standard library.
+# Two layouts are supported (output.layout):
+#   files (default): one file per year, named as in the previous versions of the pipeline,
+#         e.g. data/output/pm25_components__randall/county_monthly/pm25_components__randall__county_monthly_2015.parquet
+#   hive: one hive partitioned dataset per component/geography/frequency with a year=<year> partition per year,
+#         e.g. data/output/pm25_components__randall/county_monthly/year=2015/part-0.parquet
+
+import os
+
+LAYOUTS = ("hive", "files")
+
+
+def check_layout(layout):
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown output layout {layout}, options are {LAYOUTS}.")
+
+
+def component_output_file(temporal_freq, component, polygon_name, year, layout):
+    """
+    Relative path of the intermediate file of a component and year
+    """
+    check_layout(layout)
+    root = f"data/intermediate/pm25_components__randall/{temporal_freq}/{component}/"
+    if layout == "hive":
+        return f"{root}{polygon_name}/year={year}/part-0.parquet"
+    return f"{root}{component}__{polygon_name}_{temporal_freq}_{year}.parquet"
+
+
+def merged_output_file(polygon_name, temporal_freq, year, layout):
+    """
+    Relative path of the merged file (all the components) of a year
+    """
+    check_layout(layout)
+    root = f"data/output/pm25_components__randall/{polygon_name}_{temporal_freq}/"
+    if layout == "hive":
+        return f"{root}year={year}/part-0.parquet"
+    return f"{root}pm25_components__randall__{polygon_name}_{temporal_freq}_{year}.parquet"
+
+
+def partition_values(path):
+    """
+    {column: value} of the hive partition directories (key=value) of a file, e.g. {"year": 2015}
+    """
+    values = {}
+    for part in os.path.normpath(os.path.dirname(path)).split(os.sep):
+        if "=" in part:
+            key, value = part.split("=", 1)
+            values[key] = int(value) if value.lstrip("-").isdigit() else value
+    return values
+
+
+def sidecar_path(output_path, suffix):
+    """
+    Path of a file stored next to an output (e.g. suffix .metrics.json). Inside a hive partition the name
+    starts with an underscore, so that dataset readers (pyarrow, pandas, spark...) skip it.
+    """
+    directory, name = os.path.split(output_path)
+    prefix = "_" if partition_values(output_path) else ""
+    return os.path.join(directory, f"{prefix}{os.path.splitext(name)[0]}{suffix}")
@@ -0,0 +1,184 @@
+# parquet writer of the intermediate and merged outputs, with fixed size row groups and column statistics.
+# The compact encoding (output.compact) is opt-in: dictionary encoded polygon ids, small integer year/month and
+# rows sorted by polygon id and time, so that scans over many years can skip row groups and files by id or time.
+# Otherwise the tables are written with their columns, types and row order. With output.float32 (the default, as
+# the np.nanmean of the float32 rasters in the previous versions) the statistics are stored as float32, the
+# partial sums and counts of the roll-up (e.g. no3_sum__county) are kept in float64.
+
+import os
+import pathlib
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from utils.output_paths import partition_values
+
+time_types = {"year": pa.int16(), "month": pa.int8()}
+
+
+def is_statistic(field, keys):
+    """
+    Whether a column holds float statistics stored as float32 with output.float32 (not the roll-up partials)
+    """
+    return field.name not in keys and "__" not in field.name and pa.types.is_floating(field.type)
+
+
+def compact_table(table, keys, compact=True, float32=True, sort_keys=None):
+    """
+    Table with the key columns first, sorted by the keys (polygon id, year, month) or by sort_keys, the polygon ids
+    dictionary encoded and the statistics cast to float32 (when float32 is true). When compact is false the
+    table keeps its columns, types and row order, only the statistics are cast (when float32 is true).
+    """
+    polygon_name = keys[0]
+    if not compact:
+        for i, field in enumerate(table.schema):
+            if float32 and is_statistic(field, keys):
+                table = table.set_column(i, field.name, table.column(i).cast(pa.float32()))
+        return table
+
+    columns = {}
+    for name in keys + [name for name in table.column_names if name not in keys]:
+        column = table.column(name)
+        if pa.types.is_dictionary(column.type):
+            column = column.cast(column.type.value_type)
+        if name in time_types:
+            column = column.cast(time_types[name])
+        elif float32 and is_statistic(table.schema.field(name), keys):
+            column = column.cast(pa.float32())
+        columns[name] = column
+
+    table = pa.table(columns).sort_by([(key, "ascending") for key in (sort_keys or keys)])
+    polygon_ids = pc.dictionary_encode(table.column(polygon_name))
+    return table.set_column(0, polygon_name, polygon_ids)
+
+
+def temporary_path(path):
+    """
+    Temporary file next to an output, renamed to the output once it is complete
+    """
+    os.makedirs(path.parent, exist_ok=True)
+    # not created with mkstemp, so that the output gets the default file mode (mkstemp files are private)
+    return str(path.with_name(f".{path.name}.{os.getpid()}.tmp"))
+
+
+def write_table(table, output_path, keys, row_group_size, compression):
+    """
+    Write a table (sorted by keys, or in its original order when keys is empty) with a streaming parquet writer,
+    row_group_size rows at a time, with column statistics and the sort order in the file metadata. Columns that are hive partitions of the output path
+    (e.g. year=2015) are not stored in the file. The file is written to a temporary file and renamed.
+    """
+    partitions = partition_values(output_path)
+    table = table.select([name for name in table.column_names if name not in partitions])
+    sorting_columns = [pq.SortingColumn(table.column_names.index(key)) for key in keys if key not in partitions]
+
+    path = pathlib.Path(output_path)
+    tmp_path = temporary_path(path)
+    try:
+        with pq.ParquetWriter(
+            tmp_path,
+            table.schema,
+            compression=compression,
+            write_statistics=True,
+            sorting_columns=sorting_columns,
+        ) as writer:
+            for start in range(0, max(table.num_rows, 1), row_group_size):
+                writer.write_table(table.slice(start, row_group_size))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class StreamingWriter:
+    """
+    Write an output one table at a time (e.g. the statistics of each file) with a streaming parquet writer, so that
+    only row_group_size rows are buffered. With compact, each table is compacted as by compact_table and sorted by
+    time then polygon id, so the output is sorted by time and polygon id when the tables are written in time order
+    (the sort order recorded in the file metadata). Otherwise the tables are written as they are. The file is written to a temporary file and renamed by close, abort
+    removes it. Used as a context manager, the output is closed on success and aborted on errors.
+    """
+
+    def __init__(self, output_path, keys, compact, float32, row_group_size, compression):
+        self.path = pathlib.Path(output_path)
+        self.keys = keys
+        self.compact = compact
+        self.float32 = float32
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.partitions = partition_values(output_path)
+        self.tmp_path = temporary_path(self.path)
+        self.writer = None
+        self.buffer = []
+        self.n_rows = 0
+
+    def write(self, table):
+        sort_keys = self.keys[1:] + self.keys[:1]
+        table = compact_table(table, self.keys, self.compact, self.float32, sort_keys=sort_keys)
+        table = table.select([name for name in table.column_names if name not in self.partitions])
+        if self.writer is None:
+            sort_keys = [key for key in sort_keys if key not in self.partitions] if self.compact else []
+            self.writer = pq.ParquetWriter(
+                self.tmp_path,
+                table.schema,
+                compression=self.compression,
+                write_statistics=True,
+                sorting_columns=[pq.SortingColumn(table.column_names.index(key)) for key in sort_keys],
+            )
+        self.buffer.append(table)
+        self.n_rows += table.num_rows
+        if sum(t.num_rows for t in self.buffer) >= self.row_group_size:
+            self.flush(final=False)
+
+    def flush(self, final):
+        """
+        Write the buffered rows as row groups of row_group_size rows, keeping the remainder unless final
+        """
+        buffered = pa.concat_tables(self.buffer).combine_chunks() if self.buffer else None
+        self.buffer = []
+        if buffered is None:
+            return
+        start = 0
+        while buffered.num_rows - start >= self.row_group_size or (final and start < buffered.num_rows):
+            self.writer.write_table(buffered.slice(start, self.row_group_size))
+            start += self.row_group_size
+        if start < buffered.num_rows:
+            self.buffer = [buffered.slice(start)]
+
+    def close(self):
+        if self.writer is None:
+            raise ValueError(f"Nothing was written to {self.path}.")
+        self.flush(final=True)
+        self.writer.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def read_output(output_path):
+    """
+    Table of an output file, with the hive partition columns of its path (e.g. year) added back
+    and the dictionary encoded columns decoded
+    """
+    table = pq.read_table(output_path).replace_schema_metadata(None)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(field.type.value_type))
+    for name, value in partition_values(output_path).items():
+        column = pa.array([value] * table.num_rows, type=time_types.get(name))
+        table = table.append_column(name, column)
+    return table
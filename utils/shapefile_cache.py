@@ -0,0 +1,168 @@
+# preprocessed copy of a shapefile (src/convert_shapefile.py), stored as geoparquet next to it:
+#   data/input/shapefiles/shapefile_{polygon}_{year}/geometries.parquet
+# It holds the id column and the geometries in the crs of the rasters, the bounds of each feature
+# (xmin, ymin, xmax, ymax) and its window in the full component grid (row_start, row_stop, col_start, col_stop),
+# so that the aggregation jobs load the polygons in bulk instead of parsing the shapefile feature by feature.
+# The file metadata records the hash of the source shapefile (the copy is ignored once the shapefile changes)
+# and the transform and shape of the grid of the windows.
+# The file is not named shapefile.*, so that it is not part of the hash of the shapefile (utils/mapping_cache.py).
+
+import json
+import os
+
+import geopandas as gpd
+import numpy as np
+import pyarrow.parquet as pq
+import pyproj
+import shapely
+
+from utils.faster_zonal_stats import bounds_windows
+
+BOUNDS_COLUMNS = ["xmin", "ymin", "xmax", "ymax"]
+WINDOW_COLUMNS = ["row_start", "row_stop", "col_start", "col_stop"]
+METADATA_KEY = b"shapefile_cache"
+
+
+def preprocessed_path(shape_path):
+    return os.path.join(os.path.dirname(shape_path), "geometries.parquet")
+
+
+def grid_key(transform):
+    """
+    Coefficients of an affine transform, as stored in the metadata
+    """
+    return [float(v) for v in list(transform)[:6]]
+
+
+def to_raster_crs(polygon, crs):
+    """
+    Polygons reprojected to the crs of the rasters (unchanged when they have no crs or already use it)
+    """
+    if crs is None or polygon.crs is None or polygon.crs == crs:
+        return polygon
+    return polygon.to_crs(crs)
+
+
+def write_preprocessed(polygon, path, idvar, source_hash, transform=None, shape=None):
+    """
+    Write the id column and the geometries of the polygons with their bounds, and their windows in the grid
+    of the given transform and shape (when given), to a geoparquet file
+    """
+    bounds = shapely.bounds(polygon.geometry.values)
+    table = gpd.GeoDataFrame(
+        {idvar: polygon[idvar].values, **{name: bounds[:, i] for i, name in enumerate(BOUNDS_COLUMNS)}},
+        geometry=polygon.geometry.values,
+        crs=polygon.crs,
+    )
+    metadata = {"source_hash": source_hash, "idvar": idvar, "grid_transform": None, "grid_shape": None}
+    if transform is not None:
+        windows = bounds_windows(bounds, transform)
+        for i, name in enumerate(WINDOW_COLUMNS):
+            table[name] = windows[:, i].astype(np.int32)
+        metadata.update(grid_transform=grid_key(transform), grid_shape=[int(n) for n in shape])
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        table.to_parquet(tmp_path, index=False, write_covering_bbox=False)
+        # add the cache metadata to the geo metadata written by geopandas
+        arrow_table = pq.read_table(tmp_path)
+        arrow_table = arrow_table.replace_schema_metadata(
+            {**arrow_table.schema.metadata, METADATA_KEY: json.dumps(metadata).encode()}
+        )
+        pq.write_table(arrow_table, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return metadata
+
+
+def read_metadata(path):
+    """
+    Cache metadata of a preprocessed file (None if the file does not exist or is not a preprocessed shapefile)
+    """
+    if not os.path.exists(path):
+        return None
+    metadata = pq.read_schema(path).metadata or {}
+    return json.loads(metadata[METADATA_KEY]) if METADATA_KEY in metadata else None
+
+
+def shapefile_crs(shape_path):
+    """
+    Crs of a shapefile, read from its .prj file (None when there is none)
+    """
+    prj_path = os.path.splitext(shape_path)[0] + ".prj"
+    if not os.path.exists(prj_path):
+        return None
+    with open(prj_path) as f:
+        return pyproj.CRS.from_wkt(f.read())
+
+
+def preprocessed_crs(path):
+    """
+    Crs of the geometries of a preprocessed file, read from its geoparquet metadata
+    """
+    geo = json.loads(pq.read_schema(path).metadata[b"geo"])
+    column = geo["columns"][geo["primary_column"]]
+    # geoparquet: a missing crs is OGC:CRS84, a null crs is unknown
+    if "crs" not in column:
+        return pyproj.CRS("OGC:CRS84")
+    return None if column["crs"] is None else pyproj.CRS.from_json_dict(column["crs"])
+
+
+def read_feature_bounds(path, source_hash, crs=None, columns=()):
+    """
+    Dataframe of the given columns and the bounds of each polygon of a preprocessed file, read without
+    the geometries, or None when read_preprocessed would not use the file
+    """
+    metadata = read_metadata(path)
+    if metadata is None or metadata["source_hash"] != source_hash:
+        return None
+    file_crs = preprocessed_crs(path)
+    if crs is not None and file_crs is not None and file_crs != crs:
+        return None
+    return pq.read_table(path, columns=list(columns) + BOUNDS_COLUMNS).to_pandas()
+
+
+def read_bounds(path, source_hash, crs=None):
+    """
+    Bounding box (xmin, ymin, xmax, ymax) of the polygons of a preprocessed file, read from its bounds
+    columns only, or None when read_preprocessed would not use the file
+    """
+    bounds = read_feature_bounds(path, source_hash, crs)
+    if bounds is None:
+        return None
+    return (
+        float(bounds["xmin"].min()),
+        float(bounds["ymin"].min()),
+        float(bounds["xmax"].max()),
+        float(bounds["ymax"].max()),
+    )
+
+
+def read_preprocessed(path, source_hash, crs=None):
+    """
+    Polygons of a preprocessed file and its metadata, or None when the file is missing, was made
+    from another version of the shapefile or is in another crs
+    """
+    metadata = read_metadata(path)
+    if metadata is None or metadata["source_hash"] != source_hash:
+        return None
+    polygon = gpd.read_parquet(path)
+    if crs is not None and polygon.crs is not None and polygon.crs != crs:
+        return None
+    return polygon, metadata
+
+
+def feature_windows(polygon, metadata, transform, shape):
+    """
+    (n, 4) windows of the polygons in the raster of the given transform and shape: the stored windows when
+    the raster is the grid they were computed for, otherwise computed in bulk from the stored bounds.
+    None when the polygons do not come from a preprocessed file.
+    """
+    if metadata is None:
+        return None
+    if metadata["grid_transform"] == grid_key(transform) and metadata["grid_shape"] == [int(n) for n in shape]:
+        return polygon[WINDOW_COLUMNS].to_numpy(np.int64)
+    return bounds_windows(polygon[BOUNDS_COLUMNS].to_numpy(), transform)